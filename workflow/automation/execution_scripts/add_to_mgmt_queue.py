@@ -18,6 +18,13 @@ def datestr_to_timestamp(time: str):
     )
 
 
+def parse_job_id(job_id: str):
+    """
+    Job ids are integers, other than the jobid_index of array job elements
+    """
+    return int(job_id) if job_id.isdigit() else job_id
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -37,9 +44,10 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "job_id",
-        type=int,
+        type=parse_job_id,
         nargs="?",
-        help="The job id. Used for setting on job queueing, used for matching on following steps",
+        help="The job id, or jobid_index for array job elements. Used for setting on job queueing, "
+        "used for matching on following steps",
         default=None,
     )
     parser.add_argument(
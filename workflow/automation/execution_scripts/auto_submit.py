@@ -6,8 +6,10 @@ import argparse
 import os
 import time
 
+from contextlib import nullcontext
 from datetime import datetime
 from logging import Logger
+from threading import Event
 from typing import List, Dict
 import numpy as np
 
@@ -27,6 +29,11 @@ from workflow.automation.submit.submit_bb import main as submit_bb_main
 from workflow.automation.submit.submit_sim_imcalc import submit_im_calc_slurm
 from workflow.automation.submit.submit_vm_pert import submit_vm_pert_main
 from workflow.automation.lib import shared_automated_workflow
+from workflow.automation.lib.mgmt_db_queue import get_pending_updates, get_queue
+from workflow.automation.lib.task_prioritisation import (
+    PRIORITY_POLICIES,
+    TaskPrioritiser,
+)
 from workflow.automation.platform_config import (
     HPC,
     platform_config,
@@ -397,9 +404,27 @@ def run_main_submit_loop(
     sleep_time: int,
     main_logger: Logger = qclogging.get_basic_logger(),
     cycle_timeout=1,
+    wake_event: Event = None,
+    array_jobs: bool = False,
+    priority: str = "fifo",
 ):
+    """Submits runnable tasks every sleep_time seconds, until nothing has been running or runnable
+    for cycle_timeout cycles.
+    :param wake_event: When set, wakes the loop to submit tasks made runnable by mgmt db updates.
+    The scheduler is still only checked every sleep_time seconds, cycles in between reuse the free
+    slots from the last check, less the tasks submitted since
+    :param array_jobs: Submit the tasks of each cycle with the same process type and resources as array jobs,
+    rather than one job per task. Only supported by Slurm
+    :param priority: The policy of task_prioritisation.PRIORITY_POLICIES used to order the runnable tasks
+    before the free slots of each machine are filled. fifo keeps the order the tasks were created in
+    """
     mgmt_queue_folder = sim_struct.get_mgmt_db_queue(root_folder)
+    mgmt_queue = get_queue(mgmt_queue_folder)
     mgmt_db = MgmtDB(sim_struct.get_mgmt_db(root_folder))
+    mgmt_db.migrate(main_logger)
+    prioritiser = TaskPrioritiser(
+        priority, root_folder, mgmt_db, given_tasks_to_run, main_logger
+    )
     root_params_file = os.path.join(
         sim_struct.get_runs_dir(root_folder), "root_params.yaml"
     )
@@ -415,45 +440,60 @@ def run_main_submit_loop(
     time_since_something_happened = cycle_timeout
 
     first = True
+    last_scheduler_check = None
     while time_since_something_happened > 0 or first:
         first = False
-        main_logger.debug(
-            "time_since_something_happened is now {}".format(
-                time_since_something_happened
+        check_scheduler = (
+            wake_event is None
+            or last_scheduler_check is None
+            or time.monotonic() - last_scheduler_check >= sleep_time
+        )
+        if check_scheduler:
+            last_scheduler_check = time.monotonic()
+            main_logger.debug(
+                "time_since_something_happened is now {}".format(
+                    time_since_something_happened
+                )
             )
-        )
-        time_since_something_happened -= 1
+            time_since_something_happened -= 1
+            # Get in progress tasks in the db and the HPC queue
+            n_tasks_to_run = {}
+            for hpc in HPC:
+                try:
+                    squeued_tasks = Scheduler.get_scheduler().check_queues(
+                        user=True, target_machine=hpc
+                    )
+                except EnvironmentError as e:
+                    main_logger.critical(e)
+                    n_tasks_to_run[hpc] = 0
+                else:
+                    n_tasks_to_run[hpc] = n_runs[hpc] - len(squeued_tasks)
+                    if len(squeued_tasks) > 0:
+                        main_logger.debug(
+                            "There was at least one job in squeue, resetting timeout"
+                        )
+                        time_since_something_happened = cycle_timeout
+        else:
+            main_logger.debug(
+                "Woken by mgmt db updates, using the free slots from the last scheduler check: {}".format(
+                    n_tasks_to_run
+                )
+            )
+
         # Get items in the mgmt queue, have to get a snapshot instead of
-        # checking the directory real-time to prevent timing issues,
+        # checking the queue real-time to prevent timing issues,
         # which can result in dual-submission
-        mgmt_queue_entries = os.listdir(mgmt_queue_folder)
-
-        # Get in progress tasks in the db and the HPC queue
-        n_tasks_to_run = {}
-        for hpc in HPC:
-            try:
-                squeued_tasks = Scheduler.get_scheduler().check_queues(
-                    user=True, target_machine=hpc
-                )
-            except EnvironmentError as e:
-                main_logger.critical(e)
-                n_tasks_to_run[hpc] = 0
-            else:
-                n_tasks_to_run[hpc] = n_runs[hpc] - len(squeued_tasks)
-                if len(squeued_tasks) > 0:
-                    main_logger.debug(
-                        "There was at least one job in squeue, resetting timeout"
-                    )
-                    time_since_something_happened = cycle_timeout
+        pending_updates = get_pending_updates(mgmt_queue.keys())
 
         # Gets all runnable tasks based on mgmt db state
         runnable_tasks = mgmt_db.get_runnable_tasks(
             rels_to_run,
-            sum(n_runs.values()),
-            os.listdir(sim_struct.get_mgmt_db_queue(root_folder)),
+            prioritiser.candidate_limit(sum(n_runs.values())),
+            pending_updates,
             given_tasks_to_run,
             main_logger,
         )
+        runnable_tasks = prioritiser.prioritise(runnable_tasks, rels_to_run)
         if len(runnable_tasks) > 0:
             time_since_something_happened = cycle_timeout
             main_logger.info("Number of runnable tasks: {}".format(len(runnable_tasks)))
@@ -471,7 +511,7 @@ def run_main_submit_loop(
             # outstanding mgmt db updates
             if (
                 not shared_automated_workflow.check_mgmt_queue(
-                    mgmt_queue_entries, cur_run_name, cur_proc_type
+                    pending_updates, cur_run_name, cur_proc_type
                 )
                 and task_counter.get(cur_hpc, 0) < n_tasks_to_run[cur_hpc]
             ):
@@ -502,36 +542,52 @@ def run_main_submit_loop(
             main_logger.debug("No tasks to run this iteration")
 
         # Submit the runnable tasks
-        for proc_type, run_name, retries in tasks_to_run:
-
-            # Special handling for merge-ts
-            if proc_type == const.ProcessType.merge_ts.value:
-                # Check if clean up has already run
-                if mgmt_db.is_task_complete(
-                    [const.ProcessType.clean_up.value, run_name]
-                ):
-                    # If clean_up has already run, then we should set it to
-                    # be run again after merge_ts has run
-                    shared_automated_workflow.add_to_queue(
-                        mgmt_queue_folder,
-                        run_name,
-                        const.ProcessType.clean_up.value,
-                        const.Status.created.value,
-                        logger=main_logger,
-                    )
+        with (
+            shared_automated_workflow.array_submission(main_logger)
+            if array_jobs
+            else nullcontext()
+        ):
+            for proc_type, run_name, retries in tasks_to_run:
+
+                # Special handling for merge-ts
+                if proc_type == const.ProcessType.merge_ts.value:
+                    # Check if clean up has already run
+                    if mgmt_db.is_task_complete(
+                        [const.ProcessType.clean_up.value, run_name]
+                    ):
+                        # If clean_up has already run, then we should set it to
+                        # be run again after merge_ts has run
+                        shared_automated_workflow.add_to_queue(
+                            mgmt_queue_folder,
+                            run_name,
+                            const.ProcessType.clean_up.value,
+                            const.Status.created.value,
+                            logger=main_logger,
+                        )
 
-            # submit the job
-            submit_task(
-                sim_struct.get_sim_dir(root_folder, run_name),
-                proc_type,
-                run_name,
-                root_folder,
-                main_logger,
-                retries=retries,
-                hf_seed=hf_seed,
+                # submit the job
+                submit_task(
+                    sim_struct.get_sim_dir(root_folder, run_name),
+                    proc_type,
+                    run_name,
+                    root_folder,
+                    main_logger,
+                    retries=retries,
+                    hf_seed=hf_seed,
+                )
+        for hpc, n_submitted in task_counter.items():
+            n_tasks_to_run[hpc] -= n_submitted
+
+        if wake_event is None:
+            main_logger.debug("Sleeping for {} second(s)".format(sleep_time))
+            time.sleep(sleep_time)
+        else:
+            timeout = max(0, last_scheduler_check + sleep_time - time.monotonic())
+            main_logger.debug(
+                "Waiting up to {} second(s) for mgmt db updates".format(timeout)
             )
-        main_logger.debug("Sleeping for {} second(s)".format(sleep_time))
-        time.sleep(sleep_time)
+            if wake_event.wait(timeout):
+                wake_event.clear()
     main_logger.info("Nothing was running or ready to run last cycle, exiting now")
 
 
@@ -579,6 +635,21 @@ def main():
         help="An SQLite formatted query to match the realisations that should run.",
         default="%",
     )
+    parser.add_argument(
+        "--array_jobs",
+        action="store_true",
+        help="Submit the tasks of each cycle with the same process type and resources as array jobs. "
+        "Only supported by Slurm",
+    )
+    parser.add_argument(
+        "--priority",
+        choices=list(PRIORITY_POLICIES),
+        default="fifo",
+        help="How runnable tasks are ordered before filling the free slots of each machine. "
+        "fifo: the order tasks were created in, sjf: fewest estimated core hours first, "
+        "critical_path: longest estimated run time to the end of the realisation first, "
+        "fair_share: tasks of each fault in turn",
+    )
 
     args = parser.parse_args()
 
@@ -676,6 +747,8 @@ def main():
         task_types_to_run,
         args.sleep_time,
         main_logger=logger,
+        array_jobs=args.array_jobs,
+        priority=args.priority,
     )
 
 
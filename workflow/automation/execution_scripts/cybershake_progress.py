@@ -43,42 +43,48 @@ _summary_est_template_fmt = (
 )
 
 
-def get_chours_used(root_dir: str, fault_names: List[str], proc_types: List[str]):
+def get_states_df(db: MgmtDB):
+    """Returns a dataframe of the core hour states of all realisations, with their fault,
+    process type name and core hours"""
+    states_df = pd.DataFrame(
+        [
+            (
+                state.run_name,
+                sim_struct.get_fault_from_realisation(state.run_name),
+                const.ProcessType(state.proc_type).str_value,
+                state.status,
+                state.core_hours,
+            )
+            for state in db.get_core_hour_states_bulk(ChCountType.Needed)
+        ],
+        columns=["run_name", "fault_name", "proc_type", "status", "core_hours"],
+    )
+    # Jobs without a duration log entry have no core hours
+    states_df["core_hours"] = states_df["core_hours"].astype(float)
+    return states_df
+
+
+def get_chours_used(
+    root_dir: str,
+    fault_names: List[str],
+    proc_types: List[str],
+    states_df: pd.DataFrame = None,
+):
     """Returns a dataframe containing the core hours used for each of the
     specified faults"""
-    db = MgmtDB(f"{root_dir}/slurm_mgmt.db")
-    df = pd.DataFrame(
-        columns=proc_types,
-        index=fault_names,
-        data=np.zeros(shape=(len(fault_names), len(proc_types))),
+    if states_df is None:
+        states_df = get_states_df(MgmtDB(f"{root_dir}/slurm_mgmt.db"))
+    return (
+        states_df.pivot_table(
+            index="fault_name",
+            columns="proc_type",
+            values="core_hours",
+            aggfunc="sum",
+        )
+        .reindex(index=fault_names, columns=proc_types)
+        .fillna(0)
     )
 
-    rel_names = db.get_rel_names()
-    for fault_name in fault_names:
-        flt_rel_names = [
-            rel_name[0] for rel_name in rel_names if fault_name in rel_name[0]
-        ]
-        for rel_name in flt_rel_names:
-            rel_states = db.get_core_hour_states(rel_name, ChCountType.Needed)
-            for state in rel_states:
-                _, _, proc_type, _, job_id, _ = state
-                proc_type_name = const.ProcessType(proc_type).str_value
-                if proc_type_name in proc_types:
-                    (
-                        _,
-                        _,
-                        _,
-                        start_time,
-                        end_time,
-                        _,
-                        cores,
-                        _,
-                        _,
-                    ) = db.get_job_duration_info(job_id)
-                    runtime = end_time - start_time
-                    df.loc[fault_name, proc_type_name] += cores * runtime / 3600
-    return df
-
 
 def get_faults_dict(cybershake_list: str):
     """Gets the fault names and number of realisations from a cybershake fault list."""
@@ -120,7 +126,8 @@ def get_new_progress_df(root_dir, faults_dict, mgmtdb: MgmtDB, proc_types: List[
     )
 
     # Get actual core hours for all faults
-    chours_df = get_chours_used(root_dir, fault_names, proc_types)
+    states_df = get_states_df(mgmtdb)
+    chours_df = get_chours_used(root_dir, fault_names, proc_types, states_df)
 
     # Populate progress dataframe with estimation data and actual data
     for proc_type in proc_types:
@@ -131,14 +138,19 @@ def get_new_progress_df(root_dir, faults_dict, mgmtdb: MgmtDB, proc_types: List[
         progress_df[proc_type, ACT_CORE_HOURS_COL] = chours_df[proc_type]
 
     # Retrieve the number of completed RELs from DB
-    for fault_name in fault_names:
-        for proc_type in proc_types:
-            task = fault_name + "_REL%" if faults_dict[fault_name] > 1 else fault_name
-            like = faults_dict[fault_name] > 1
-            r_completed = mgmtdb.num_task_complete(
-                (const.ProcessType.from_str(proc_type).value, task), like=like
-            )
-            progress_df.loc[fault_name, (proc_type, NUM_COMPLETED_COL)] = r_completed
+    completed_df = (
+        states_df[states_df.status == const.Status.completed.value]
+        .pivot_table(
+            index="fault_name",
+            columns="proc_type",
+            values="run_name",
+            aggfunc="count",
+        )
+        .reindex(index=fault_names, columns=proc_types)
+        .fillna(0)
+    )
+    for proc_type in proc_types:
+        progress_df[proc_type, NUM_COMPLETED_COL] = completed_df[proc_type]
 
     # Compute total estimated time and actual time across all faults
     idx = pd.IndexSlice
@@ -5,6 +5,7 @@ A script that queries a slurm mgmt db and returns the status of a task
 """
 
 import argparse
+import os
 from typing import Union, List
 
 from workflow.automation.lib import MgmtDB
@@ -354,6 +355,12 @@ def main():
         help="The cybershake config file defining which tasks are being run, and should be looked at ",
     )
 
+    parser.add_argument(
+        "--integrity_check",
+        action="store_true",
+        help="runs a full integrity check of the db instead of querying it. Reads the whole db, so can be slow",
+    )
+
     parser.add_argument(
         "--mode-help",
         action="store_true",
@@ -367,6 +374,17 @@ def main():
     f = args.run_folder
     run_name = args.run_name
     mode = args.mode
+
+    if args.integrity_check:
+        problems = MgmtDB.MgmtDB(
+            os.path.abspath(os.path.join(f, "slurm_mgmt.db"))
+        ).check_integrity()
+        if len(problems) > 0:
+            print("\n".join(problems))
+            exit(1)
+        print("ok")
+        exit()
+
     db = MgmtDB.connect_db(f)
 
     query_mode = QueryModes()
@@ -7,7 +7,8 @@ import urllib
 import argparse
 import time
 from logging import Logger
-from typing import List, Dict
+from threading import Event
+from typing import Dict, List, Set, Tuple
 from datetime import datetime
 
 from qcore.qclogging import VERYVERBOSE
@@ -16,15 +17,32 @@ import qcore.constants as const
 import qcore.simulation_structure as sim_struct
 from qcore import qclogging
 from workflow.automation.lib.MgmtDB import MgmtDB, SchedulerTask
+from workflow.automation.lib.schedulers.abstractscheduler import QUEUE_TTL
 from workflow.automation.lib.schedulers.scheduler_factory import Scheduler
 from workflow.automation.platform_config import HPC
 from workflow.automation.lib.shared_automated_workflow import check_mgmt_queue
+from workflow.automation.lib.mgmt_db_queue import (
+    QueueWatcher,
+    get_pending_updates,
+    get_queue,
+)
 from workflow.automation.metadata.log_metadata import store_metadata
 
 # Have to include sub-seconds, as clean up can run sub one second.
 
 QUEUE_MONITOR_LOG_FILE_NAME = "queue_monitor_log_{}.txt"
 DEFAULT_N_MAX_RETRIES = 2
+# Updates that can make tasks runnable
+SUBMIT_WAKE_STATUSES = [
+    const.Status.created.value,
+    const.Status.completed.value,
+    const.Status.killed_WCT.value,
+    const.Status.failed.value,
+]
+
+# Minimum seconds between re-checks of the scheduler, in between scheduler cycles, for jobs that
+# have reported finishing
+RECHECK_INTERVAL = 2
 
 keepAlive = True
 
@@ -41,37 +59,8 @@ def send_alert(msg, alert_url):
     response = urllib.request.urlopen(req, jsondataasbytes)
 
 
-def get_queue_entry(
-    entry_file: str, queue_logger: Logger = qclogging.get_basic_logger()
-):
-    try:
-        with open(entry_file, "r") as f:
-            data_dict = json.load(f)
-    except json.JSONDecodeError as ex:
-        queue_logger.error(
-            "Failed to decode the file {} as json. Check that this is "
-            "valid json. Ignored!".format(entry_file)
-        )
-        return None
-
-    return SchedulerTask(
-        run_name=os.path.basename(entry_file).split(".")[1],
-        proc_type=data_dict[MgmtDB.col_proc_type],
-        status=data_dict[MgmtDB.col_status],
-        job_id=data_dict[MgmtDB.col_job_id],
-        error=data_dict.get("error"),
-        queued_time=data_dict.get(MgmtDB.col_queued_time),
-        start_time=data_dict.get(MgmtDB.col_start_time),
-        end_time=data_dict.get(MgmtDB.col_end_time),
-        nodes=data_dict.get(MgmtDB.col_nodes),
-        cores=data_dict.get(MgmtDB.col_cores),
-        memory=data_dict.get(MgmtDB.col_memory),
-        wct=data_dict.get(MgmtDB.col_wct),
-    )
-
-
 def update_tasks(
-    mgmt_queue_entries: List[str],
+    pending_updates: Set[Tuple[str, int]],
     squeue_tasks: Dict[str, str],
     db_running_tasks: List[SchedulerTask],
     complete_data: bool,
@@ -80,6 +69,9 @@ def update_tasks(
 ):
     """Updates the mgmt db entries based on the HPC queue"""
     tasks_to_do = []
+    # Tasks that are no longer in the HPC queue, and those of them that are to be reset
+    finished_tasks = []
+    disappeared_tasks = []
 
     task_logger.debug("Checking running tasks in the db for updates")
     task_logger.debug(
@@ -114,7 +106,7 @@ def update_tasks(
                     )
                 )
             elif not check_mgmt_queue(
-                mgmt_queue_entries,
+                pending_updates,
                 db_running_task.run_name,
                 db_running_task.proc_type,
                 logger=task_logger,
@@ -143,7 +135,7 @@ def update_tasks(
         # Only reset if there is no entry on the mgmt queue for this
         # realisation/proc combination and nothing in the mgmt folder
         elif not check_mgmt_queue(
-            mgmt_queue_entries,
+            pending_updates,
             db_running_task.run_name,
             db_running_task.proc_type,
             logger=task_logger,
@@ -160,58 +152,150 @@ def update_tasks(
                     f"not found on {Scheduler.get_scheduler().QUEUE_NAME} or in the management db folder; resetting the status "
                     "to 'created' for resubmission"
                 )
+                disappeared_tasks.append(db_running_task)
+            # When job failed, we want to log metadata as well
+            finished_tasks.append(db_running_task)
 
-                # Check for if task was killed by Wall Clock Time
-                try:
-                    killed_wct = Scheduler.get_scheduler().check_wct_hit(
-                        db_running_task.job_id
-                    )
-                except IndexError:
-                    task_logger.warning(
-                        f"Could not find wall clock time for Task '{const.ProcessType(db_running_task.proc_type).str_value}' "
-                        f"on '{db_running_task.run_name}'"
-                    )
-                    killed_wct = False
+    # The scheduler is queried for all disappeared tasks at once, rather than once per task
+    # Check for if tasks were killed by Wall Clock Time
+    killed_wct = Scheduler.get_scheduler().check_wct_hit_many(
+        [db_running_task.job_id for db_running_task in disappeared_tasks]
+    )
+    for db_running_task in disappeared_tasks:
+        if db_running_task.job_id not in killed_wct:
+            task_logger.warning(
+                f"Could not find wall clock time for Task '{const.ProcessType(db_running_task.proc_type).str_value}' "
+                f"on '{db_running_task.run_name}'"
+            )
 
-                # Add an error
-                tasks_to_do.append(
-                    SchedulerTask(
-                        db_running_task.run_name,
-                        db_running_task.proc_type,
-                        const.Status.killed_WCT.value
-                        if killed_wct
-                        else const.Status.failed.value,
-                        None,
-                        f"Disappeared from {Scheduler.get_scheduler().QUEUE_NAME}.",
-                    )
+        # Add an error
+        tasks_to_do.append(
+            SchedulerTask(
+                db_running_task.run_name,
+                db_running_task.proc_type,
+                const.Status.killed_WCT.value
+                if killed_wct.get(db_running_task.job_id, False)
+                else const.Status.failed.value,
+                None,
+                f"Disappeared from {Scheduler.get_scheduler().QUEUE_NAME}.",
+            )
+        )
+
+    metadata = Scheduler.get_scheduler().get_metadata_many(finished_tasks, task_logger)
+    for db_running_task in finished_tasks:
+        start_time, end_time, run_time, n_cores, status = metadata[
+            db_running_task.job_id
+        ]
+        log_file = os.path.join(
+            sim_struct.get_sim_dir(root_folder, db_running_task.run_name),
+            "ch_log",
+            "metadata_log.json",
+        )
+        # now log metadata
+        store_metadata(
+            log_file,
+            const.ProcessType(db_running_task.proc_type).str_value,
+            {
+                "start_time": start_time,
+                "end_time": end_time,
+                "run_time": run_time,
+                "cores": n_cores,
+                "status": status,
+            },
+            logger=task_logger,
+        )
+    return tasks_to_do
+
+
+def get_queued_tasks(
+    queue_logger: Logger, max_age: float = None
+) -> Tuple[Dict[str, str], bool]:
+    """Gets the jobs in the scheduler queue of each HPC
+    :param max_age: Seconds the last scheduler query can be reused for, when less than the queue ttl of the scheduler
+    :return: A dictionary of job id: state, and if the queues of all HPCs could be checked
+    """
+    queued_tasks, complete_data = {}, True
+    for hpc in HPC:
+        try:
+            squeued_tasks = Scheduler.get_scheduler().check_queues(
+                user=False, target_machine=hpc, max_age=max_age
+            )
+        except EnvironmentError as e:
+            queue_logger.critical(e)
+            queue_logger.critical(
+                f"An error was encountered when attempting to check {Scheduler.get_scheduler().QUEUE_NAME} for HPC {hpc}. "
+                "Tasks will not be submitted to this HPC until the issue is resolved"
+            )
+            complete_data = False
+        else:
+            for task in squeued_tasks:
+                queued_tasks[task.split()[0]] = task.split()[1]
+    return queued_tasks, complete_data
+
+
+def check_queue_updates(
+    queue_entries: List[Tuple[str, SchedulerTask]],
+    queued_tasks: Dict[str, str],
+    recheck: bool,
+    queue_logger: Logger,
+) -> Tuple[List[SchedulerTask], List[str], bool, Dict[str, str]]:
+    """Gets the updates in the mgmt db queue that can be applied to the mgmt db.
+    Finished (completed, failed, etc) updates of jobs still in the scheduler queue are skipped
+    until the jobs have left it.
+    :param queued_tasks: The last scheduler queue, a dictionary of job id: state
+    :param recheck: If queued_tasks can be out of date, so the scheduler is re-checked for the
+    finished updates. Jobs submitted after queued_tasks was checked aren't in it
+    :return: The updates and their keys, if any updates are waiting for their jobs to leave the
+    scheduler queue, and the scheduler queue the updates were checked against
+    """
+    entries = []
+    entry_keys = []
+    waiting_for_exit = False
+    defer_finished = False
+
+    if recheck and any(
+        entry is not None and entry.status > 3 for _, entry in queue_entries
+    ):
+        # Jobs have reported finishing since the last scheduler check, so the dependants of
+        # those that have left the queue can be submitted without waiting for the next check
+        queue_logger.debug(
+            f"Re-checking {Scheduler.get_scheduler().QUEUE_NAME} for jobs that have finished"
+        )
+        rechecked_tasks, rechecked_complete = get_queued_tasks(
+            queue_logger, max_age=RECHECK_INTERVAL
+        )
+        if rechecked_complete:
+            queued_tasks = rechecked_tasks
+        else:
+            # Jobs submitted since the last check could still be queued,
+            # so finished updates wait for the next scheduler check
+            defer_finished = True
+
+    for key, entry in queue_entries:
+        queue_logger.debug("Checking {} to see if it is a valid update".format(key))
+        if entry is None:
+            queue_logger.debug("Removing {} from the list of updates".format(key))
+        elif entry.status > 3 and defer_finished:
+            queue_logger.debug(
+                "Could not re-check the scheduler for job {}, skipping this iteration".format(
+                    entry
                 )
-            # When job failed, we want to log metadata as well
-            (
-                start_time,
-                end_time,
-                run_time,
-                n_cores,
-                status,
-            ) = Scheduler.get_scheduler().get_metadata(db_running_task, task_logger)
-            log_file = os.path.join(
-                sim_struct.get_sim_dir(root_folder, db_running_task.run_name),
-                "ch_log",
-                "metadata_log.json",
             )
-            # now log metadata
-            store_metadata(
-                log_file,
-                const.ProcessType(db_running_task.proc_type).str_value,
-                {
-                    "start_time": start_time,
-                    "end_time": end_time,
-                    "run_time": run_time,
-                    "cores": n_cores,
-                    "status": status,
-                },
-                logger=task_logger,
+        elif str(entry.job_id) in queued_tasks.keys() and entry.status > 3:
+            # This will prevent race conditions if the failure/completion state file is made and picked up before the job actually finishes
+            # Most notabley happens on Kisti
+            # The queued and running states are allowed
+            queue_logger.debug(
+                "Job {} is still running on the HPC, skipping this iteration".format(
+                    entry
+                )
             )
-    return tasks_to_do
+            waiting_for_exit = True
+        else:
+            queue_logger.debug("Adding {} to the list of updates".format(entry))
+            entries.append(entry)
+            entry_keys.append(key)
+    return entries, entry_keys, waiting_for_exit, queued_tasks
 
 
 def queue_monitor_loop(
@@ -220,119 +304,115 @@ def queue_monitor_loop(
     max_retries: int,
     queue_logger: Logger = qclogging.get_basic_logger(),
     alert_url=None,
+    watch_queue: bool = False,
+    submit_event: Event = None,
 ):
+    """Applies the updates in the mgmt db queue to the mgmt db, and checks the scheduler for tasks
+    that have disappeared from it.
+    :param watch_queue: Wake as soon as updates are added to the queue, rather than every sleep_time
+    seconds. The scheduler is still only checked every sleep_time seconds, the updates in between are
+    checked against the last scheduler queue. Finished updates are re-checked against the scheduler,
+    at most every RECHECK_INTERVAL seconds
+    :param submit_event: Set after applying updates that can make tasks runnable, to wake auto_submit
+    """
     mgmt_db = MgmtDB(sim_struct.get_mgmt_db(root_folder))
-    queue_folder = sim_struct.get_mgmt_db_queue(root_folder)
-
-    queue_logger.info("Running queue-monitor, exit with Ctrl-C.")
+    queue = get_queue(sim_struct.get_mgmt_db_queue(root_folder))
+
+    watcher = None
+    if watch_queue:
+        watcher = QueueWatcher(queue, logger=queue_logger)
+    queue_logger.info(
+        f"Running queue-monitor with the {queue.backend} queue, "
+        f"{'watching' if watch_queue else 'polling'} for updates, exit with Ctrl-C."
+    )
 
+    mgmt_db.migrate(queue_logger)
     mgmt_db.add_retries(max_retries)
 
     sqlite_tmpdir = "/tmp/cer"
+    last_scheduler_check = None
     while keepAlive:
-        complete_data = True
-        if not os.path.exists(sqlite_tmpdir):
-            os.makedirs(sqlite_tmpdir)
-            queue_logger.debug("Set up the sqlite_tmpdir")
-
-        # For each hpc get a list of job id and status', and for each pair save them in a dictionary
-        queued_tasks = {}
-        for hpc in HPC:
-            try:
-                squeued_tasks = Scheduler.get_scheduler().check_queues(
-                    user=False, target_machine=hpc
-                )
-            except EnvironmentError as e:
-                queue_logger.critical(e)
-                queue_logger.critical(
-                    f"An error was encountered when attempting to check {Scheduler.get_scheduler().QUEUE_NAME} for HPC {hpc}. "
-                    "Tasks will not be submitted to this HPC until the issue is resolved"
-                )
-                complete_data = False
-            else:
-                for task in squeued_tasks:
-                    queued_tasks[task.split()[0]] = task.split()[1]
-
-        if len(queued_tasks) > 0:
-            if len(queued_tasks) > 200:
-                queue_logger.log(
-                    VERYVERBOSE,
-                    f"{Scheduler.get_scheduler().QUEUE_NAME} tasks: {', '.join([' '.join(task) for task in queued_tasks.items()])}",
-                )
-                queue_logger.info(
-                    f"Over 200 tasks were found in the queue. Check the log for an exact listing of them"
+        check_scheduler = (
+            watcher is None
+            or last_scheduler_check is None
+            or time.monotonic() - last_scheduler_check >= sleep_time
+        )
+        if check_scheduler:
+            last_scheduler_check = time.monotonic()
+            if not os.path.exists(sqlite_tmpdir):
+                os.makedirs(sqlite_tmpdir)
+                queue_logger.debug("Set up the sqlite_tmpdir")
+
+            # For each hpc get a list of job id and status', and for each pair save them in a dictionary
+            queued_tasks, complete_data = get_queued_tasks(queue_logger)
+            for hpc, metrics in Scheduler.get_scheduler().get_queue_metrics().items():
+                queue_logger.debug(
+                    f"{Scheduler.get_scheduler().QUEUE_NAME} metrics for {hpc}: {metrics}"
                 )
+
+            if len(queued_tasks) > 0:
+                if len(queued_tasks) > 200:
+                    queue_logger.log(
+                        VERYVERBOSE,
+                        f"{Scheduler.get_scheduler().QUEUE_NAME} tasks: {', '.join([' '.join(task) for task in queued_tasks.items()])}",
+                    )
+                    queue_logger.info(
+                        f"Over 200 tasks were found in the queue. Check the log for an exact listing of them"
+                    )
+                else:
+                    queue_logger.info(
+                        f"{Scheduler.get_scheduler().QUEUE_NAME} tasks: {', '.join([' '.join(task) for task in queued_tasks.items()])}"
+                    )
             else:
+                queue_logger.debug(f"No {Scheduler.get_scheduler().QUEUE_NAME} tasks")
+
+            db_in_progress_tasks = mgmt_db.get_submitted_tasks()
+            if len(db_in_progress_tasks) > 0:
+
                 queue_logger.info(
-                    f"{Scheduler.get_scheduler().QUEUE_NAME} tasks: {', '.join([' '.join(task) for task in queued_tasks.items()])}"
+                    "In progress tasks in mgmt db:"
+                    + ", ".join(
+                        [
+                            "{}-{}-{}-{}".format(
+                                entry.run_name,
+                                const.ProcessType(entry.proc_type).str_value,
+                                entry.job_id,
+                                const.Status(entry.status).str_value,
+                            )
+                            for entry in db_in_progress_tasks
+                        ]
+                    )
                 )
         else:
-            queue_logger.debug(f"No {Scheduler.get_scheduler().QUEUE_NAME} tasks")
-
-        db_in_progress_tasks = mgmt_db.get_submitted_tasks()
-        if len(db_in_progress_tasks) > 0:
-
-            queue_logger.info(
-                "In progress tasks in mgmt db:"
-                + ", ".join(
-                    [
-                        "{}-{}-{}-{}".format(
-                            entry.run_name,
-                            const.ProcessType(entry.proc_type).str_value,
-                            entry.job_id,
-                            const.Status(entry.status).str_value,
-                        )
-                        for entry in db_in_progress_tasks
-                    ]
-                )
+            queue_logger.debug(
+                f"Woken by new updates, using the last {Scheduler.get_scheduler().QUEUE_NAME} check"
             )
 
-        entry_files = os.listdir(queue_folder)
-        entry_files.sort()
-
-        entries = []
+        entries, entry_keys, waiting_for_exit, queued_tasks = check_queue_updates(
+            queue.read(queue_logger), queued_tasks, not check_scheduler, queue_logger
+        )
 
-        for file_name in entry_files[::-1]:
-            queue_logger.debug(
-                "Checking {} to see if it is a valid update file".format(file_name)
-            )
-            entry = get_queue_entry(os.path.join(queue_folder, file_name), queue_logger)
-            if entry is None:
-                queue_logger.debug(
-                    "Removing {} from the list of update files".format(file_name)
+        # Only look for tasks missing from the scheduler with an up to date scheduler queue
+        if check_scheduler:
+            entries.extend(
+                update_tasks(
+                    get_pending_updates(entry_keys),
+                    queued_tasks,
+                    db_in_progress_tasks,
+                    complete_data,
+                    queue_logger,
+                    root_folder,
                 )
-                entry_files.remove(file_name)
-            else:
-                if str(entry.job_id) in queued_tasks.keys() and entry.status > 3:
-                    # This will prevent race conditions if the failure/completion state file is made and picked up before the job actually finishes
-                    # Most notabley happens on Kisti
-                    # The queued and running states are allowed
-                    queue_logger.debug(
-                        "Job {} is still running on the HPC, skipping this iteration".format(
-                            entry
-                        )
-                    )
-                    entry_files.remove(file_name)
-                else:
-                    queue_logger.debug("Adding {} to the list of updates".format(entry))
-                    entries.insert(0, entry)
-
-        entries.extend(
-            update_tasks(
-                entry_files,
-                queued_tasks,
-                db_in_progress_tasks,
-                complete_data,
-                queue_logger,
-                root_folder,
             )
-        )
 
         if len(entries) > 0:
             queue_logger.info("Updating {} mgmt db tasks.".format(len(entries)))
             if mgmt_db.update_entries_live(entries, max_retries, queue_logger):
-                for file_name in entry_files:
-                    os.remove(os.path.join(queue_folder, file_name))
+                queue.remove(entry_keys)
+                if submit_event is not None and any(
+                    entry.status in SUBMIT_WAKE_STATUSES for entry in entries
+                ):
+                    submit_event.set()
                 # check for jobs that matches alert criteria
                 if alert_url != None:
                     for entry in entries:
@@ -355,8 +435,18 @@ def queue_monitor_loop(
             queue_logger.info("No entries in the mgmt db queue.")
 
         # Nap time
-        queue_logger.debug("Sleeping for {}".format(sleep_time))
-        time.sleep(sleep_time)
+        if watcher is None:
+            queue_logger.debug("Sleeping for {}".format(sleep_time))
+            time.sleep(sleep_time)
+        else:
+            timeout = max(0, last_scheduler_check + sleep_time - time.monotonic())
+            if waiting_for_exit:
+                # Check again shortly for the finished jobs to leave the queue
+                timeout = min(timeout, RECHECK_INTERVAL)
+            queue_logger.debug("Waiting up to {} for updates".format(timeout))
+            watcher.wait(timeout)
+    if watcher is not None:
+        watcher.close()
 
 
 def initialisation():
@@ -391,6 +481,19 @@ def initialisation():
     parser.add_argument(
         "--alert_url", help="the url to slack alert channel", default=None
     )
+    parser.add_argument(
+        "--watch_queue",
+        action="store_true",
+        help="Apply updates as soon as they are added to the mgmt db queue, rather than every sleep_time seconds. "
+        "The scheduler is still checked every sleep_time seconds",
+    )
+    parser.add_argument(
+        "--queue_ttl",
+        help="The number of seconds a check of the scheduler queue is reused for, "
+        "by the queue monitor and auto_submit threads, before the scheduler is queried again",
+        default=QUEUE_TTL,
+        type=float,
+    )
     args = parser.parse_args()
 
     root_folder = os.path.abspath(args.root_folder)
@@ -411,7 +514,9 @@ def initialisation():
     qclogging.add_general_file_handler(logger, log_file_name)
     logger.debug("Successfully added {} as the log file.".format(log_file_name))
 
-    Scheduler.initialise_scheduler(user=args.user, logger=logger)
+    Scheduler.initialise_scheduler(
+        user=args.user, queue_ttl=args.queue_ttl, logger=logger
+    )
 
     queue_monitor_loop(
         root_folder,
@@ -419,6 +524,7 @@ def initialisation():
         args.n_max_retries,
         logger,
         alert_url=args.alert_url,
+        watch_queue=args.watch_queue,
     )
 
 
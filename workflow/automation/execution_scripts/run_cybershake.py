@@ -11,7 +11,9 @@ from qcore.utils import load_yaml
 
 import queue_monitor
 from auto_submit import run_main_submit_loop
+from workflow.automation.lib.schedulers.abstractscheduler import QUEUE_TTL
 from workflow.automation.lib.schedulers.scheduler_factory import Scheduler
+from workflow.automation.lib.task_prioritisation import PRIORITY_POLICIES
 from workflow.automation.platform_config import platform_config, HPC
 
 MASTER_LOG_NAME = "master_log_{}.txt"
@@ -39,6 +41,9 @@ def run_automated_workflow(
     debug: bool,
     alert_url=None,
     run_queue_monitor=True,
+    watch_queue=False,
+    array_jobs=False,
+    priority="fifo",
 ):
     """Runs the automated workflow. Beings the queue monitor script and the script for tasks that apply to all
     realisations. Then while the all realisation thread is running go through each pattern and run all tasks that are
@@ -56,6 +61,10 @@ def run_automated_workflow(
     :param tasks_to_run_with_pattern: A list of (pattern, task_list) pairs to be run. task_list must have dependencies
     already added.
     :param wrapper_logger: The logger to use for wrapper messages
+    :param watch_queue: Apply mgmt db updates as soon as they are added to the queue, and wake the main auto_submit
+    thread when they make tasks runnable, rather than waiting for the next sleep_time cycle
+    :param array_jobs: Submit tasks with the same process type and resources as array jobs
+    :param priority: The policy used by each instance of auto_submit to order the runnable tasks
     """
 
     bulk_logger = qclogging.get_logger(name="auto_submit_main", threaded=True)
@@ -110,6 +119,9 @@ def run_automated_workflow(
             )
         )
 
+    # Set by the queue monitor when updates have made tasks runnable
+    submit_event = threading.Event() if watch_queue and run_queue_monitor else None
+
     queue_monitor_thread = None
     if run_queue_monitor:
         queue_monitor_thread = threading.Thread(
@@ -117,6 +129,7 @@ def run_automated_workflow(
             daemon=True,
             target=queue_monitor.queue_monitor_loop,
             args=(root_folder, sleep_time, n_max_retries, queue_logger, alert_url),
+            kwargs={"watch_queue": watch_queue, "submit_event": submit_event},
         )
         wrapper_logger.info("Created queue_monitor thread")
 
@@ -128,6 +141,9 @@ def run_automated_workflow(
         kwargs={
             "main_logger": bulk_logger,
             "cycle_timeout": 2 * len(tasks_to_run_with_pattern_and_logger) + 2,
+            "wake_event": submit_event,
+            "array_jobs": array_jobs,
+            "priority": priority,
         },
     )
     wrapper_logger.info("Created main auto_submit thread")
@@ -167,6 +183,8 @@ def run_automated_workflow(
                 sleep_time,
                 main_logger=pattern_logger,
                 cycle_timeout=0,
+                array_jobs=array_jobs,
+                priority=priority,
             )
     bulk_auto_submit_thread.join()
     wrapper_logger.info(
@@ -277,6 +295,34 @@ def main():
         action="store_false",
         dest="run_queue_monitor",
     )
+    parser.add_argument(
+        "--watch_queue",
+        action="store_true",
+        help="Apply mgmt db updates as soon as they are added to the queue and submit the tasks they make runnable, "
+        "rather than waiting for the next cycle. The scheduler is still only checked every sleep_time seconds",
+    )
+    parser.add_argument(
+        "--array_jobs",
+        action="store_true",
+        help="Submit tasks with the same process type and resources as array jobs, rather than one job per task. "
+        "Only supported by Slurm",
+    )
+    parser.add_argument(
+        "--priority",
+        choices=list(PRIORITY_POLICIES),
+        default="fifo",
+        help="How runnable tasks are ordered before filling the free slots of each machine. "
+        "fifo: the order tasks were created in, sjf: fewest estimated core hours first, "
+        "critical_path: longest estimated run time to the end of the realisation first, "
+        "fair_share: tasks of each fault in turn",
+    )
+    parser.add_argument(
+        "--queue_ttl",
+        help="The number of seconds a check of the scheduler queue is reused for, "
+        "by the queue monitor and auto_submit threads, before the scheduler is queried again",
+        default=QUEUE_TTL,
+        type=float,
+    )
     args = parser.parse_args()
 
     wrapper_logger = qclogging.get_logger(name="cybershake_wrapper", threaded=True)
@@ -307,7 +353,9 @@ def main():
 
     scheduler_logger = qclogging.get_logger(name="scheduler", threaded=True)
     qclogging.add_general_file_handler(scheduler_logger, scheduler_log_file)
-    Scheduler.initialise_scheduler(user=args.user, logger=scheduler_logger)
+    Scheduler.initialise_scheduler(
+        user=args.user, queue_ttl=args.queue_ttl, logger=scheduler_logger
+    )
 
     n_runs = 0
     if args.n_runs is not None:
@@ -357,6 +405,9 @@ def main():
         args.debug,
         alert_url=args.alert_url,
         run_queue_monitor=args.run_queue_monitor,
+        watch_queue=args.watch_queue,
+        array_jobs=args.array_jobs,
+        priority=args.priority,
     )
 
 
@@ -6,16 +6,25 @@ each stage of the run
 """
 import argparse
 import os
+from logging import Logger
+
+from qcore.qclogging import get_basic_logger
 
 from workflow.automation.lib.MgmtDB import MgmtDB
 
 
-def create_mgmt_db(realisations, db_file, srf_files=[]):
+def create_mgmt_db(
+    realisations, db_file, srf_files=[], logger: Logger = get_basic_logger()
+):
     mgmt_db = MgmtDB.init_db(
         db_file,
         os.path.join(os.path.dirname(os.path.realpath(__file__)), "slurm_mgmt.db.sql"),
     )
-    mgmt_db.populate(realisations, srf_files)
+    inserted, skipped = mgmt_db.populate(realisations, srf_files)
+    if inserted + skipped > 0:
+        logger.info(
+            f"Inserted {inserted} tasks into the mgmt db, skipped {skipped} already present"
+        )
 
     return mgmt_db
 
@@ -12,6 +12,7 @@ from qcore.constants import (
 from qcore import qclogging
 
 from install_cybershake_fault import install_fault
+from workflow.automation.lib.mgmt_db_queue import BACKENDS, BACKEND_DIRECTORY
 from workflow.automation.platform_config import platform_config
 
 AUTO_SUBMIT_LOG_FILE_NAME = "install_cybershake_log_{}.txt"
@@ -84,6 +85,13 @@ def load_args(logger):
         help="Set this flag if you know you have a validated VM and skip memory-hungry step",
         default=False,
     )
+    parser.add_argument(
+        "--queue_backend",
+        choices=BACKENDS,
+        default=BACKEND_DIRECTORY,
+        help="How jobs pass their status updates to the queue monitor. "
+        "sqlite keeps them in a single db file rather than a file per update",
+    )
     vm_pert = parser.add_mutually_exclusive_group()
     vm_pert.add_argument(
         "--vm_perturbations",
@@ -193,6 +201,7 @@ def main():
             logger=qclogging.get_realisation_logger(logger, fault),
             check_vm=args.check_vm,
             skip_validate_vm=args.skip_validate_vm,
+            queue_backend=args.queue_backend,
         )
 
 
@@ -41,6 +41,7 @@ from install_shared import (
 
 # from shared_workflow.shared_template import generate_command
 from workflow.automation.platform_config import platform_config, HPC
+from workflow.automation.lib.mgmt_db_queue import BACKEND_DIRECTORY, create_queue
 
 
 def main():
@@ -117,6 +118,7 @@ def install_fault(
     logger: Logger = get_basic_logger(),
     check_vm=True,
     skip_validate_vm=False,
+    queue_backend=BACKEND_DIRECTORY,
 ):
 
     config_dict = utils.load_yaml(
@@ -171,7 +173,7 @@ def install_fault(
                 message = " ".join([params_message, vm_file_message])
                 message = f"Error: VM {fault_name} failed {message}"
                 logger.log(NOPRINTCRITICAL, message)
-                #raise RuntimeError(message)
+                # raise RuntimeError(message)
         # Load the variables from vm_params.yaml
         vm_params_dict = utils.load_yaml(vm_params_path)
 
@@ -249,9 +251,12 @@ def install_fault(
             return
 
         create_mgmt_db.create_mgmt_db(
-            [], simulation_structure.get_mgmt_db(root_folder), srf_files=srf
+            [],
+            simulation_structure.get_mgmt_db(root_folder),
+            srf_files=srf,
+            logger=logger,
         )
-        utils.setup_dir(os.path.join(root_folder, "mgmt_db_queue"))
+        create_queue(os.path.join(root_folder, "mgmt_db_queue"), queue_backend)
         root_params_dict["mgmt_db_location"] = root_folder
 
         if check_vm:
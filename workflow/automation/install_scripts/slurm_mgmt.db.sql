@@ -26,6 +26,8 @@ CREATE TABLE IF NOT EXISTS `error` (
 );
 CREATE INDEX IF NOT EXISTS `state_search` ON state (status);
 CREATE INDEX IF NOT EXISTS `status` ON state (run_name, job_id, status, proc_type);
+CREATE INDEX IF NOT EXISTS `task_search` ON state (run_name, proc_type, status, job_id);
+CREATE INDEX IF NOT EXISTS `error_task` ON error (task_id);
 
 CREATE TABLE IF NOT EXISTS "proc_type_enum" (
 	`id`	INTEGER NOT NULL UNIQUE,
@@ -80,6 +82,7 @@ CREATE TABLE IF NOT EXISTS `job_duration_log`(
 	PRIMARY KEY(`id`),
 	FOREIGN KEY(`job_id`) REFERENCES state(job_id)
 );
+CREATE INDEX IF NOT EXISTS `job_duration_job` ON job_duration_log (job_id);
 CREATE VIEW IF NOT EXISTS state_view AS
 SELECT state.id, state.run_name, proc_type_enum.proc_type, status_enum.state, state.job_id, state.last_modified
 FROM state, status_enum, proc_type_enum
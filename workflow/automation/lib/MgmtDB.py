@@ -4,7 +4,8 @@ from contextlib import contextmanager
 from logging import Logger
 import os
 import sqlite3 as sql
-from typing import List, Union
+import threading
+from typing import Dict, Iterable, List, Set, Tuple, Union
 from dataclasses import dataclass
 
 import qcore.constants as const
@@ -30,36 +31,180 @@ class SchedulerTask:
     wct: int = None
 
 
+@dataclass
+class CoreHourState:
+    """A completed or killed_WCT task with its job_duration_log entry.
+    The job fields are None if the job has no entry"""
+
+    run_name: str
+    proc_type: int
+    status: int
+    job_id: int
+    queued_time: int = None
+    start_time: int = None
+    end_time: int = None
+    nodes: int = None
+    cores: int = None
+    memory: int = None
+    wct: int = None
+
+    @property
+    def core_hours(self):
+        """The core hours used by the job, None if they aren't known"""
+        if None in (self.start_time, self.end_time, self.cores):
+            return None
+        return self.cores * (self.end_time - self.start_time) / 3600
+
+
+# WAL lets the readers (auto_submit, query_mgmt_db) run alongside the queue_monitor writer.
+# All processes using a db have to be on the same host, as WAL relies on shared memory.
+JOURNAL_MODE = "WAL"
+# In WAL mode NORMAL can't corrupt the db, at worst the last commits are lost on power failure
+SYNCHRONOUS = "NORMAL"
+# Seconds to wait for another connection's write lock before raising
+BUSY_TIMEOUT = 60
+
+_thread_connections = threading.local()
+
+# Expressions for whether a state row counts as an attempt (as counted by get_retries),
+# a failure, or a task that hasn't failed (used by add_retries)
+_ATTEMPT = f"IFNULL({{row}}.status != {const.Status.killed_WCT.value}, 0)"
+_FAILURE = f"IFNULL({{row}}.status IN ({const.Status.killed_WCT.value}, {const.Status.failed.value}), 0)"
+_NOT_FAILED = f"IFNULL({{row}}.status <= {const.Status.completed.value}, 0)"
+
+
+def _count_task_attempts(row: str, sign: str):
+    """Statements adding (sign +) or removing (sign -) a state row from the task_attempts counts"""
+    return f"""INSERT OR IGNORE INTO task_attempts(run_name, proc_type) VALUES ({row}.run_name, {row}.proc_type);
+        UPDATE task_attempts SET
+            attempts = attempts {sign} {_ATTEMPT.format(row=row)},
+            failures = failures {sign} {_FAILURE.format(row=row)},
+            not_failed = not_failed {sign} {_NOT_FAILED.format(row=row)}
+        WHERE run_name = {row}.run_name AND proc_type = {row}.proc_type;"""
+
+
+# Schema changes for existing dbs, MIGRATIONS[i] upgrades a db from version i to i + 1.
+# The version of a db is kept in PRAGMA user_version, dbs from before versioning are 0.
+# Statements must also be safe to run on new dbs created from slurm_mgmt.db.sql
+MIGRATIONS = [
+    # Indexes for the per task lookups on the state, error and job_duration_log tables
+    [
+        "CREATE INDEX IF NOT EXISTS `task_search` ON state (run_name, proc_type, status, job_id)",
+        "CREATE INDEX IF NOT EXISTS `error_task` ON error (task_id)",
+        "CREATE INDEX IF NOT EXISTS `job_duration_job` ON job_duration_log (job_id)",
+    ],
+    # Per task attempt and failure counts, kept up to date by triggers on the state table
+    [
+        """CREATE TABLE IF NOT EXISTS `task_attempts` (
+        `run_name` TEXT NOT NULL,
+        `proc_type` INTEGER NOT NULL,
+        `attempts` INTEGER NOT NULL DEFAULT 0,
+        `failures` INTEGER NOT NULL DEFAULT 0,
+        `not_failed` INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (run_name, proc_type)) WITHOUT ROWID""",
+        # Tasks that can be retried by add_retries
+        "CREATE INDEX IF NOT EXISTS `task_attempts_retry` ON task_attempts (failures) WHERE not_failed = 0",
+        f"""INSERT OR REPLACE INTO task_attempts(run_name, proc_type, attempts, failures, not_failed)
+        SELECT run_name, proc_type, SUM({_ATTEMPT.format(row="state")}),
+        SUM({_FAILURE.format(row="state")}), SUM({_NOT_FAILED.format(row="state")})
+        FROM state GROUP BY run_name, proc_type""",
+        f"""CREATE TRIGGER IF NOT EXISTS `task_attempts_insert` AFTER INSERT ON state
+        BEGIN {_count_task_attempts("NEW", "+")} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS `task_attempts_update`
+        AFTER UPDATE OF run_name, proc_type, status ON state
+        BEGIN {_count_task_attempts("OLD", "-")} {_count_task_attempts("NEW", "+")} END""",
+        f"""CREATE TRIGGER IF NOT EXISTS `task_attempts_delete` AFTER DELETE ON state
+        BEGIN {_count_task_attempts("OLD", "-")} END""",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+@dataclass
+class _PooledConnection:
+    conn: sql.Connection
+    file_id: tuple
+    # number of connect_db_ctx contexts currently using the connection
+    depth: int = 0
+
+
+def _file_id(db_file):
+    try:
+        stat = os.stat(db_file)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def _open_connection(db_file):
+    conn = sql.connect(db_file, timeout=BUSY_TIMEOUT)
+    conn.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    return conn
+
+
+def _get_pooled(db_file):
+    if not hasattr(_thread_connections, "pool"):
+        _thread_connections.pool = {}
+    key = os.path.abspath(db_file)
+    pooled = _thread_connections.pool.get(key)
+    # Reopen if the db file was deleted or replaced since the connection was made
+    if pooled is not None and pooled.depth == 0:
+        if _file_id(key) != pooled.file_id:
+            pooled.conn.close()
+            pooled = None
+    if pooled is None:
+        conn = _open_connection(key)
+        pooled = _PooledConnection(conn, _file_id(key))
+        _thread_connections.pool[key] = pooled
+    return pooled
+
+
+def get_connection(db_file):
+    """Returns the calling thread's connection to db_file, opening it on first use"""
+    return _get_pooled(db_file).conn
+
+
+def close_connections():
+    """Closes all connections of the calling thread"""
+    for pooled in getattr(_thread_connections, "pool", {}).values():
+        pooled.conn.close()
+    _thread_connections.pool = {}
+
+
 def connect_db(path):
     db_location = os.path.abspath(os.path.join(path, "slurm_mgmt.db"))
-    conn = sql.connect(db_location)
-    db = conn.cursor()
-    db.execute("PRAGMA synchronous = EXTRA")
-    # db.execute("PRAGMA synchronous = OFF")
-    db.execute("PRAGMA integrity_check")
-
-    return db
+    return get_connection(db_location).cursor()
 
 
 @contextmanager
 def connect_db_ctx(db_file, verbose=False):
     """Returns a db cursor. Use with a context (i.e. with statement)
 
-    A commit is run at the end of the context.
+    The connection is reused across contexts of the same thread.
+    A commit is run at the end of the outermost context.
     """
-    conn = sql.connect(db_file)
+    pooled = _get_pooled(db_file)
+    conn = pooled.conn
+    pooled.depth += 1
     if verbose:
         conn.set_trace_callback(print)
 
+    cur = conn.cursor()
     try:
-        yield conn.cursor()
+        yield cur
     except Exception:
-        conn.rollback()
+        if pooled.depth == 1:
+            conn.rollback()
         raise
     else:
-        conn.commit()
+        if pooled.depth == 1:
+            conn.commit()
     finally:
-        conn.close()
+        cur.close()
+        if verbose:
+            conn.set_trace_callback(None)
+        pooled.depth -= 1
 
 
 def enum_to_list(enum):
@@ -94,11 +239,16 @@ class MgmtDB:
 
     def get_retries(self, process, realisation_name):
         with connect_db_ctx(self._db_file) as cur:
-            return cur.execute(
-                "SELECT COUNT(*) from state "
-                "WHERE run_name = ? AND proc_type = ? and status != ?",
-                (realisation_name, process, const.Status.killed_WCT.value),
-            ).fetchone()[0]
+            return self._get_retries(cur, process, realisation_name)
+
+    @staticmethod
+    def _get_retries(cur: sql.Cursor, process, realisation_name):
+        """The number of attempts at the task that weren't killed by the WCT"""
+        attempts = cur.execute(
+            "SELECT attempts from task_attempts WHERE run_name = ? AND proc_type = ?",
+            (realisation_name, process),
+        ).fetchone()
+        return 0 if attempts is None else attempts[0]
 
     def update_entries_live(
         self,
@@ -112,7 +262,7 @@ class MgmtDB:
         try:
             if self._conn is None:
                 logger.info("Acquiring db connection.")
-                self._conn = sql.connect(self._db_file)
+                self._conn = _open_connection(self._db_file)
             logger.debug("Getting db cursor")
 
             cur = self._conn.cursor()
@@ -185,7 +335,7 @@ class MgmtDB:
                     entry.status == const.Status.failed.value
                     or entry.status == const.Status.killed_WCT.value
                 ):
-                    if self.get_retries(process, realisation_name) < retry_max:
+                    if self._get_retries(cur, process, realisation_name) < retry_max:
                         # The task was failed. If there have been few enough other attempts at the task make another one
                         logger.debug(
                             "Task failed but is able to be retried. Adding new task to the db"
@@ -195,16 +345,25 @@ class MgmtDB:
 
                 if entry.status == const.Status.failed.value:
                     tasks = MgmtDB.find_dependant_task(cur, entry)
-                    i = 0
-                    while i < len(tasks):
-                        task = tasks[i]
-                        # fails dependant task
-                        self._update_entry(cur, task, logger=logger)
+                    for task in tasks:
                         logger.debug(
                             f"Cascading failure for {entry.run_name} - {task.proc_type}"
                         )
-                        tasks.extend(MgmtDB.find_dependant_task(cur, task))
-                        i += 1
+                    # fails dependant tasks
+                    cur.executemany(
+                        "UPDATE state SET status = ?, last_modified = strftime('%s','now') "
+                        "WHERE run_name = ? AND proc_type = ? AND status < ? AND job_id IS ?",
+                        [
+                            (
+                                task.status,
+                                task.run_name,
+                                task.proc_type,
+                                task.status,
+                                task.job_id,
+                            )
+                            for task in tasks
+                        ],
+                    )
 
         except sql.Error as ex:
             self._conn.rollback()
@@ -278,6 +437,83 @@ class MgmtDB:
                 ).fetchall()
         return states
 
+    def get_core_hour_states_bulk(
+        self, ch_count_type: ChCountType, allowed_rels: str = "%"
+    ) -> List[CoreHourState]:
+        """Bulk version of get_core_hour_states, for all realisations matching allowed_rels in one query.
+        The states are joined with their job_duration_log entries and ordered by realisation.
+        As with get_core_hour_states, ChCountType.Needed only gives tasks modified after the last
+        failure of the same realisation and process type"""
+        only_needed = ch_count_type == ChCountType.Needed
+        with connect_db_ctx(self._db_file) as cur:
+            rows = cur.execute(
+                """SELECT state.run_name, state.proc_type, state.status, state.job_id,
+                job_duration_log.queued_time, job_duration_log.start_time, job_duration_log.end_time,
+                job_duration_log.nodes, job_duration_log.cores, job_duration_log.memory, job_duration_log.WCT
+                FROM state
+                LEFT JOIN job_duration_log ON job_duration_log.job_id = state.job_id
+                LEFT JOIN (
+                    SELECT run_name, proc_type, MAX(last_modified) AS failed_time FROM state
+                    WHERE status = ? AND run_name LIKE ?
+                    GROUP BY run_name, proc_type
+                ) AS last_failure
+                ON last_failure.run_name = state.run_name AND last_failure.proc_type = state.proc_type
+                WHERE state.status IN (?, ?) AND state.run_name LIKE ?
+                AND (NOT ? OR last_failure.failed_time IS NULL OR state.last_modified > last_failure.failed_time)
+                ORDER BY state.run_name, state.id""",
+                (
+                    const.Status.failed.value,
+                    allowed_rels,
+                    const.Status.completed.value,
+                    const.Status.killed_WCT.value,
+                    allowed_rels,
+                    only_needed,
+                ),
+            ).fetchall()
+        return [CoreHourState(*row) for row in rows]
+
+    def get_mean_job_usage(
+        self, allowed_rels: str = "%"
+    ) -> Dict[int, Tuple[float, float]]:
+        """Gets the mean run time and core hours of the completed jobs of each process type,
+        for the realisations matching allowed_rels. Jobs with an incomplete job_duration_log entry are ignored
+        :return: A dictionary of proc_type: (run time in hours, core hours)"""
+        with connect_db_ctx(self._db_file) as cur:
+            rows = cur.execute(
+                """SELECT state.proc_type,
+                AVG(job_duration_log.end_time - job_duration_log.start_time) / 3600.0,
+                AVG((job_duration_log.end_time - job_duration_log.start_time) * job_duration_log.cores) / 3600.0
+                FROM state
+                JOIN job_duration_log ON job_duration_log.job_id = state.job_id
+                WHERE state.status = ? AND state.run_name LIKE ?
+                AND job_duration_log.start_time IS NOT NULL
+                AND job_duration_log.end_time IS NOT NULL
+                AND job_duration_log.cores IS NOT NULL
+                GROUP BY state.proc_type""",
+                (const.Status.completed.value, allowed_rels),
+            ).fetchall()
+        return {
+            proc_type: (run_time, core_hours)
+            for proc_type, run_time, core_hours in rows
+        }
+
+    def get_in_progress_counts(self, allowed_rels: str = "%") -> Dict[str, int]:
+        """Gets the number of queued, running and unknown tasks of each realisation matching allowed_rels"""
+        with connect_db_ctx(self._db_file) as cur:
+            return dict(
+                cur.execute(
+                    """SELECT run_name, COUNT(*) FROM state
+                    WHERE status IN (?, ?, ?) AND run_name LIKE ?
+                    GROUP BY run_name""",
+                    (
+                        const.Status.queued.value,
+                        const.Status.running.value,
+                        const.Status.unknown.value,
+                        allowed_rels,
+                    ),
+                ).fetchall()
+            )
+
     def get_job_duration_info(self, job_id: int):
         with connect_db_ctx(self._db_file) as cur:
             return cur.execute(
@@ -290,27 +526,62 @@ class MgmtDB:
             return cur.execute("SELECT DISTINCT run_name from state").fetchall()
 
     @staticmethod
-    def find_dependant_task(cur, entry):
-        tasks = []
+    def _create_dependency_table(cur: sql.Cursor):
+        """Materialises ProcessType.dependencies into the temporary proc_dependency table,
+        for the connection of the given cursor"""
+        cur.execute(
+            """CREATE TEMP TABLE IF NOT EXISTS proc_dependency(
+            proc_type INTEGER NOT NULL,
+            dependency INTEGER NOT NULL,
+            PRIMARY KEY (dependency, proc_type))"""
+        )
+        dependencies = set()
         for process in const.ProcessType:
             for dependency in process.dependencies:
+                # Of alternative dependency sets only the first task is cascaded from
                 if isinstance(dependency, tuple):
                     dependency = dependency[0]
-                if entry.proc_type == dependency:
-                    job_id = cur.execute(
-                        "SELECT `job_id` FROM `state` WHERE proc_type = ? and status = ? and run_name = ?",
-                        (process.value, const.Status.completed.value, entry.run_name),
-                    ).fetchone()
-
-                    if job_id is not None:
-                        dependant_entry = SchedulerTask(
-                            entry.run_name,
-                            process.value,
-                            const.Status.failed.value,
-                            job_id[0],
-                        )
-                        tasks.append(dependant_entry)
-        return tasks
+                dependencies.add((process.value, dependency))
+        cur.executemany(
+            "INSERT OR IGNORE INTO proc_dependency(proc_type, dependency) VALUES(?, ?)",
+            dependencies,
+        )
+
+    @staticmethod
+    def find_dependant_task(cur: sql.Cursor, entry: SchedulerTask):
+        """Finds the completed tasks of the realisation that depend on the given task,
+        directly or through other completed tasks. Returns them with a failed status"""
+        MgmtDB._create_dependency_table(cur)
+        rows = cur.execute(
+            """WITH RECURSIVE dependant(proc_type) AS (
+                SELECT ?
+                UNION
+                SELECT proc_dependency.proc_type
+                FROM dependant
+                JOIN proc_dependency ON proc_dependency.dependency = dependant.proc_type
+                WHERE EXISTS (
+                    SELECT 1 FROM state
+                    WHERE run_name = ? AND proc_type = proc_dependency.proc_type AND status = ?
+                )
+            )
+            SELECT proc_type, job_id FROM state
+            WHERE run_name = ? AND status = ? AND proc_type IN (
+                SELECT proc_type FROM dependant WHERE proc_type != ?
+            )
+            ORDER BY id""",
+            (
+                entry.proc_type,
+                entry.run_name,
+                const.Status.completed.value,
+                entry.run_name,
+                const.Status.completed.value,
+                entry.proc_type,
+            ),
+        ).fetchall()
+        return [
+            SchedulerTask(entry.run_name, proc_type, const.Status.failed.value, job_id)
+            for proc_type, job_id in rows
+        ]
 
     def add_retries(self, n_max_retries: int):
         """Checks the database for failed tasks with less failures than the given n_max_retries.
@@ -318,39 +589,14 @@ class MgmtDB:
         If any are found then nothing happens, if none are found then another created entry is added to the db.
         n_max_retries: The maximum number of retries a task can have"""
         with connect_db_ctx(self._db_file) as cur:
-            errored = cur.execute(
-                "SELECT run_name, proc_type "
-                "FROM state, status_enum "
-                "WHERE state.status = status_enum.id "
-                "AND (status_enum.state  = 'failed' "
-                "OR status_enum.state = 'killed_WCT')"
+            # Only tasks without an entry that hasn't failed are read, through the task_attempts_retry index
+            retry_tasks = cur.execute(
+                "SELECT run_name, proc_type FROM task_attempts "
+                "WHERE not_failed = 0 AND failures > 0 AND failures < ?",
+                (n_max_retries,),
             ).fetchall()
-
-        failure_count = {}
-        for run_name, proc_type in errored:
-            key = "{}__{}".format(run_name, proc_type)
-            if key not in failure_count.keys():
-                failure_count.update({key: 0})
-            failure_count[key] += 1
-
-        with connect_db_ctx(self._db_file) as cur:
-            for key, fail_count in failure_count.items():
-                if fail_count >= n_max_retries:
-                    continue
-                run_name, proc_type = key.split("__")
-                # Gets the number of entries for the task with state in [created, queued, running or completed]
-                # Where completed has enum index 5, and the other 4 less than this
-                # If any are found then don't add another entry
-                not_failed_count = cur.execute(
-                    "SELECT COUNT(*) "
-                    "FROM state "
-                    "WHERE run_name = (?)"
-                    "AND proc_type = (?)"
-                    "AND status <= (SELECT id FROM status_enum WHERE state = 'completed') ",
-                    (run_name, proc_type),
-                ).fetchone()[0]
-                if not_failed_count == 0:
-                    self._insert_task(cur, run_name, proc_type)
+            for run_name, proc_type in retry_tasks:
+                self._insert_task(cur, run_name, proc_type)
 
     def close_conn(self):
         """Close the db connection. Note, this ONLY has to be done if
@@ -358,6 +604,7 @@ class MgmtDB:
         closed by default."""
         if self._conn is not None:
             self._conn.close()
+            self._conn = None
 
     def get_submitted_tasks(self, allowed_tasks=tuple(const.ProcessType)):
         """Gets all in progress tasks i.e. (running or queued)"""
@@ -370,67 +617,78 @@ class MgmtDB:
         self,
         allowed_rels,
         task_limit,
-        update_files,
+        pending_updates: Set[Tuple[str, int]],
         allowed_tasks=None,
         logger=get_basic_logger(),
     ):
         """Gets all runnable tasks based on their status and their associated
         dependencies (i.e. other tasks have to be finished first)
 
-        Returns a list of tuples (proc_type, run_name, state_str)
+        Uses a fixed number of queries regardless of the number of tasks, the dependency
+        check is done in python against the completed tasks of each realisation.
+        task_limit of None returns all runnable tasks.
+        Tasks in pending_updates, (run_name, proc_type) pairs as given by
+        mgmt_db_queue.get_pending_updates, are excluded.
+
+        Returns a list of tuples (proc_type, run_name, retries)
         """
         if allowed_tasks is None:
             allowed_tasks = list(const.ProcessType)
-        allowed_tasks = [str(task.value) for task in allowed_tasks]
+        allowed_tasks = [task.value for task in allowed_tasks]
 
         if len(allowed_tasks) == 0:
             return []
 
         runnable_tasks = []
-        offset = 0
-
-        # "{}__{}" is intended to be the template for a unique string for every realisation and process type pair
-        # Used to compare with database entries to prevent running a task that has already been submitted, but not
-        # recorded
-        tasks_waiting_for_updates = [
-            "{}__{}".format(*(entry.split(".")[1:3])) for entry in update_files
-        ]
-
+        n_candidates = 0
         with connect_db_ctx(self._db_file) as cur:
-            entries = cur.execute(
-                """SELECT COUNT(*) 
-                          FROM status_enum, state 
-                          WHERE state.status = status_enum.id
-                           AND proc_type IN (?{})
-                           AND run_name LIKE (?)
-                           AND status_enum.state = 'created'""".format(
-                    ",?" * (len(allowed_tasks) - 1)
+            completed = {}
+            for run_name, proc_type in cur.execute(
+                """SELECT DISTINCT run_name, proc_type
+                          FROM state
+                          WHERE status = ?
+                           AND run_name LIKE (?)""",
+                (const.Status.completed.value, allowed_rels),
+            ):
+                completed.setdefault(run_name, []).append(const.ProcessType(proc_type))
+
+            # Created tasks along with their number of attempts, as given by get_retries.
+            # Rows are streamed so that only as many as needed to reach task_limit are evaluated
+            candidates = cur.execute(
+                """SELECT created.proc_type, created.run_name, task_attempts.attempts
+                          FROM state AS created
+                          JOIN task_attempts
+                           ON task_attempts.run_name = created.run_name
+                           AND task_attempts.proc_type = created.proc_type
+                          WHERE created.status = ?
+                           AND created.proc_type IN ({})
+                           AND created.run_name LIKE (?)
+                          ORDER BY created.id""".format(
+                    ",".join("?" * len(allowed_tasks))
                 ),
-                (*allowed_tasks, allowed_rels),
-            ).fetchone()[0]
-
-            while len(runnable_tasks) < task_limit and offset < entries:
-                db_tasks = cur.execute(
-                    """SELECT proc_type, run_name 
-                              FROM status_enum, state 
-                              WHERE state.status = status_enum.id
-                               AND proc_type IN (?{})
-                               AND run_name LIKE (?)
-                                   AND status_enum.state = 'created'
-                                   LIMIT 100 OFFSET ?""".format(
-                        ",?" * (len(allowed_tasks) - 1)
-                    ),
-                    (*allowed_tasks, allowed_rels, offset),
-                ).fetchall()
-                runnable_tasks.extend(
-                    [
-                        (*task, self.get_retries(*task))
-                        for task in db_tasks
-                        if self._check_dependancy_met(task, logger)
-                        and "{}__{}".format(*task) not in tasks_waiting_for_updates
-                    ]
+                (
+                    const.Status.created.value,
+                    *allowed_tasks,
+                    allowed_rels,
+                ),
+            )
+            for proc_type, run_name, retries in candidates:
+                if task_limit is not None and len(runnable_tasks) >= task_limit:
+                    break
+                n_candidates += 1
+                # Prevents running a task that has already been submitted, but not recorded
+                if (run_name, proc_type) in pending_updates:
+                    continue
+                remaining_deps = Process(proc_type).get_remaining_dependencies(
+                    completed.get(run_name, [])
                 )
-                offset += 100
+                if len(remaining_deps) == 0:
+                    runnable_tasks.append((proc_type, run_name, retries))
+        logger.debug(
+            "{} of {} created tasks considered are runnable".format(
+                len(runnable_tasks), n_candidates
+            )
+        )
 
         return runnable_tasks
 
@@ -534,7 +792,10 @@ class MgmtDB:
             )
 
     def populate(self, realisations, srf_files: Union[List[str], str] = []):
-        """Initial population of the database with all realisations"""
+        """Initial population of the database with all realisations
+
+        Returns the number of tasks inserted, and the number skipped as the
+        realisation already had a non-failed task of that process type"""
         # for manual install, only one srf will be passed to srf_files as a string
         if isinstance(srf_files, str):
             srf_files = [srf_files]
@@ -545,16 +806,50 @@ class MgmtDB:
 
         if len(realisations) == 0:
             print("No realisations found - no entries inserted into db")
-        else:
-            with connect_db_ctx(self._db_file) as cur:
-                procs_to_be_done = cur.execute(
-                    """select * from proc_type_enum"""
-                ).fetchall()
+            return 0, 0
 
-                for run_name in realisations:
-                    for proc in procs_to_be_done:
-                        if not self._does_task_exists(cur, run_name, proc[0]):
-                            self._insert_task(cur, run_name, proc[0])
+        with connect_db_ctx(self._db_file) as cur:
+            procs_to_be_done = [
+                proc[0]
+                for proc in cur.execute("SELECT id FROM proc_type_enum ORDER BY id")
+            ]
+        return self.insert_tasks(
+            (run_name, proc) for run_name in realisations for proc in procs_to_be_done
+        )
+
+    def insert_tasks(self, tasks: Iterable[Tuple[str, int]]):
+        """Inserts a created task for each (run_name, proc_type) pair, in a single transaction.
+        Pairs that already have a non-failed task (see _does_task_exists) are skipped,
+        as are repeats within tasks.
+
+        Returns the number of tasks inserted and skipped"""
+        tasks = list(tasks)
+        with connect_db_ctx(self._db_file) as cur:
+            # The unique constraint keeps the first of any repeated pair
+            cur.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS `new_task` "
+                "(run_name TEXT NOT NULL, proc_type INTEGER NOT NULL, "
+                "UNIQUE(run_name, proc_type))"
+            )
+            cur.execute("DELETE FROM temp.new_task")
+            cur.executemany(
+                "INSERT OR IGNORE INTO temp.new_task(run_name, proc_type) VALUES(?, ?)",
+                tasks,
+            )
+            cur.execute(
+                """INSERT INTO `state`(run_name, proc_type, status, last_modified)
+                  SELECT run_name, proc_type, ?, strftime('%s','now')
+                  FROM temp.new_task AS new
+                  WHERE NOT EXISTS (SELECT 1 FROM state
+                    WHERE state.run_name = new.run_name
+                    AND state.proc_type = new.proc_type
+                    AND state.status != ?)
+                  ORDER BY new.rowid""",
+                (const.Status.created.value, const.Status.failed.value),
+            )
+            n_inserted = cur.rowcount
+            cur.execute("DROP TABLE temp.new_task")
+        return n_inserted, len(tasks) - n_inserted
 
     def insert(self, run_name: str, proc_type: int):
         """Inserts a task into the mgmt db"""
@@ -620,17 +915,59 @@ class MgmtDB:
             (end_time, job_id),
         )
 
+    def check_integrity(self):
+        """Runs a full integrity check of the db, this reads the whole file.
+        Returns the list of problems found, empty if there are none"""
+        with connect_db_ctx(self._db_file) as cur:
+            result = [row[0] for row in cur.execute("PRAGMA integrity_check")]
+        return [] if result == ["ok"] else result
+
+    def get_schema_version(self):
+        with connect_db_ctx(self._db_file) as cur:
+            return cur.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self, logger: Logger = get_basic_logger()):
+        """Applies any MIGRATIONS the db has not had yet, each in its own transaction.
+        Safe to call from several processes at once.
+        Returns the schema version of the db"""
+        with connect_db_ctx(self._db_file) as cur:
+            version = cur.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            logger.warning(
+                f"The mgmt db {self._db_file} has schema version {version}, "
+                f"newer than the latest known version {SCHEMA_VERSION}"
+            )
+        while version < SCHEMA_VERSION:
+            with connect_db_ctx(self._db_file) as cur:
+                # Takes the write lock before checking the version again,
+                # so only one process applies each migration
+                cur.execute("BEGIN IMMEDIATE")
+                version = cur.execute("PRAGMA user_version").fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    break
+                logger.info(
+                    f"Migrating mgmt db {self._db_file} to schema version {version + 1}"
+                )
+                for statement in MIGRATIONS[version]:
+                    cur.execute(statement)
+                version += 1
+                cur.execute(f"PRAGMA user_version = {version}")
+        return version
+
     @classmethod
     def init_db(cls, db_file: str, init_script: str):
         with connect_db_ctx(db_file) as cur:
             with open(init_script, "r") as f:
                 cur.executescript(f.read())
 
-        return cls(db_file)
+        mgmt_db = cls(db_file)
+        mgmt_db.migrate()
+        return mgmt_db
 
     def __del__(self):
         if self._conn is not None:
             self._conn.close()
+            self._conn = None
 
     def command_builder(
         self,
@@ -0,0 +1,411 @@
+"""
+Backends for the mgmt db queue, the updates jobs send to the queue monitor.
+
+directory: one json file per update in the queue folder (the default)
+sqlite: rows of a staging table in a db inside the queue folder, used when that db exists.
+    Needs fewer metadata operations on parallel filesystems than the directory backend.
+    The db uses a rollback journal, as it is written to from the compute nodes.
+
+Both identify an update by a key "{sort key}.{run_name}.{proc_type}",
+sorting the keys gives the order the updates were added in.
+Updates are only removed after they have been applied, so none are lost if the queue monitor
+stops part way, they are applied again instead.
+
+QueueWatcher waits for updates to arrive, rather than sleeping for a fixed time.
+inotify only sees changes made by the local kernel, updates written by jobs on other nodes
+are found by checking the queue stats every poll_interval, which is also the fallback when
+inotify isn't available.
+"""
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import sqlite3 as sql
+import struct
+import time
+from datetime import datetime
+from logging import Logger
+from typing import Iterable, List, Optional, Set, Tuple
+
+import qcore.constants as const
+from qcore.qclogging import get_basic_logger, NOPRINTCRITICAL
+
+from workflow.automation.lib.MgmtDB import MgmtDB, SchedulerTask
+
+QUEUE_DB_NAME = "mgmt_db_queue.db"
+BACKEND_DIRECTORY = "directory"
+BACKEND_SQLITE = "sqlite"
+BACKENDS = [BACKEND_DIRECTORY, BACKEND_SQLITE]
+# Seconds to wait for the queue db write lock
+BUSY_TIMEOUT = 120
+
+# Seconds between checks of the queue stats for updates from other nodes
+POLL_INTERVAL = 1
+# Seconds without new updates before a burst of updates is considered complete
+DEBOUNCE = 0.5
+# Maximum seconds to wait for a burst of updates to complete
+MAX_DEBOUNCE = 5
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def make_entry(
+    run_name: str,
+    proc_type: int,
+    status: int,
+    job_id: int = None,
+    error: str = None,
+    start_time: int = None,
+    end_time: int = None,
+    nodes: int = None,
+    cores: int = None,
+    memory: int = None,
+    wct: int = None,
+):
+    """The content of an update, as stored by the backends"""
+    return {
+        MgmtDB.col_run_name: run_name,
+        MgmtDB.col_proc_type: proc_type,
+        MgmtDB.col_status: status,
+        MgmtDB.col_job_id: job_id,
+        "error": error,
+        MgmtDB.col_queued_time: int(datetime.now().timestamp()),
+        MgmtDB.col_start_time: start_time,
+        MgmtDB.col_end_time: end_time,
+        MgmtDB.col_nodes: nodes,
+        MgmtDB.col_cores: cores,
+        MgmtDB.col_memory: memory,
+        MgmtDB.col_wct: wct,
+    }
+
+
+def entry_to_task(run_name: str, data_dict: dict):
+    return SchedulerTask(
+        run_name=run_name,
+        proc_type=data_dict[MgmtDB.col_proc_type],
+        status=data_dict[MgmtDB.col_status],
+        job_id=data_dict[MgmtDB.col_job_id],
+        error=data_dict.get("error"),
+        queued_time=data_dict.get(MgmtDB.col_queued_time),
+        start_time=data_dict.get(MgmtDB.col_start_time),
+        end_time=data_dict.get(MgmtDB.col_end_time),
+        nodes=data_dict.get(MgmtDB.col_nodes),
+        cores=data_dict.get(MgmtDB.col_cores),
+        memory=data_dict.get(MgmtDB.col_memory),
+        wct=data_dict.get(MgmtDB.col_wct),
+    )
+
+
+class DirectoryQueue:
+    """Each update is a json file named by its key, the sort key being the time it was added"""
+
+    backend = BACKEND_DIRECTORY
+    # Only files written to, as reading an update closes it without writing
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO
+
+    def __init__(self, queue_folder: str):
+        self.queue_folder = queue_folder
+
+    def stat(self):
+        """Changes when an update is added or removed"""
+        return os.stat(self.queue_folder).st_mtime_ns
+
+    def add(self, entry: dict, logger: Logger = get_basic_logger()):
+        filename = os.path.join(
+            self.queue_folder,
+            "{}.{}.{}".format(
+                datetime.now().strftime(const.QUEUE_DATE_FORMAT),
+                entry[MgmtDB.col_run_name],
+                entry[MgmtDB.col_proc_type],
+            ),
+        )
+
+        if os.path.exists(filename):
+            logger.log(
+                NOPRINTCRITICAL,
+                "An update with the name {} already exists. This should never happen. Quitting!".format(
+                    os.path.basename(filename)
+                ),
+            )
+            raise Exception(
+                "An update with the name {} already exists. This should never happen. Quitting!".format(
+                    os.path.basename(filename)
+                )
+            )
+
+        logger.debug("Writing update file to {}".format(filename))
+
+        with open(filename, "w") as f:
+            json.dump(entry, f)
+
+        if not os.path.isfile(filename):
+            logger.critical("File {} did not successfully write".format(filename))
+        else:
+            logger.debug("Successfully wrote task update file")
+
+    def keys(self) -> List[str]:
+        """Keys of all pending updates, in the order they were added"""
+        return sorted(os.listdir(self.queue_folder))
+
+    def read(
+        self, logger: Logger = get_basic_logger()
+    ) -> List[Tuple[str, Optional[SchedulerTask]]]:
+        """All pending updates in the order they were added.
+        The task is None for updates that could not be read"""
+        entries = []
+        for key in self.keys():
+            entry_file = os.path.join(self.queue_folder, key)
+            try:
+                with open(entry_file, "r") as f:
+                    data_dict = json.load(f)
+            except json.JSONDecodeError:
+                logger.error(
+                    "Failed to decode the file {} as json. Check that this is "
+                    "valid json. Ignored!".format(entry_file)
+                )
+                entries.append((key, None))
+            else:
+                entries.append((key, entry_to_task(key.split(".")[1], data_dict)))
+        return entries
+
+    def remove(self, keys: List[str]):
+        for key in keys:
+            os.remove(os.path.join(self.queue_folder, key))
+
+
+class SQLiteQueue:
+    """Each update is a row of the queue table, the sort key being the zero padded row id"""
+
+    backend = BACKEND_SQLITE
+    # Connections are opened for writing even when only reading, so only actual writes
+    watch_mask = IN_MODIFY
+
+    def __init__(self, queue_folder: str):
+        self.queue_folder = queue_folder
+        self.db_file = os.path.join(queue_folder, QUEUE_DB_NAME)
+
+    def stat(self):
+        """Changes when an update is added or removed"""
+        db_stat = os.stat(self.db_file)
+        return db_stat.st_mtime_ns, db_stat.st_size
+
+    def _connect(self):
+        conn = sql.connect(self.db_file, timeout=BUSY_TIMEOUT)
+        # WAL needs shared memory, which isn't available across nodes.
+        # PERSIST keeps the journal file, rather than creating and deleting it for every update
+        conn.execute("PRAGMA journal_mode = PERSIST")
+        return conn
+
+    @classmethod
+    def create(cls, queue_folder: str):
+        queue = cls(queue_folder)
+        conn = queue._connect()
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS `queue` (
+                `id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                `run_name` TEXT NOT NULL,
+                `proc_type` INTEGER NOT NULL,
+                `entry` TEXT NOT NULL)"""
+            )
+        conn.close()
+        return queue
+
+    def add(self, entry: dict, logger: Logger = get_basic_logger()):
+        conn = self._connect()
+        try:
+            with conn:
+                cur = conn.execute(
+                    "INSERT INTO queue(run_name, proc_type, entry) VALUES(?, ?, ?)",
+                    (
+                        entry[MgmtDB.col_run_name],
+                        entry[MgmtDB.col_proc_type],
+                        json.dumps(entry),
+                    ),
+                )
+            logger.debug("Added update {} to {}".format(cur.lastrowid, self.db_file))
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _key(row_id, run_name, proc_type):
+        return "{:012d}.{}.{}".format(row_id, run_name, proc_type)
+
+    def keys(self) -> List[str]:
+        """Keys of all pending updates, in the order they were added"""
+        conn = self._connect()
+        try:
+            return [
+                self._key(*row)
+                for row in conn.execute(
+                    "SELECT id, run_name, proc_type FROM queue ORDER BY id"
+                )
+            ]
+        finally:
+            conn.close()
+
+    def read(
+        self, logger: Logger = get_basic_logger()
+    ) -> List[Tuple[str, Optional[SchedulerTask]]]:
+        """All pending updates in the order they were added.
+        The task is None for updates that could not be read"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT id, run_name, proc_type, entry FROM queue ORDER BY id"
+            ).fetchall()
+        finally:
+            conn.close()
+
+        entries = []
+        for row_id, run_name, proc_type, entry in rows:
+            key = self._key(row_id, run_name, proc_type)
+            try:
+                entries.append((key, entry_to_task(run_name, json.loads(entry))))
+            except json.JSONDecodeError:
+                logger.error(
+                    "Failed to decode the update {} as json. Ignored!".format(key)
+                )
+                entries.append((key, None))
+        return entries
+
+    def remove(self, keys: List[str]):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "DELETE FROM queue WHERE id = ?",
+                    [(int(key.split(".")[0]),) for key in keys],
+                )
+        finally:
+            conn.close()
+
+
+def _init_inotify(path: str, mask: int):
+    """Returns an inotify file descriptor watching path, or None if inotify isn't available"""
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        return None
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class QueueWatcher:
+    """Waits for updates to be added to a queue. Changes made since the previous wait
+    returned, including those by the caller, count as updates"""
+
+    def __init__(
+        self,
+        queue,
+        poll_interval: float = POLL_INTERVAL,
+        debounce: float = DEBOUNCE,
+        max_debounce: float = MAX_DEBOUNCE,
+        use_inotify: bool = True,
+        logger: Logger = get_basic_logger(),
+    ):
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+
+        self._fd = (
+            _init_inotify(queue.queue_folder, queue.watch_mask) if use_inotify else None
+        )
+        if self._fd is None:
+            logger.debug(
+                f"Watching {queue.queue_folder} every {poll_interval}s without inotify"
+            )
+        else:
+            logger.debug(f"Watching {queue.queue_folder} with inotify")
+        self._last_stat = queue.stat()
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def _changed(self, timeout: float):
+        """Waits up to timeout seconds for a change to the queue"""
+        if self._fd is not None:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if ready:
+                # Only the presence of events matters, not their content
+                while True:
+                    try:
+                        os.read(self._fd, 64 * (struct.calcsize("iIII") + 256))
+                    except BlockingIOError:
+                        break
+                self._last_stat = self.queue.stat()
+                return True
+        else:
+            time.sleep(timeout)
+
+        queue_stat = self.queue.stat()
+        if queue_stat != self._last_stat:
+            self._last_stat = queue_stat
+            return True
+        return False
+
+    def wait(self, timeout: float):
+        """Waits up to timeout seconds for updates to be added.
+        Once an update is seen keeps waiting until the updates stop for debounce seconds,
+        so a burst of updates is returned together.
+        Returns True if there were updates, False if the timeout was reached"""
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self._changed(min(self.poll_interval, remaining)):
+                break
+
+        burst_end = time.monotonic() + self.max_debounce
+        while True:
+            remaining = burst_end - time.monotonic()
+            if remaining <= 0 or not self._changed(min(self.debounce, remaining)):
+                return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def get_pending_updates(keys: Iterable[str]) -> Set[Tuple[str, int]]:
+    """Indexes the given update keys by (run_name, proc_type), to check for pending updates
+    of a task without going through all keys. Build once per cycle from a snapshot of keys()"""
+    pending_updates = set()
+    for key in keys:
+        _, run_name, proc_type = key.split(".")
+        pending_updates.add((run_name, int(proc_type)))
+    return pending_updates
+
+
+def get_queue(queue_folder: str):
+    """Returns the backend in use by the given queue folder"""
+    if os.path.isfile(os.path.join(queue_folder, QUEUE_DB_NAME)):
+        return SQLiteQueue(queue_folder)
+    return DirectoryQueue(queue_folder)
+
+
+def create_queue(queue_folder: str, backend: str = BACKEND_DIRECTORY):
+    """Sets up the queue folder to use the given backend"""
+    os.makedirs(queue_folder, exist_ok=True)
+    if backend == BACKEND_SQLITE:
+        return SQLiteQueue.create(queue_folder)
+    elif backend == BACKEND_DIRECTORY:
+        return DirectoryQueue(queue_folder)
+    raise ValueError(f"Unknown queue backend {backend}, must be one of {BACKENDS}")
@@ -1,4 +1,8 @@
+import threading
+import time
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from enum import Enum
 from logging import Logger
 from typing import List, Dict, Type, Tuple
 
@@ -15,6 +19,42 @@ class SchedulerException(EnvironmentError):
     pass
 
 
+# Maximum number of job ids given to a single sacct/qstat call by the *_many methods
+JOB_BATCH_SIZE = 200
+
+# Default seconds a snapshot of a machines queue is used for, before the scheduler is queried again
+QUEUE_TTL = 5
+
+
+@dataclass
+class QueueSnapshot:
+    # (job id, state, user) of every job of the platform accounts
+    jobs: List[Tuple[str, str, str]]
+    # time.monotonic() at the start of the query
+    time: float
+
+
+@dataclass
+class QueueMetrics:
+    """Scheduler queue queries and cache hits of check_queues for a machine"""
+
+    queries: int = 0
+    cache_hits: int = 0
+    errors: int = 0
+    total_query_time: float = 0
+    max_query_time: float = 0
+
+    @property
+    def mean_query_time(self):
+        return self.total_query_time / self.queries if self.queries > 0 else 0
+
+    def __str__(self):
+        return (
+            f"{self.queries} queries (mean {self.mean_query_time:.2f}s, max {self.max_query_time:.2f}s), "
+            f"{self.cache_hits} cache hits, {self.errors} errors"
+        )
+
+
 class AbstractScheduler(ABC):
     """
     Defines the generic scheduler API to interact with various platform scheduling software
@@ -24,9 +64,20 @@ class AbstractScheduler(ABC):
     SCRIPT_EXTENSION: str
     HEADER_TEMPLATE: str
     QUEUE_NAME: str
+    # The queue state of a job that has just been submitted
+    QUEUED_STATE: str
+    # If submit_array_job is implemented, and how many elements an array job can have
+    SUPPORTS_ARRAY_JOBS = False
+    MAX_ARRAY_SIZE = 0
 
     def __init__(
-        self, user, account, current_machine, logger: Logger, platform_accounts=None
+        self,
+        user,
+        account,
+        current_machine,
+        logger: Logger,
+        platform_accounts=None,
+        queue_ttl: float = QUEUE_TTL,
     ):
         if platform_accounts is None:
             platform_accounts = [account]
@@ -37,6 +88,13 @@ class AbstractScheduler(ABC):
         self._run_command_and_wait = self.logging_wrapper(task_runner_no_debug)
         self.platform_accounts = platform_accounts
 
+        # The scheduler is shared by the queue monitor and auto_submit threads,
+        # the queue snapshots let them share the result of each query
+        self.queue_ttl = queue_ttl
+        self._queue_snapshots: Dict[str, QueueSnapshot] = {}
+        self._queue_metrics: Dict[str, QueueMetrics] = {}
+        self._queue_locks: Dict[str, threading.Lock] = {}
+
     @abstractmethod
     def submit_job(
         self, sim_dir, script_location: str, target_machine: str = None
@@ -51,6 +109,28 @@ class AbstractScheduler(ABC):
         """
         pass
 
+    def submit_array_job(
+        self, elements: List[Tuple[str, str]], target_machine=None
+    ) -> List[str]:
+        """
+        Submits the scripts of tasks with the same resources as the elements of a single array job
+        :param elements: The (sim_dir, script_location) of each element, at most MAX_ARRAY_SIZE
+        :param target_machine: The machine to submit the array job to
+        :return: The job id of each element, in the order of elements
+        """
+        raise self.raise_exception(
+            f"Array jobs are not supported by the {type(self).__name__} scheduler",
+            NotImplementedError,
+        )
+
+    def array_group_key(self, script_location: str) -> Tuple[str, ...]:
+        """The resources requested by a script. Scripts with the same resources can be submitted
+        as the elements of one array job"""
+        raise self.raise_exception(
+            f"Array jobs are not supported by the {type(self).__name__} scheduler",
+            NotImplementedError,
+        )
+
     @abstractmethod
     def cancel_job(self, job_id: int, target_machine=None) -> Tuple[str, str]:
         """
@@ -61,14 +141,92 @@ class AbstractScheduler(ABC):
         pass
 
     @abstractmethod
-    def check_queues(self, user: bool = False, target_machine=None) -> List[str]:
+    def _query_queue(self, target_machine=None) -> List[Tuple[str, str, str]]:
+        """
+        Queries the schedulers queue(s) for the jobs of all users of the platform accounts
+        :param target_machine: The machine to check the queues of
+        :return: A list of (job id, state, user) tuples
+        """
+        pass
+
+    def check_queues(
+        self, user: bool = False, target_machine=None, max_age: float = None
+    ) -> List[str]:
         """
-        Checks the schedulers queue(s) for running jobs
+        Checks the schedulers queue(s) for running jobs.
+        The scheduler is queried at most once per queue_ttl seconds for each machine,
+        the user and account wide views are both taken from the same query
         :param user: Which user should the jobs be checked for?
         :param target_machine: The machine to check the queues of
+        :param max_age: Seconds the last query can be reused for, when less than queue_ttl.
+        For re-checking the queue for jobs known to have finished since the last query
         :return: A list of jobs and states, in the format "<job id> <state>"
         """
-        pass
+        jobs = self._get_queue_snapshot(target_machine, max_age).jobs
+        return [
+            f"{job_id} {state}"
+            for job_id, state, job_user in jobs
+            if not user or job_user == self.user_name
+        ]
+
+    def get_queue_metrics(self) -> Dict[str, QueueMetrics]:
+        """The queue query and cache hit counts of each machine"""
+        return dict(self._queue_metrics)
+
+    def _machine_key(self, target_machine):
+        if target_machine is None:
+            target_machine = self.current_machine
+        if isinstance(target_machine, Enum):
+            return target_machine.name
+        return target_machine
+
+    def _get_queue_snapshot(
+        self, target_machine=None, max_age: float = None
+    ) -> QueueSnapshot:
+        key = self._machine_key(target_machine)
+        ttl = self.queue_ttl if max_age is None else min(self.queue_ttl, max_age)
+        # Only one thread queries a machine at a time, the others wait for its result
+        with self._queue_locks.setdefault(key, threading.Lock()):
+            metrics = self._queue_metrics.setdefault(key, QueueMetrics())
+            snapshot = self._queue_snapshots.get(key)
+            if snapshot is not None and time.monotonic() - snapshot.time < ttl:
+                metrics.cache_hits += 1
+                return snapshot
+
+            start = time.monotonic()
+            try:
+                jobs = self._query_queue(target_machine)
+            except EnvironmentError:
+                metrics.errors += 1
+                raise
+            finally:
+                query_time = time.monotonic() - start
+                metrics.queries += 1
+                metrics.total_query_time += query_time
+                metrics.max_query_time = max(metrics.max_query_time, query_time)
+            self.logger.debug(
+                f"Queried the {self.QUEUE_NAME} queue of {key} in {query_time:.2f}s"
+            )
+            snapshot = QueueSnapshot(jobs, start)
+            self._queue_snapshots[key] = snapshot
+            return snapshot
+
+    def _add_to_queue_snapshot(self, job_id, target_machine=None):
+        """Adds a just submitted job to the queue snapshot of its machine,
+        so it is counted before the next query"""
+        key = self._machine_key(target_machine)
+        with self._queue_locks.setdefault(key, threading.Lock()):
+            snapshot = self._queue_snapshots.get(key)
+            if snapshot is not None:
+                snapshot.jobs = snapshot.jobs + [
+                    (str(job_id), self.QUEUED_STATE, self.user_name)
+                ]
+
+    def _clear_queue_snapshot(self, target_machine=None):
+        """Forces the next check_queues of the machine to query the scheduler"""
+        key = self._machine_key(target_machine)
+        with self._queue_locks.setdefault(key, threading.Lock()):
+            self._queue_snapshots.pop(key, None)
 
     @abstractmethod
     def check_wct_hit(self, job_id: int) -> bool:
@@ -79,6 +237,22 @@ class AbstractScheduler(ABC):
         """
         pass
 
+    def check_wct_hit_many(self, job_ids: List[int]) -> Dict[int, bool]:
+        """
+        Checks the given jobs if they have failed due to Wall Clock Time.
+        Schedulers that can query many jobs at once override this to do so
+        :param job_ids: The ids of the jobs to be checked for wct
+        :return: Dictionary of job id to if the job has failed due to Wall Clock Time or not.
+        Jobs the scheduler has no wall clock time for are not included
+        """
+        wct_hits = {}
+        for job_id in job_ids:
+            try:
+                wct_hits[job_id] = self.check_wct_hit(job_id)
+            except IndexError:
+                continue
+        return wct_hits
+
     @staticmethod
     @abstractmethod
     def process_arguments(
@@ -98,6 +272,31 @@ class AbstractScheduler(ABC):
     def get_metadata(self, db_running_task: SchedulerTask, task_logger: Logger):
         pass
 
+    @staticmethod
+    def _batch_job_ids(job_ids: List[int]) -> List[Dict[str, int]]:
+        """Splits job ids into batches of at most JOB_BATCH_SIZE,
+        each a dictionary of the job ids as the scheduler prints them to the given job id"""
+        job_ids = list(job_ids)
+        return [
+            {str(job_id): job_id for job_id in job_ids[i : i + JOB_BATCH_SIZE]}
+            for i in range(0, len(job_ids), JOB_BATCH_SIZE)
+        ]
+
+    def get_metadata_many(
+        self, db_running_tasks: List[SchedulerTask], task_logger: Logger
+    ) -> Dict[int, Tuple]:
+        """
+        Retrieves the metadata of the given tasks, as returned by get_metadata.
+        Schedulers that can query many jobs at once override this to do so
+        :param db_running_tasks: The tasks to retrieve metadata for
+        :param task_logger: the logger for the tasks
+        :return: Dictionary of job id to the metadata tuple of the job
+        """
+        return {
+            task.job_id: self.get_metadata(task, task_logger)
+            for task in db_running_tasks
+        }
+
     def logging_wrapper(self, func):
         """
         Wraps an external function so that all input and output is logged at the VERYVERBOSE level
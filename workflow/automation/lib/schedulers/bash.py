@@ -1,63 +1,329 @@
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
 from logging import Logger
-from typing import Dict
+from typing import Dict, Optional
+
+from qcore.constants import timestamp
 
 from workflow.automation.lib.MgmtDB import SchedulerTask
 from workflow.automation.lib.schedulers.abstractscheduler import AbstractScheduler
 
+# Seconds between checks of the running jobs, for finished jobs and jobs over their wall clock time
+POLL_INTERVAL = 1
+# Seconds a job is given to exit after being sent SIGTERM, before it is killed
+KILL_GRACE = 10
+# #SBATCH header lines, as used by the scheduler header of the local platform
+HEADER_PATTERN = re.compile(r"^#SBATCH\s+(--?[\w-]+)[=\s]+(\S+)")
+MEMORY_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024**2}
+METADATA_TIME_FORMAT = "%Y-%m-%d_%H:%M:%S"
+
+
+@dataclass
+class LocalJob:
+    job_id: int
+    script_location: str
+    sim_dir: str
+    n_cores: int
+    # MB
+    memory: float
+    # Seconds, None for no limit
+    wct: Optional[float]
+    # One of the sacct job states
+    state: str = "PENDING"
+    submit_time: float = None
+    start_time: float = None
+    end_time: float = None
+    exit_code: int = None
+    process: subprocess.Popen = None
+    # When a stopped job that hasn't exited is killed
+    kill_time: float = None
+
+    @property
+    def has_process(self):
+        """If the job has a process that hasn't exited, including stopped jobs that are still exiting"""
+        return self.process is not None and self.exit_code is None
+
 
 class Bash(AbstractScheduler):
-    job_counter = 0
-    task_running = False
+    """
+    Runs jobs as local processes, as many at once as the cores and memory of the machine allow.
+    Jobs request resources with the same #SBATCH header lines as on Slurm, and are given the
+    SLURM_JOB_ID, SLURM_NTASKS and SLURM_NNODES variables the templates use
+    """
 
     RUN_COMMAND = ""
     SCRIPT_EXTENSION = "sh"
+    QUEUE_NAME = "bash"
+    QUEUED_STATE = "PD"
+    STATUS_DICT = {"R": 3, "PD": 2}
+    # The queue state of each job state that is still in the queue
+    QUEUE_STATES = {"PENDING": "PD", "RUNNING": "R"}
 
-    @staticmethod
-    def process_arguments(script_path: str, arguments: Dict[str, str]):
-        return f"{script_path} {' '.join(arguments.items())}"
+    def __init__(
+        self,
+        user,
+        account,
+        current_machine,
+        logger: Logger,
+        platform_accounts=None,
+        queue_ttl: float = 0,
+        max_cores: int = None,
+        max_memory: float = None,
+    ):
+        """
+        :param max_cores: The number of cores jobs can use at once, defaults to the core count of the machine
+        :param max_memory: The MB of memory jobs can use at once, defaults to the memory of the machine
+        """
+        super().__init__(
+            user,
+            account,
+            current_machine,
+            logger,
+            platform_accounts=platform_accounts,
+            queue_ttl=queue_ttl,
+        )
+        self.max_cores = max_cores if max_cores is not None else os.cpu_count()
+        if max_memory is None:
+            max_memory = (
+                os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**2
+            )
+        self.max_memory = max_memory
 
-    def get_metadata(self, db_running_task: SchedulerTask, task_logger: Logger):
-        pass
+        # Job ids are unique across runs, as they are unique in the mgmt db
+        self._next_job_id = int(time.time() * 1000)
+        self._jobs: Dict[int, LocalJob] = {}
+        self._jobs_lock = threading.RLock()
+        self._manager = None
 
-    def submit_job(self, script_location: str, target_machine: str = None, **kwargs):
+    @staticmethod
+    def process_arguments(
+        script_path: str,
+        arguments: Dict[str, str],
+        scheduler_arguments: Dict[str, str],
+    ):
         """
-        Runs job in the bash shell
-        Will run job until completion
-        Enforces that the script is executable, then executes it
-        :param script_location:
-        :param target_machine:
-        :param **kwargs: Any additional parameters to be passed to the executor
-        :return: The index of the task
+        The scheduler arguments are not used, the resources of a job are read from the header of its script
         """
-        self.logger.debug(
-            f"Ensuring execute set and running script located at: {script_location}"
-        )
+        return f"{script_path} {' '.join(arguments.values())}"
 
-        # Could run task as non blocking with internal "schedule manager".
-        # May result in cpu overload if too many tasks are run at once
-        self.task_running = True
-        self._run_command_and_wait(cmd=f"chmod u+x {script_location}")
-        self._run_command_and_wait(cmd=f"{script_location}")
-        self.task_running = False
-        self.job_counter += 1
-        return self.job_counter
+    def submit_job(self, sim_dir, script_location: str, target_machine: str = None):
+        """
+        Queues the script to be run in the bash shell, once there are enough cores and memory free for it
+        :param sim_dir: The realisation directory, the output of the job is written to it
+        :param script_location: The script to run
+        :param target_machine: The machine to run the job on (unused)
+        :return: The id of the job
+        """
+        n_cores, memory, wct = self._get_resources(script_location)
+        # A job larger than the machine runs on its own
+        n_cores, memory = min(n_cores, self.max_cores), min(memory, self.max_memory)
+        with self._jobs_lock:
+            job_id = self._next_job_id
+            self._next_job_id += 1
+            self._jobs[job_id] = LocalJob(
+                job_id,
+                script_location,
+                sim_dir,
+                n_cores,
+                memory,
+                wct,
+                submit_time=time.time(),
+            )
+            self.logger.debug(
+                f"Queued {script_location} as job {job_id}, requesting {n_cores} cores, {memory}MB and {wct}s"
+            )
+            self._start_jobs()
+            if self._manager is None:
+                self._manager = threading.Thread(
+                    target=self._manage_jobs, name="bash_scheduler", daemon=True
+                )
+                self._manager.start()
+        return job_id
 
     def cancel_job(self, job_id: int, target_machine=None):
-        raise self.raise_exception("Cannot cancel a job with the bash scheduler")
+        with self._jobs_lock:
+            job = self._jobs.get(int(job_id))
+            if job is None or job.state not in self.QUEUE_STATES:
+                raise self.raise_exception(
+                    f"Job {job_id} is not queued or running, so cannot be cancelled"
+                )
+            if job.state == "RUNNING":
+                self._stop_job(job)
+            job.state = "CANCELLED"
+            job.end_time = time.time()
+            self._start_jobs()
+        self.logger.debug(f"Cancelled job-id {job_id} successfully")
 
-    def check_queues(self, user: bool = False, target_machine=None):
+    def _query_queue(self, target_machine=None):
         """
-        If there is a job running in submit_job then this returns the job number
-        submit_job needs to be changed to non-blocking to allow the task to enter the 'queued' state in the db
-        :param user: The user to check the queues for (unused)
         :param target_machine: The machine to check the queues of (unused)
-        :return: Either an empty list or a list containing a job id, 'R' tuple to represent the currently running job
+        :return: A job id, state, user tuple for each queued and running job
         """
-        self.logger.debug("Bash scheduler queues are empty")
-        tasks = []
-        if self.task_running:
-            tasks.append((f"{self.job_counter}", "R"))
-        return tasks
+        with self._jobs_lock:
+            self._update_jobs()
+            return [
+                (str(job.job_id), self.QUEUE_STATES[job.state], self.user_name)
+                for job in self._jobs.values()
+                if job.state in self.QUEUE_STATES
+            ]
 
     def check_wct_hit(self, job_id: int):
-        pass
+        with self._jobs_lock:
+            job = self._jobs.get(int(job_id))
+            if job is None or job.end_time is None:
+                # As for sacct, no wall clock time is known for the job
+                raise IndexError(f"Job {job_id} has not finished")
+            return job.state == "TIMEOUT"
+
+    def get_metadata(self, db_running_task: SchedulerTask, task_logger: Logger):
+        """
+        Gets the recorded metadata of a finished job
+        :param db_running_task: The task to retrieve metadata for
+        :param task_logger: the logger for the task
+        :return: start_time, end_time, run_time, n_cores, status
+        """
+        with self._jobs_lock:
+            self._update_jobs()
+            job = self._jobs.get(int(db_running_task.job_id))
+            if job is None or job.start_time is None:
+                task_logger.warning(
+                    "job data cannot be retrieved from the bash scheduler. likely the job is cancelled before running. setting job status to CANCELLED"
+                )
+                return 0, 0, 0, 0.0, "CANCELLED"
+            end_time = job.end_time if job.end_time is not None else time.time()
+            task_logger.debug(f"Job {job.job_id} exited with code {job.exit_code}")
+            return (
+                datetime.fromtimestamp(job.start_time).strftime(METADATA_TIME_FORMAT),
+                datetime.fromtimestamp(end_time).strftime(METADATA_TIME_FORMAT),
+                end_time - job.start_time,
+                float(job.n_cores),
+                job.state,
+            )
+
+    def _manage_jobs(self):
+        """Checks the running jobs every POLL_INTERVAL seconds, for as long as there are jobs in the queue"""
+        while True:
+            time.sleep(POLL_INTERVAL)
+            with self._jobs_lock:
+                self._update_jobs()
+                if not any(
+                    job.state in self.QUEUE_STATES or job.has_process
+                    for job in self._jobs.values()
+                ):
+                    self._manager = None
+                    return
+
+    def _update_jobs(self):
+        """Records the exit of finished jobs, stops jobs over their wall clock time and starts queued jobs.
+        Must be called with the jobs lock held"""
+        now = time.time()
+        for job in self._jobs.values():
+            if not job.has_process:
+                continue
+            exit_code = job.process.poll()
+            if exit_code is not None:
+                job.exit_code = exit_code
+                self.logger.debug(f"Job {job.job_id} exited with code {exit_code}")
+                if job.state == "RUNNING":
+                    job.end_time = now
+                    job.state = "COMPLETED" if exit_code == 0 else "FAILED"
+            elif job.state == "RUNNING":
+                if job.wct is not None and now - job.start_time > job.wct:
+                    self.logger.warning(
+                        f"Job {job.job_id} exceeded its wall clock time of {job.wct}s, stopping it"
+                    )
+                    self._stop_job(job)
+                    job.state = "TIMEOUT"
+                    job.end_time = now
+            elif now > job.kill_time:
+                self._signal_job(job, signal.SIGKILL)
+        self._start_jobs()
+
+    def _start_jobs(self):
+        """Starts queued jobs in submission order, skipping those that don't fit in the free cores and memory.
+        Must be called with the jobs lock held"""
+        # Stopped jobs hold on to their resources until they have exited
+        running = [job for job in self._jobs.values() if job.has_process]
+        free_cores = self.max_cores - sum(job.n_cores for job in running)
+        free_memory = self.max_memory - sum(job.memory for job in running)
+        for job in self._jobs.values():
+            if (
+                job.state == "PENDING"
+                and job.n_cores <= free_cores
+                and job.memory <= free_memory
+            ):
+                self._start_job(job)
+                free_cores -= job.n_cores
+                free_memory -= job.memory
+
+    def _start_job(self, job: LocalJob):
+        job_name = os.path.basename(job.script_location).rsplit(".", 1)[0]
+        f_name = os.path.join(job.sim_dir, f"{job_name}_{timestamp}_{job.job_id}")
+        env = dict(
+            os.environ,
+            SLURM_JOB_ID=str(job.job_id),
+            SLURM_NTASKS=str(job.n_cores),
+            SLURM_NNODES="1",
+        )
+        self.logger.debug(f"Starting job {job.job_id}: {job.script_location}")
+        with open(f"{f_name}.out", "w") as out, open(f"{f_name}.err", "w") as err:
+            # A new session, so the job and all its child processes can be stopped together
+            job.process = subprocess.Popen(
+                ["bash", job.script_location],
+                cwd=job.sim_dir,
+                stdout=out,
+                stderr=err,
+                env=env,
+                start_new_session=True,
+            )
+        job.state = "RUNNING"
+        job.start_time = time.time()
+
+    def _stop_job(self, job: LocalJob):
+        """Stops a running job and its child processes. They are killed if they are still running after KILL_GRACE seconds"""
+        self._signal_job(job, signal.SIGTERM)
+        job.kill_time = time.time() + KILL_GRACE
+
+    @staticmethod
+    def _signal_job(job: LocalJob, signal_number: int):
+        try:
+            os.killpg(job.process.pid, signal_number)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def _get_resources(script_location: str):
+        """
+        Gets the resources a script requests with its #SBATCH header lines
+        :return: The number of cores, MB of memory and seconds of wall clock time (None if not limited)
+        """
+        n_tasks, cpus_per_task, memory, wct = 1, 1, 0, None
+        with open(script_location) as script_file:
+            for line in script_file:
+                match = HEADER_PATTERN.match(line.strip())
+                if match is None:
+                    continue
+                option, value = match.groups()
+                if option in ["--ntasks", "-n"]:
+                    n_tasks = int(value)
+                elif option in ["--cpus-per-task", "-c"]:
+                    cpus_per_task = int(value)
+                elif option == "--mem":
+                    unit = value[-1].upper()
+                    if unit in MEMORY_UNITS:
+                        memory = float(value[:-1]) * MEMORY_UNITS[unit]
+                    else:
+                        memory = float(value)
+                elif option in ["--time", "-t"]:
+                    days, _, hms = value.rpartition("-")
+                    hours, minutes, seconds = hms.split(":")
+                    wct = (
+                        (int(days or 0) * 24 + int(hours)) * 60 + int(minutes)
+                    ) * 60 + int(seconds)
+        return n_tasks * cpus_per_task, memory, wct
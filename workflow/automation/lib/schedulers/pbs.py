@@ -1,7 +1,7 @@
 import json
 import os
 from logging import Logger
-from typing import List, Dict
+from typing import Dict, List
 from datetime import timedelta
 
 from qcore.constants import timestamp
@@ -18,7 +18,40 @@ class Pbs(AbstractScheduler):
         :param task_logger: the logger for the task
         :return: A tuple containing the expected metadata
         """
-        cmd = [f"qstat -f -F json -x {db_running_task.job_id}"]
+        tasks_dict = self._get_jobs_dict([db_running_task.job_id])
+        assert (
+            len(tasks_dict.keys()) <= 1
+        ), f"Too many tasks returned by qstat: {tasks_dict.keys()}"
+
+        return self._parse_metadata(next(iter(tasks_dict.values()), None), task_logger)
+
+    def get_metadata_many(
+        self, db_running_tasks: List[SchedulerTask], task_logger: Logger
+    ):
+        """
+        Queries qstat for the information of completed tasks, with one call per JOB_BATCH_SIZE jobs
+        :param db_running_tasks: The tasks to retrieve metadata for
+        :param task_logger: the logger for the tasks
+        :return: Dictionary of job id to the metadata tuple of the job
+        """
+        metadata = {}
+        for batch in self._batch_job_ids(
+            [db_running_task.job_id for db_running_task in db_running_tasks]
+        ):
+            tasks_dict = self._get_jobs_dict(batch.keys())
+            for job_id in batch.keys():
+                metadata[batch[job_id]] = self._parse_metadata(
+                    tasks_dict.get(job_id), task_logger
+                )
+        return metadata
+
+    def _get_jobs_dict(self, job_ids):
+        """
+        Queries qstat for the full information of the given jobs, including finished jobs
+        :param job_ids: The ids of the jobs to query
+        :return: Dictionary of job id (without the server suffix) to the qstat job dictionary
+        """
+        cmd = [f"qstat -f -F json -x {' '.join(str(job_id) for job_id in job_ids)}"]
 
         out, err = self._run_command_and_wait(cmd, shell=True)
         # remove values that contains backslash
@@ -26,7 +59,20 @@ class Pbs(AbstractScheduler):
         out = out.replace("\\", "")
         json_dict = json.loads(out, strict=False)
 
-        if "Jobs" not in json_dict:
+        return {
+            task_name.split(".")[0]: task_dict
+            for task_name, task_dict in json_dict.get("Jobs", {}).items()
+        }
+
+    @staticmethod
+    def _parse_metadata(task_dict, task_logger: Logger):
+        """
+        Gets the metadata of a task from its qstat job dictionary
+        :param task_dict: The qstat job dictionary, None if qstat has no information on the job
+        :param task_logger: the logger for the task
+        :return: A tuple containing the expected metadata
+        """
+        if task_dict is None:
             # a special case when a job is cancelled before getting logged in the scheduler
             task_logger.warning(
                 "job data cannot be retrieved from qstat."
@@ -39,13 +85,6 @@ class Pbs(AbstractScheduler):
             status = "CANCELLED"
             return start_time, end_time, run_time, n_cores, status
 
-        tasks_dict = json_dict["Jobs"]
-        assert (
-            len(tasks_dict.keys()) == 1
-        ), f"Too many tasks returned by qstat: {tasks_dict.keys()}"
-
-        task_name = list(tasks_dict.keys())[0]
-        task_dict = tasks_dict[task_name]
         submit_time = task_dict["ctime"].replace(" ", "_")
         start_time = task_dict["qtime"].replace(" ", "_")
         # Last modified time. There isn't an explicit end time,
@@ -69,6 +108,7 @@ class Pbs(AbstractScheduler):
     STATUS_DICT = {"R": 3, "Q": 2, "E": 3, "F": 4}
     SCRIPT_EXTENSION = "pbs"
     QUEUE_NAME = "qstat"
+    QUEUED_STATE = "Q"
 
     def submit_job(
         self, sim_dir, script_location: str, target_machine: str = None
@@ -127,33 +167,29 @@ class Pbs(AbstractScheduler):
         self._run_command_and_wait(
             [f"qalter -e {sim_dir}/{f_name}.err {jobid}"], shell=True
         )
+        self._add_to_queue_snapshot(jobid, target_machine)
         return jobid
 
     def cancel_job(self, job_id: int, target_machine=None) -> None:
-        return self._run_command_and_wait(cmd=[f"qdel {job_id}"], shell=True)
+        out = self._run_command_and_wait(cmd=[f"qdel {job_id}"], shell=True)
+        self._clear_queue_snapshot(target_machine)
+        return out
 
-    def check_queues(self, user: bool = False, target_machine=None) -> List[str]:
-        self.logger.debug(
-            f"Checking queues with raw input of machine {target_machine} and user {user}"
-        )
-        if user:  # just print the list of jobid and status (a space between)
-            cmd = [f"qstat -u {self.user_name}"]
-            header_pattern = "pbs:"
-            header_idx = 1
-            job_list_idx = 5
-        else:
-            cmd = ["qstat"]
-            header_pattern = "Job id"
-            header_idx = 0
-            job_list_idx = 3
+    def _query_queue(self, target_machine=None):
+        self.logger.debug(f"Checking queues with raw input of machine {target_machine}")
+        # Jobs of all users are requested, check_queues filters them for the user view
+        cmd = ["qstat"]
+        header_pattern = "Job id"
+        header_idx = 0
+        job_list_idx = 3
 
         (output, err) = self._run_command_and_wait(cmd, encoding="utf-8", shell=True)
         self.logger.debug(f"Command {cmd} got response output {output} and error {err}")
+        if len(output) == 0:  # empty queue has no header
+            return []
         try:
             header = output.split("\n")[header_idx]
         except Exception:
-            if user is not None and len(output) == 0:  # empty queue has no header
-                return []
             raise EnvironmentError(
                 f"qstat did not return expected output. Ignoring for this iteration. Actual output: {output}"
             )
@@ -162,17 +198,15 @@ class Pbs(AbstractScheduler):
                 raise EnvironmentError(
                     f"qstat did not return expected output. Ignoring for this iteration. Actual output: {output}"
                 )
-        # only keep the relevant info
+        # only keep the relevant info, the columns are Job id, Name, User, Time Use, S, Queue
         jobs = []
-        for l in [
-            line.split() for line in output.split("\n")[job_list_idx:-1]
-        ]:  # last line is empty
+        for l in [line.split() for line in output.split("\n")[job_list_idx:]]:
             self.logger.debug(l)
-            jobs.append("{} {}".format(l[0].split(".")[0], l[-2]))
+            if l:
+                jobs.append((l[0].split(".")[0], l[-2], l[2]))
 
-        output_list = list(filter(None, jobs))
-        self.logger.debug(output_list)
-        return output_list
+        self.logger.debug(jobs)
+        return jobs
 
     def check_wct_hit(self, job_id: int):
         """
@@ -198,6 +232,34 @@ class Pbs(AbstractScheduler):
         )
         return elapsed_time >= limit_time
 
+    def check_wct_hit_many(self, job_ids: List[int]) -> Dict[int, bool]:
+        """
+        Checks the given jobs if they have failed due to Wall Clock Time, with one qstat call per JOB_BATCH_SIZE jobs
+        :param job_ids: The ids of the jobs to be checked for wct
+        :return: Dictionary of job id to if the job has failed due to Wall Clock Time or not.
+        Jobs qstat has no wall clock time for are not included
+        """
+        wct_hits = {}
+        for batch in self._batch_job_ids(job_ids):
+            tasks_dict = self._get_jobs_dict(batch.keys())
+            for job_id, task_dict in tasks_dict.items():
+                try:
+                    elapsed = task_dict["resources_used"]["walltime"]
+                    time_limit = task_dict["Resource_List"]["walltime"]
+                except KeyError:
+                    continue
+                if job_id in batch:
+                    wct_hits[batch[job_id]] = self._parse_walltime(
+                        elapsed
+                    ) >= self._parse_walltime(time_limit)
+        return wct_hits
+
+    @staticmethod
+    def _parse_walltime(walltime: str) -> timedelta:
+        """Parses a qstat walltime in the hours:minutes:seconds format"""
+        hours, minutes, seconds = walltime.split(":")
+        return timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
+
     @staticmethod
     def process_arguments(
         script_path: str,
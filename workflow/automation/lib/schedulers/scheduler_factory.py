@@ -3,7 +3,10 @@ from logging import Logger
 from qcore.constants import PLATFORM_CONFIG
 from qcore.config import host
 from qcore.qclogging import get_basic_logger
-from workflow.automation.lib.schedulers.abstractscheduler import AbstractScheduler
+from workflow.automation.lib.schedulers.abstractscheduler import (
+    AbstractScheduler,
+    QUEUE_TTL,
+)
 from workflow.automation.lib.schedulers.bash import Bash
 from workflow.automation.lib.schedulers.pbs import Pbs
 from workflow.automation.lib.schedulers.slurm import Slurm
@@ -15,7 +18,11 @@ class Scheduler:
 
     @classmethod
     def initialise_scheduler(
-        cls, user: str, account: str = None, logger: Logger = get_basic_logger()
+        cls,
+        user: str,
+        account: str = None,
+        logger: Logger = get_basic_logger(),
+        queue_ttl: float = QUEUE_TTL,
     ):
         if cls.__scheduler is not None:
             raise RuntimeError("Scheduler already initialised")
@@ -33,14 +40,24 @@ class Scheduler:
                 current_machine=host,
                 logger=logger,
                 platform_accounts=platform_accounts,
+                queue_ttl=queue_ttl,
             )
         elif scheduler == "pbs":
             cls.__scheduler = Pbs(
-                user=user, account=account, current_machine=host, logger=logger
+                user=user,
+                account=account,
+                current_machine=host,
+                logger=logger,
+                queue_ttl=queue_ttl,
             )
         else:
+            # Checking the bash "queue" is free, so it is never cached
             cls.__scheduler = Bash(
-                user=user, account=account, current_machine=host, logger=logger
+                user=user,
+                account=account,
+                current_machine=host,
+                logger=logger,
+                queue_ttl=0,
             )
         cls.__scheduler.logger.debug("Scheduler initialised")
 
@@ -1,38 +1,56 @@
+import os
+import re
 from logging import Logger
-from typing import Dict
+from typing import Dict, List, Tuple
 from os.path import join
-from datetime import timedelta
+from datetime import datetime, timedelta
 
-from qcore.constants import ProcessType, timestamp
+from qcore.constants import ProcessType, TIMESTAMP_FORMAT, timestamp
 
 from workflow.automation.lib.MgmtDB import SchedulerTask
 from workflow.automation.lib.schedulers.abstractscheduler import AbstractScheduler
 from workflow.automation.platform_config import HPC, get_target_machine
 
 
+# The id array elements report to the mgmt db, in the jobid_index format squeue and sacct use for them
+ARRAY_ELEMENT_ID = "${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}"
+# Header lines that differ between the elements of an array job, and so aren't part of its resources
+ARRAY_ELEMENT_OPTIONS = [
+    "--job-name",
+    "-J",
+    "--output",
+    "-o",
+    "--error",
+    "-e",
+    "--time",
+    "-t",
+]
+# A pending array job is shown by squeue as jobid_[indices], e.g. 1234_[3-5,7%2]
+ARRAY_PENDING_PATTERN = re.compile(r"^(\d+)_\[([\d,\-]+)(%\d+)?\]$")
+
+SACCT_METADATA_FORMAT = (
+    "'jobid%20,jobname%35,Submit,Start,End,NCPUS,CPUTimeRAW%18,State,Nodelist%60'"
+)
+
+
 class Slurm(AbstractScheduler):
     STATUS_DICT = {"R": 3, "PD": 2, "CG": 3}
     SCRIPT_EXTENSION = "sl"
     QUEUE_NAME = "squeue"
+    QUEUED_STATE = "PD"
     HEADER_TEMPLATE = "slurm_header.cfg"
+    SUPPORTS_ARRAY_JOBS = True
+    # Slurms default MaxArraySize is 1001, so indices up to 1000
+    MAX_ARRAY_SIZE = 1000
 
-    def check_queues(self, user: bool = False, target_machine: HPC = None):
-        self.logger.debug(
-            f"Checking queues for machine {target_machine}{f' and user {self.user_name}' if user else ''}."
-        )
+    def _query_queue(self, target_machine: HPC = None):
+        target_machine = self._machine_key(target_machine)
+        self.logger.debug(f"Checking queues for machine {target_machine}.")
 
-        if target_machine is None:
-            target_machine = self.current_machine
-        if isinstance(self.account, dict):
-            account = self.account[target_machine.name]
-        else:
-            account = self.account
         accounts = ",".join(self.platform_accounts)
-        if user:
-            # user is True, so we use the same user as we use for submission
-            cmd = f"squeue -A {accounts} -o '%A %t' -M {target_machine.name} -u {self.user_name}"
-        else:
-            cmd = f"squeue -A {accounts} -o '%A %t' -M {target_machine.name}"
+        # Jobs of all users are requested, check_queues filters them for the user view
+        # %i gives array elements as jobid_index, matching the ids they are tracked with in the mgmt db
+        cmd = f"squeue -A {accounts} -o '%i %t %u' -M {target_machine}"
         self.logger.debug(f"Running squeue command: {cmd}")
         output, err = self._run_command_and_wait(cmd=[cmd], shell=True)
         self.logger.debug(f"Squeue got output: {output}")
@@ -44,7 +62,7 @@ class Slurm(AbstractScheduler):
         except Exception:
             message = f"squeue did not return expected output. Ignoring for this iteration. Actual output: {output}"
         else:
-            if header != "JOBID ST":
+            if header != "JOBID ST USER":
                 message = f"squeue did not return expected output. Ignoring for this iteration. Actual output: {output}"
 
         if message:
@@ -52,7 +70,31 @@ class Slurm(AbstractScheduler):
 
         output_list = list(filter(None, output.split("\n")[1:]))
         output_list.pop(0)
-        return output_list
+        jobs = []
+        for line in output_list:
+            job_id, state, user = line.split()
+            jobs.extend(
+                (element_id, state, user)
+                for element_id in self._expand_array_job_id(job_id)
+            )
+        return jobs
+
+    @staticmethod
+    def _expand_array_job_id(job_id: str) -> List[str]:
+        """Expands the pending elements of an array job, shown by squeue as a single jobid_[indices] line,
+        to the jobid_index of each element. Other job ids are returned as is"""
+        match = ARRAY_PENDING_PATTERN.match(job_id)
+        if match is None:
+            return [job_id]
+        array_job_id, indices, _ = match.groups()
+        element_ids = []
+        for index_range in indices.split(","):
+            start, _, end = index_range.partition("-")
+            element_ids.extend(
+                f"{array_job_id}_{index}"
+                for index in range(int(start), int(end or start) + 1)
+            )
+        return element_ids
 
     def check_wct_hit(self, job_id: int):
         """
@@ -75,6 +117,44 @@ class Slurm(AbstractScheduler):
         )
         return elapsed_time >= limit_time
 
+    def check_wct_hit_many(self, job_ids: List[int]) -> Dict[int, bool]:
+        """
+        Checks the given jobs if they have failed due to Wall Clock Time, with one sacct call per JOB_BATCH_SIZE jobs
+        :param job_ids: The ids of the jobs to be checked for wct
+        :return: Dictionary of job id to if the job has failed due to Wall Clock Time or not.
+        Jobs sacct has no wall clock time for are not included
+        """
+        wct_hits = {}
+        for batch in self._batch_job_ids(job_ids):
+            cmd = f"sacct -j {','.join(batch)} -X -o jobid,timelimit,elapsed -P -n"
+            output, err = self._run_command_and_wait(cmd=[cmd], shell=True)
+
+            for line in output.split():
+                job_id, time_limit, elapsed = line.split("|")
+                if job_id not in batch:
+                    continue
+                try:
+                    wct_hits[batch[job_id]] = self._parse_sacct_time(
+                        elapsed
+                    ) >= self._parse_sacct_time(time_limit)
+                except ValueError:
+                    self.logger.debug(
+                        f"Could not parse the wall clock time of job {job_id}: {line}"
+                    )
+        return wct_hits
+
+    @staticmethod
+    def _parse_sacct_time(sacct_time: str) -> timedelta:
+        """Parses a sacct duration in the [days-]hours:minutes:seconds format"""
+        days, _, hms = sacct_time.rpartition("-")
+        hours, minutes, seconds = hms.split(":")
+        return timedelta(
+            days=int(days or 0),
+            hours=int(hours),
+            minutes=int(minutes),
+            seconds=int(seconds),
+        )
+
     def submit_job(self, sim_dir, script_location, target_machine=None):
         """Submits the slurm script and updates the management db
         :param sim_dir:
@@ -83,17 +163,130 @@ class Slurm(AbstractScheduler):
             "Submitting {} on machine {}".format(script_location, target_machine)
         )
         f_name = f"%x_{timestamp}_%j"
-        if isinstance(self.account, dict):
-            account = self.account[target_machine]
-        else:
-            account = self.account
-        common_pre = f"sbatch -o {join(sim_dir, f'{f_name}.out')} -e {join(sim_dir, f'{f_name}.err')} -A {account}"
+        common_pre = f"sbatch -o {join(sim_dir, f'{f_name}.out')} -e {join(sim_dir, f'{f_name}.err')} -A {self._get_account(target_machine)}"
         if target_machine and target_machine != self.current_machine:
             mid = f"--export=CUR_ENV,CUR_HPC -M {target_machine}"
         else:
             mid = ""
         command = " ".join([common_pre, mid, script_location])
         self.logger.debug(f"Submitting command {command}")
+        jobid = self._sbatch(command)
+        self._add_to_queue_snapshot(jobid, target_machine)
+        return jobid
+
+    def submit_array_job(
+        self, elements: List[Tuple[str, str]], target_machine=None
+    ) -> List[str]:
+        """
+        Submits the scripts of tasks with the same resources as the elements of a single array job.
+        Each element runs its own script, with its output written to its own sim_dir.
+        The $SLURM_JOB_ID the scripts report to the mgmt db is replaced with the jobid_index of their element
+        :param elements: The (sim_dir, script_location) of each element, at most MAX_ARRAY_SIZE
+        :param target_machine: The machine to submit the array job to
+        :return: The jobid_index of each element, in the order of elements
+        """
+        self.logger.debug(
+            f"Submitting {len(elements)} scripts as an array job on machine {target_machine}"
+        )
+        header, time_limit = [], None
+        branches = []
+        for index, (sim_dir, script_location) in enumerate(elements):
+            with open(script_location) as script_file:
+                script = script_file.read()
+            script_header = self._get_header(script)
+            if index == 0:
+                header = [
+                    line
+                    for line in script_header
+                    if self._parse_header_line(line)[0] not in ARRAY_ELEMENT_OPTIONS
+                ]
+            job_name = os.path.basename(script_location).rsplit(".", 1)[0]
+            for line in script_header:
+                option, value = self._parse_header_line(line)
+                if option in ["--job-name", "-J"]:
+                    job_name = value
+                elif option in ["--time", "-t"] and (
+                    time_limit is None
+                    or self._parse_sacct_time(value)
+                    > self._parse_sacct_time(time_limit)
+                ):
+                    time_limit = value
+
+            with open(script_location, "w") as script_file:
+                script_file.write(script.replace("$SLURM_JOB_ID", ARRAY_ELEMENT_ID))
+            f_name = join(sim_dir, f"{job_name}_{timestamp}_{ARRAY_ELEMENT_ID}")
+            branches.append(
+                f'    {index}) bash {script_location} > "{f_name}.out" 2> "{f_name}.err" ;;'
+            )
+
+        # The array job runs for as long as its longest element
+        if time_limit is not None:
+            header.append(f"#SBATCH --time={time_limit}")
+        array_name = f"{os.path.basename(elements[0][1]).rsplit('.', 1)[0]}_array"
+        array_script = join(
+            os.path.dirname(elements[0][1]),
+            f"{array_name}_{datetime.now().strftime(TIMESTAMP_FORMAT)}.{self.SCRIPT_EXTENSION}",
+        )
+        with open(array_script, "w") as script_file:
+            script_file.write(
+                "\n".join(
+                    ["#!/bin/bash", f"#SBATCH --job-name={array_name}"]
+                    + header
+                    + ["", 'case "$SLURM_ARRAY_TASK_ID" in']
+                    + branches
+                    + ["esac", ""]
+                )
+            )
+
+        f_name = join(os.path.dirname(array_script), f"%x_{timestamp}_%A_%a")
+        command = f"sbatch --array=0-{len(elements) - 1} -o {f_name}.out -e {f_name}.err -A {self._get_account(target_machine)}"
+        if target_machine and target_machine != self.current_machine:
+            command += f" --export=CUR_ENV,CUR_HPC -M {target_machine}"
+        command = f"{command} {array_script}"
+        self.logger.debug(f"Submitting command {command}")
+        array_job_id = self._sbatch(command)
+
+        element_ids = [f"{array_job_id}_{index}" for index in range(len(elements))]
+        for element_id in element_ids:
+            self._add_to_queue_snapshot(element_id, target_machine)
+        return element_ids
+
+    def array_group_key(self, script_location: str) -> Tuple[str, ...]:
+        """The resources requested by the header of a script, other than the wall clock time.
+        Scripts with the same resources can be submitted as the elements of one array job"""
+        with open(script_location) as script_file:
+            header = self._get_header(script_file.read())
+        return tuple(
+            sorted(
+                line
+                for line in header
+                if self._parse_header_line(line)[0] not in ARRAY_ELEMENT_OPTIONS
+            )
+        )
+
+    @staticmethod
+    def _get_header(script: str) -> List[str]:
+        """The #SBATCH lines of a script"""
+        return [
+            line.strip()
+            for line in script.split("\n")
+            if line.strip().startswith("#SBATCH")
+        ]
+
+    @staticmethod
+    def _parse_header_line(line: str) -> Tuple[str, str]:
+        """The option and value of a #SBATCH header line, e.g. ('--ntasks', '40') for '#SBATCH --ntasks=40'"""
+        option, *value = re.split(r"[=\s]+", line[len("#SBATCH") :].strip(), maxsplit=1)
+        return option, value[0] if value else ""
+
+    def _get_account(self, target_machine=None):
+        if isinstance(self.account, dict):
+            return self.account[target_machine]
+        return self.account
+
+    def _sbatch(self, command: str) -> str:
+        """Runs an sbatch command
+        :return: The job id of the submitted job"""
         out, err = self._run_command_and_wait(cmd=[command], shell=True)
 
         if len(err) == 0 and out.startswith("Submitted"):
@@ -134,6 +327,7 @@ class Slurm(AbstractScheduler):
 
         if "error" not in out.lower() and "error" not in err.lower():
             self.logger.debug(f"Cancelled job-id {job_id} successfully")
+            self._clear_queue_snapshot(target_machine)
         else:
             raise self.raise_exception(
                 f"An error occurred during job cancellation: {err}"
@@ -173,9 +367,50 @@ class Slurm(AbstractScheduler):
         :return:
         """
         target_machine = get_target_machine(ProcessType(db_running_task.proc_type))
-        cmd = f"sacct -n -X -j {db_running_task.job_id} -M {target_machine} -o 'jobid%10,jobname%35,Submit,Start,End,NCPUS,CPUTimeRAW%18,State,Nodelist%60'"
+        cmd = f"sacct -n -X -j {db_running_task.job_id} -M {target_machine} -o {SACCT_METADATA_FORMAT}"
         out, err = self._run_command_and_wait(cmd, shell=True)
         output = out.strip().split()
+        return self._parse_metadata(output, task_logger)
+
+    def get_metadata_many(
+        self, db_running_tasks: List[SchedulerTask], task_logger: Logger
+    ):
+        """
+        Retrieves the metadata of the given tasks, with one sacct call per target machine and JOB_BATCH_SIZE jobs
+        :param db_running_tasks: The tasks to retrieve metadata for
+        :param task_logger: the logger for the tasks
+        :return: Dictionary of job id to the metadata tuple of the job
+        """
+        machine_tasks = {}
+        for db_running_task in db_running_tasks:
+            target_machine = get_target_machine(ProcessType(db_running_task.proc_type))
+            machine_tasks.setdefault(target_machine, []).append(db_running_task.job_id)
+
+        metadata = {}
+        for target_machine, job_ids in machine_tasks.items():
+            for batch in self._batch_job_ids(job_ids):
+                cmd = f"sacct -n -X -j {','.join(batch)} -M {target_machine} -o {SACCT_METADATA_FORMAT}"
+                out, err = self._run_command_and_wait(cmd, shell=True)
+                for line in out.strip().split("\n"):
+                    output = line.split()
+                    if len(output) > 0 and output[0] in batch:
+                        metadata[batch[output[0]]] = self._parse_metadata(
+                            output, task_logger
+                        )
+
+        for db_running_task in db_running_tasks:
+            if db_running_task.job_id not in metadata:
+                metadata[db_running_task.job_id] = self._parse_metadata([], task_logger)
+        return metadata
+
+    @staticmethod
+    def _parse_metadata(output: List[str], task_logger: Logger):
+        """
+        Parses the fields of a SACCT_METADATA_FORMAT sacct line
+        :param output: The whitespace separated fields of the line, empty if sacct had no line for the job
+        :param task_logger: the logger for the task
+        :return: start_time, end_time, run_time, n_cores, status
+        """
         # ['578928', 'u-bl689.atmos_main.18621001T0000Z', '2019-08-16T13:05:06', '2019-08-16T13:12:56', '2019-08-16T14:58:28', '1840', '11650880', 'CANCELLED+', 'nid00[166-171,180-196]']
         try:
             submit_time, start_time, end_time = [
@@ -1,16 +1,15 @@
 """
 Shared functions only used by the automated workflow
 """
-import json
-import os
-from datetime import datetime
+import threading
+from contextlib import contextmanager
 from logging import Logger
-from typing import List
+from typing import Dict, List, Set, Tuple
 
 import qcore.constants as const
 from qcore.utils import load_yaml
-from workflow.automation.lib.MgmtDB import MgmtDB
-from qcore.qclogging import get_basic_logger, NOPRINTCRITICAL
+from workflow.automation.lib.mgmt_db_queue import get_queue, make_entry
+from qcore.qclogging import get_basic_logger
 from workflow.automation.lib.schedulers.scheduler_factory import Scheduler
 
 ALL = "ALL"
@@ -18,6 +17,90 @@ ONCE = "ONCE"
 ONCE_PATTERN = "%_REL01"
 NONE = "NONE"
 
+# The ArraySubmission scripts submitted by each thread are deferred to, if any
+_array_submissions = threading.local()
+
+
+class ArraySubmission:
+    """Collects the scripts given to submit_script_to_scheduler, to submit those with the same
+    process type, target machine and resources as the elements of array jobs"""
+
+    def __init__(self, logger: Logger = get_basic_logger()):
+        self.logger = logger
+        # (proc_type, target_machine, resources) to the (script, queue_folder, sim_dir, run_name) of each task
+        self.groups: Dict[Tuple, List[Tuple[str, str, str, str]]] = {}
+
+    def add(
+        self,
+        script: str,
+        proc_type: int,
+        queue_folder: str,
+        sim_dir: str,
+        run_name: str,
+        target_machine: str = None,
+    ):
+        key = (
+            proc_type,
+            target_machine,
+            Scheduler.get_scheduler().array_group_key(script),
+        )
+        self.groups.setdefault(key, []).append(
+            (script, queue_folder, sim_dir, run_name)
+        )
+
+    def submit(self):
+        """Submits the collected scripts, as array jobs of at most MAX_ARRAY_SIZE elements.
+        Groups of a single task are submitted as normal jobs"""
+        scheduler = Scheduler.get_scheduler()
+        groups, self.groups = self.groups, {}
+        for (proc_type, target_machine, _), tasks in groups.items():
+            for i in range(0, len(tasks), scheduler.MAX_ARRAY_SIZE):
+                array_tasks = tasks[i : i + scheduler.MAX_ARRAY_SIZE]
+                if len(array_tasks) == 1:
+                    script, _, sim_dir, _ = array_tasks[0]
+                    job_ids = [scheduler.submit_job(sim_dir, script, target_machine)]
+                else:
+                    self.logger.info(
+                        f"Submitting {len(array_tasks)} {const.ProcessType(proc_type).str_value} tasks as an array job"
+                    )
+                    job_ids = scheduler.submit_array_job(
+                        [(sim_dir, script) for script, _, sim_dir, _ in array_tasks],
+                        target_machine,
+                    )
+                for (_, queue_folder, _, run_name), job_id in zip(array_tasks, job_ids):
+                    add_to_queue(
+                        queue_folder,
+                        run_name,
+                        proc_type,
+                        const.Status.queued.value,
+                        job_id=job_id,
+                        logger=self.logger,
+                    )
+
+
+@contextmanager
+def array_submission(logger: Logger = get_basic_logger()):
+    """
+    Defers the scripts given to submit_script_to_scheduler by this thread until the end of the context,
+    to then submit them as array jobs. Each element is tracked in the mgmt db with its own job id.
+    Scripts are submitted individually if the scheduler doesn't support array jobs
+    """
+    if not Scheduler.get_scheduler().SUPPORTS_ARRAY_JOBS:
+        logger.warning(
+            f"The {Scheduler.get_scheduler().QUEUE_NAME} scheduler does not support array jobs, submitting tasks individually"
+        )
+        yield
+        return
+
+    submission = ArraySubmission(logger)
+    _array_submissions.current = submission
+    try:
+        yield
+    finally:
+        # Tasks whose scripts were written are still submitted if a later task failed
+        _array_submissions.current = None
+        submission.submit()
+
 
 def submit_script_to_scheduler(
     script: str,
@@ -30,6 +113,7 @@ def submit_script_to_scheduler(
 ):
     """
     Submits the slurm script and updates the management db.
+    Within an array_submission context the submission is deferred to the end of the context.
     Calling the scheduler submitter may result in an error being raised.
     This is not caught in order to get immediate attention of broken runs.
     :param sim_dir:
@@ -41,6 +125,14 @@ def submit_script_to_scheduler(
     :param logger:
     :return:
     """
+    submission = getattr(_array_submissions, "current", None)
+    if submission is not None:
+        logger.debug(f"Deferring the submission of {script} to an array job")
+        submission.add(
+            script, proc_type, queue_folder, sim_dir, run_name, target_machine
+        )
+        return
+
     job_id = Scheduler.get_scheduler().submit_job(sim_dir, script, target_machine)
 
     add_to_queue(
@@ -74,71 +166,41 @@ def add_to_queue(
             run_name, proc_type, status, job_id, error
         )
     )
-    filename = os.path.join(
-        queue_folder,
-        "{}.{}.{}".format(
-            datetime.now().strftime(const.QUEUE_DATE_FORMAT), run_name, proc_type
+    get_queue(queue_folder).add(
+        make_entry(
+            run_name,
+            proc_type,
+            status,
+            job_id=job_id,
+            error=error,
+            start_time=start_time,
+            end_time=end_time,
+            nodes=nodes,
+            cores=cores,
+            memory=memory,
+            wct=wct,
         ),
+        logger=logger,
     )
 
-    if os.path.exists(filename):
-        logger.log(
-            NOPRINTCRITICAL,
-            "An update with the name {} already exists. This should never happen. Quitting!".format(
-                os.path.basename(filename)
-            ),
-        )
-        raise Exception(
-            "An update with the name {} already exists. This should never happen. Quitting!".format(
-                os.path.basename(filename)
-            )
-        )
-
-    logger.debug("Writing update file to {}".format(filename))
-
-    with open(filename, "w") as f:
-        json.dump(
-            {
-                MgmtDB.col_run_name: run_name,
-                MgmtDB.col_proc_type: proc_type,
-                MgmtDB.col_status: status,
-                MgmtDB.col_job_id: job_id,
-                "error": error,
-                MgmtDB.col_queued_time: int(datetime.now().timestamp()),
-                MgmtDB.col_start_time: start_time,
-                MgmtDB.col_end_time: end_time,
-                MgmtDB.col_nodes: nodes,
-                MgmtDB.col_cores: cores,
-                MgmtDB.col_memory: memory,
-                MgmtDB.col_wct: wct,
-            },
-            f,
-        )
-
-    if not os.path.isfile(filename):
-        logger.critical("File {} did not successfully write".format(filename))
-    else:
-        logger.debug("Successfully wrote task update file")
-
 
 def check_mgmt_queue(
-    queue_entries: List[str], run_name: str, proc_type: int, logger=get_basic_logger()
+    pending_updates: Set[Tuple[str, int]],
+    run_name: str,
+    proc_type: int,
+    logger=get_basic_logger(),
 ):
     """Returns True if there are any queued entries for this run_name and process type,
     otherwise returns False.
+    :param pending_updates: The pending updates, as given by mgmt_db_queue.get_pending_updates
     """
-    logger.debug(
-        "Checking to see if the realisation {} has a process of type {} in updates folder".format(
-            run_name, proc_type
+    if (run_name, proc_type) in pending_updates:
+        logger.debug(
+            "The realisation {} has a process of type {} in the updates queue".format(
+                run_name, proc_type
+            )
         )
-    )
-    for entry in queue_entries:
-        logger.debug("Checking against {}".format(entry))
-        _, entry_run_name, entry_proc_type = entry.split(".")
-        if entry_run_name == run_name and entry_proc_type == str(proc_type):
-            logger.debug("It's a match, returning True")
-            return True
-    logger.debug("No match found")
+        return True
     return False
 
 
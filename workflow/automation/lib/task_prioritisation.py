@@ -0,0 +1,278 @@
+"""Ordering of the runnable tasks of auto_submit, so the free slots of each machine go to the tasks
+that get realisations finished soonest.
+
+Policies are functions taking the runnable (proc_type, run_name, retries) tasks and the TaskPrioritiser,
+and returning the tasks in the order they should be submitted. New policies are added to PRIORITY_POLICIES.
+"""
+import heapq
+from dataclasses import dataclass
+from logging import Logger
+from typing import Callable, Dict, List, Tuple
+
+from qcore import shared, utils
+import qcore.constants as const
+from qcore.qclogging import get_basic_logger
+import qcore.simulation_structure as sim_struct
+
+from workflow.automation.lib.MgmtDB import MgmtDB
+from workflow.automation.lib.shared import get_hf_nt
+from workflow.automation.platform_config import platform_config
+
+# The run time (hours) used for process types without any completed jobs to take the mean of
+DEFAULT_RUN_TIME = 1.0
+# The cores used for the default core hours of process types without any completed jobs
+DEFAULT_N_CORES = 1
+# Non fifo policies choose from this many times as many runnable tasks as there are free slots
+CANDIDATE_FACTOR = 10
+
+Task = Tuple[int, str, int]
+
+
+@dataclass
+class TaskEstimate:
+    core_hours: float
+    # Hours
+    run_time: float
+
+
+def _est_emod3d(params):
+    import workflow.automation.estimation.estimate_wct as est
+
+    nt = int(float(params.sim_duration) / float(params.dt))
+    fd_count = len(shared.get_stations(params.FD_STATLIST))
+    core_hours, run_time, _ = est.est_LF_chours_single(
+        int(params.nx),
+        int(params.ny),
+        int(params.nz),
+        nt,
+        fd_count,
+        platform_config[const.PLATFORM_CONFIG.LF_DEFAULT_NCORES.name],
+        True,
+    )
+    return core_hours, run_time
+
+
+def _est_hf(params):
+    from qcore import srf
+    import workflow.automation.estimation.estimate_wct as est
+
+    fd_count = len(shared.get_stations(params.FD_STATLIST))
+    nsub_stoch, _ = srf.get_nsub_stoch(params.hf.slip, get_area=True)
+    core_hours, run_time, _ = est.est_HF_chours_single(
+        fd_count,
+        nsub_stoch,
+        get_hf_nt(params),
+        platform_config[const.PLATFORM_CONFIG.HF_DEFAULT_NCORES.name],
+        True,
+    )
+    return core_hours, run_time
+
+
+def _est_bb(params):
+    import workflow.automation.estimation.estimate_wct as est
+
+    fd_count = len(shared.get_stations(params.FD_STATLIST))
+    return est.est_BB_chours_single(
+        fd_count,
+        get_hf_nt(params),
+        platform_config[const.PLATFORM_CONFIG.BB_DEFAULT_NCORES.name],
+    )
+
+
+# Process types with an estimate_wct model, estimated from the sim params of the realisation
+MODEL_ESTIMATES: Dict[int, Callable] = {
+    const.ProcessType.EMOD3D.value: _est_emod3d,
+    const.ProcessType.HF.value: _est_hf,
+    const.ProcessType.BB.value: _est_bb,
+}
+
+
+class TaskEstimator:
+    """
+    Estimates the core hours and run time of tasks.
+    Process types with an estimate_wct model use it with the sim params of the realisation,
+    all others (and those where the model can't be used) use the mean of their completed jobs in the mgmt db
+    """
+
+    def __init__(self, root_folder: str, logger: Logger = get_basic_logger()):
+        self.root_folder = root_folder
+        self.logger = logger
+        self._mean_usage: Dict[int, Tuple[float, float]] = {}
+        # The model estimates of each task, None where the model couldn't be used
+        self._model_estimates: Dict[Tuple[str, int], Tuple[float, float]] = {}
+
+    def refresh(self, mgmt_db: MgmtDB, allowed_rels: str = "%"):
+        """Updates the mean usage of each process type from the completed jobs in the mgmt db"""
+        self._mean_usage = mgmt_db.get_mean_job_usage(allowed_rels)
+
+    def mean_estimate(self, proc_type: int):
+        run_time, core_hours = self._mean_usage.get(
+            proc_type, (DEFAULT_RUN_TIME, DEFAULT_RUN_TIME * DEFAULT_N_CORES)
+        )
+        return TaskEstimate(core_hours, run_time)
+
+    def estimate(self, run_name: str, proc_type: int):
+        if proc_type in MODEL_ESTIMATES:
+            key = (run_name, proc_type)
+            if key not in self._model_estimates:
+                self._model_estimates[key] = self._model_estimate(run_name, proc_type)
+            if self._model_estimates[key] is not None:
+                return TaskEstimate(*self._model_estimates[key])
+        return self.mean_estimate(proc_type)
+
+    def _model_estimate(self, run_name: str, proc_type: int):
+        try:
+            params = utils.load_sim_params(
+                sim_struct.get_sim_params_yaml_path(
+                    sim_struct.get_sim_dir(self.root_folder, run_name)
+                ),
+                load_vm=proc_type == const.ProcessType.EMOD3D.value,
+            )
+            core_hours, run_time = MODEL_ESTIMATES[proc_type](params)
+        except Exception as e:
+            self.logger.debug(
+                f"Could not estimate {const.ProcessType(proc_type).str_value} of {run_name} "
+                f"with its estimation model, using the mean of completed jobs instead: {e}"
+            )
+            return None
+        return float(core_hours), float(run_time)
+
+
+def get_dependants(allowed_tasks: List[const.ProcessType]) -> Dict[int, List[int]]:
+    """Gets the process types directly depending on each process type, out of allowed_tasks.
+    Process types that are a dependency of any of the alternative dependency sets are included"""
+    dependants = {}
+    for proc in allowed_tasks:
+        for dependency in proc.dependencies:
+            for dependency_value in (
+                dependency if isinstance(dependency, tuple) else (dependency,)
+            ):
+                proc_dependants = dependants.setdefault(dependency_value, [])
+                if proc.value not in proc_dependants:
+                    proc_dependants.append(proc.value)
+    return dependants
+
+
+class TaskPrioritiser:
+    """Orders the runnable tasks of each auto_submit cycle with the given policy"""
+
+    def __init__(
+        self,
+        policy: str,
+        root_folder: str,
+        mgmt_db: MgmtDB,
+        allowed_tasks: List[const.ProcessType],
+        logger: Logger = get_basic_logger(),
+        estimator: TaskEstimator = None,
+    ):
+        if policy not in PRIORITY_POLICIES:
+            raise ValueError(
+                f"Unknown priority policy {policy}, must be one of {list(PRIORITY_POLICIES)}"
+            )
+        self.policy = policy
+        self.mgmt_db = mgmt_db
+        self.logger = logger
+        self.estimator = (
+            estimator if estimator is not None else TaskEstimator(root_folder, logger)
+        )
+        self.dependants = get_dependants(allowed_tasks)
+        self.in_progress_counts: Dict[str, int] = {}
+        self._downstream_times: Dict[int, float] = {}
+
+    def candidate_limit(self, n_slots: int):
+        """The number of runnable tasks to get from the mgmt db to fill n_slots free slots"""
+        if self.policy == "fifo":
+            return n_slots
+        return n_slots * CANDIDATE_FACTOR
+
+    def prioritise(self, tasks: List[Task], allowed_rels: str = "%") -> List[Task]:
+        """Orders the tasks by the policy, using the current state of the mgmt db"""
+        if self.policy == "fifo" or len(tasks) == 0:
+            return tasks
+        self.estimator.refresh(self.mgmt_db, allowed_rels)
+        self.in_progress_counts = self.mgmt_db.get_in_progress_counts(allowed_rels)
+        self._downstream_times = {}
+        prioritised = PRIORITY_POLICIES[self.policy](tasks, self)
+        self.logger.debug(
+            f"Ordered {len(prioritised)} runnable tasks by the {self.policy} policy"
+        )
+        return prioritised
+
+    def downstream_time(self, proc_type: int) -> float:
+        """The run time (hours) of the longest chain of tasks depending on proc_type,
+        using the mean run time of each process type"""
+        if proc_type not in self._downstream_times:
+            self._downstream_times[proc_type] = max(
+                (
+                    self.estimator.mean_estimate(dependant).run_time
+                    + self.downstream_time(dependant)
+                    for dependant in self.dependants.get(proc_type, [])
+                ),
+                default=0.0,
+            )
+        return self._downstream_times[proc_type]
+
+    def critical_path(self, run_name: str, proc_type: int) -> float:
+        """The run time (hours) of the task and the longest chain of tasks depending on it"""
+        return self.estimator.estimate(
+            run_name, proc_type
+        ).run_time + self.downstream_time(proc_type)
+
+
+def fifo(tasks: List[Task], prioritiser: TaskPrioritiser) -> List[Task]:
+    """The order tasks were created in"""
+    return tasks
+
+
+def shortest_job_first(tasks: List[Task], prioritiser: TaskPrioritiser) -> List[Task]:
+    """The fewest estimated core hours first, then the fewest retries"""
+    return sorted(
+        tasks,
+        key=lambda task: (
+            prioritiser.estimator.estimate(task[1], task[0]).core_hours,
+            task[2],
+        ),
+    )
+
+
+def critical_path_first(tasks: List[Task], prioritiser: TaskPrioritiser) -> List[Task]:
+    """The longest estimated run time to the end of the realisation first, then the fewest retries"""
+    return sorted(
+        tasks, key=lambda task: (-prioritiser.critical_path(task[1], task[0]), task[2])
+    )
+
+
+def fair_share_by_fault(tasks: List[Task], prioritiser: TaskPrioritiser) -> List[Task]:
+    """Takes tasks from each fault in turn, starting with the faults with the fewest tasks in progress.
+    Tasks of the same fault are kept in the order they were created in"""
+    fault_tasks: Dict[str, List[Task]] = {}
+    for task in tasks:
+        fault_tasks.setdefault(
+            sim_struct.get_fault_from_realisation(task[1]), []
+        ).append(task)
+    in_progress = {}
+    for run_name, count in prioritiser.in_progress_counts.items():
+        fault = sim_struct.get_fault_from_realisation(run_name)
+        in_progress[fault] = in_progress.get(fault, 0) + count
+
+    # (tasks in progress or ordered so far, order of first task, fault), ties go to the fault seen first
+    heap = [
+        (in_progress.get(fault, 0), index, fault)
+        for index, fault in enumerate(fault_tasks)
+    ]
+    heapq.heapify(heap)
+    ordered = []
+    while heap:
+        load, index, fault = heapq.heappop(heap)
+        ordered.append(fault_tasks[fault].pop(0))
+        if fault_tasks[fault]:
+            heapq.heappush(heap, (load + 1, index, fault))
+    return ordered
+
+
+PRIORITY_POLICIES: Dict[str, Callable[[List[Task], TaskPrioritiser], List[Task]]] = {
+    "fifo": fifo,
+    "sjf": shortest_job_first,
+    "critical_path": critical_path_first,
+    "fair_share": fair_share_by_fault,
+}
@@ -3,6 +3,7 @@
 This script is used after the workflow has been run to collect metadata and compile it all to a csv
 """
 import argparse
+from typing import List
 
 import numpy as np
 import pandas as pd
@@ -134,11 +135,11 @@ def add_db_stat(df: pd.DataFrame, rel_name: str, df_location: str, new_val: int)
 def get_rel_info(
     rel_name: str,
     root_dir: str,
-    db: MgmtDB,
-    ch_count_type: constants.ChCountType,
+    states: List[MgmtDB.CoreHourState],
 ):
     """
     Loads the given relisations info and populates the dataframe row
+    states are the realisations core hour states, from MgmtDB.get_core_hour_states_bulk
     """
     fault_name = simulation_structure.get_fault_from_realisation(rel_name)
     params = utils.load_sim_params(
@@ -163,32 +164,18 @@ def get_rel_info(
             value = params[v]
         df.loc[rel_name, k] = value
 
-    states = db.get_core_hour_states(rel_name, ch_count_type)
     resub_counter = dict()
     # DB Metadata
     for state in states:
-        # Get proc_type and job_id
-        _, _, proc_type, status, job_id, _ = state
-        proc_type_name = const.ProcessType(proc_type).str_value
-        if proc_type in METADATA_PROC_TYPES:
-            (
-                _,
-                _,
-                queued_time,
-                start_time,
-                end_time,
-                nodes,
-                cores,
-                memory,
-                WCT,
-            ) = db.get_job_duration_info(job_id)
+        proc_type_name = const.ProcessType(state.proc_type).str_value
+        if state.proc_type in METADATA_PROC_TYPES:
             # Add runtime and cores to df
-            runtime = end_time - start_time
+            runtime = state.end_time - state.start_time
             df.loc[rel_name, f"{proc_type_name}_runtime"] += runtime / 60
-            df = add_db_stat(df, rel_name, f"{proc_type_name}_cores", cores)
+            df = add_db_stat(df, rel_name, f"{proc_type_name}_cores", state.cores)
             # Add to core hours
-            df.loc[rel_name, f"{proc_type_name}_core_hours"] += cores * runtime / 3600
-            df.loc[rel_name, f"Total_core_hours"] += cores * runtime / 3600
+            df.loc[rel_name, f"{proc_type_name}_core_hours"] += state.core_hours
+            df.loc[rel_name, f"Total_core_hours"] += state.core_hours
             # Add to resubmits dict
             if resub_counter.get(proc_type_name) is None:
                 resub_counter[proc_type_name] = 0
@@ -253,6 +240,9 @@ def main():
     # Generate dataframe
     db = MgmtDB.MgmtDB(f"{root_dir}/slurm_mgmt.db")
     rel_names = db.get_rel_names()
+    rel_states = {}
+    for state in db.get_core_hour_states_bulk(ch_count_type):
+        rel_states.setdefault(state.run_name, []).append(state)
     df = pd.DataFrame(
         columns=COLUMNS, data=np.zeros(shape=(len(rel_names), len(COLUMNS)))
     )
@@ -260,9 +250,9 @@ def main():
     df.index.name = "Rel_name"
     for ix, name_tuple in enumerate(rel_names):
         rel_name = name_tuple[0]
-        df.loc[rel_name] = get_rel_info(rel_name, root_dir, db, ch_count_type).loc[
-            rel_name
-        ]
+        df.loc[rel_name] = get_rel_info(
+            rel_name, root_dir, rel_states.get(rel_name, [])
+        ).loc[rel_name]
     df.to_csv(output_ffp)
 
 
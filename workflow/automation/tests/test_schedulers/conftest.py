@@ -0,0 +1,34 @@
+from logging import getLogger
+
+import pytest
+
+from workflow.automation.lib.schedulers.slurm import Slurm
+
+
+@pytest.fixture
+def make_slurm():
+    """Makes Slurm schedulers that record the commands they would run in their commands list.
+    Commands starting with a key of outputs get its value as output, all others get default_output"""
+
+    def make_slurm(default_output: str = "", outputs: dict = None, **kwargs):
+        scheduler = Slurm(
+            user="test_user",
+            account="nesi00213",
+            current_machine="maui",
+            logger=getLogger("test_schedulers"),
+            **kwargs,
+        )
+        scheduler.commands = []
+
+        def run_command(cmd, shell=True):
+            command = cmd[0] if isinstance(cmd, list) else cmd
+            scheduler.commands.append(command)
+            for prefix, output in (outputs or {}).items():
+                if command.startswith(prefix):
+                    return output, ""
+            return default_output, ""
+
+        scheduler._run_command_and_wait = run_command
+        return scheduler
+
+    return make_slurm
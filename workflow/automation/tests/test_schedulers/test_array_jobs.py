@@ -0,0 +1,56 @@
+from workflow.automation.lib.schedulers.slurm import ARRAY_ELEMENT_ID
+
+SQUEUE_OUTPUT = """CLUSTER: maui
+JOBID ST USER
+1001 R test_user
+1002_0 R test_user
+1002_[2-4,7%2] PD test_user
+"""
+
+SCRIPT = """#!/bin/bash
+#SBATCH --job-name=sim_hf.{run_name}
+#SBATCH --ntasks=80
+#SBATCH --time={time}
+#SBATCH --hint=nomultithread
+
+## END HEADER
+wct={time}
+python add_to_mgmt_queue.py queue {run_name} HF running $SLURM_JOB_ID
+"""
+
+
+def test_check_queues_array_elements(make_slurm):
+    slurm = make_slurm(SQUEUE_OUTPUT)
+    assert slurm.check_queues() == [
+        "1001 R",
+        "1002_0 R",
+        "1002_2 PD",
+        "1002_3 PD",
+        "1002_4 PD",
+        "1002_7 PD",
+    ]
+
+
+def test_submit_array_job(make_slurm, tmp_path):
+    slurm = make_slurm("Submitted batch job 1003 on cluster maui")
+    elements = []
+    for run_name, time in [("rel_01", "01:00:00"), ("rel_02", "02:30:00")]:
+        sim_dir = tmp_path / run_name
+        sim_dir.mkdir()
+        script = sim_dir / f"run_hf_{run_name}.sl"
+        script.write_text(SCRIPT.format(run_name=run_name, time=time))
+        elements.append((str(sim_dir), str(script)))
+
+    # The wall clock time doesn't stop tasks sharing an array job
+    assert slurm.array_group_key(elements[0][1]) == slurm.array_group_key(
+        elements[1][1]
+    )
+    assert slurm.submit_array_job(elements) == ["1003_0", "1003_1"]
+    assert "--array=0-1" in slurm.commands[0]
+
+    array_script = open(slurm.commands[0].split()[-1]).read()
+    assert "#SBATCH --ntasks=80" in array_script
+    assert "#SBATCH --time=02:30:00" in array_script
+    assert f"1) bash {elements[1][1]}" in array_script
+    # The elements report their jobid_index to the mgmt db
+    assert f"running {ARRAY_ELEMENT_ID}" in open(elements[0][1]).read()
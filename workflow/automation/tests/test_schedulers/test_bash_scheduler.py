@@ -0,0 +1,117 @@
+import time
+from logging import getLogger
+
+import pytest
+
+from qcore.constants import ProcessType
+
+from workflow.automation.lib.MgmtDB import SchedulerTask
+from workflow.automation.lib.schedulers import bash
+from workflow.automation.lib.schedulers.bash import Bash
+from workflow.automation.lib.schedulers.scheduler_factory import Scheduler
+from workflow.automation.platform_config import get_platform_specific_script
+
+SCRIPT = """#!/bin/bash
+#SBATCH --job-name=test_job
+#SBATCH --ntasks={n_tasks}
+#SBATCH --time={time}
+
+echo $SLURM_JOB_ID $SLURM_NTASKS > job_env.txt
+{command}
+"""
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    monkeypatch.setattr(bash, "POLL_INTERVAL", 0.05)
+    return Bash(
+        "test_user",
+        "nesi00213",
+        "local",
+        getLogger("test_bash_scheduler"),
+        max_cores=2,
+        max_memory=1024,
+    )
+
+
+def write_script(tmp_path, name, command, n_tasks=1, wct="00:01:00"):
+    sim_dir = tmp_path / name
+    sim_dir.mkdir()
+    script = sim_dir / f"{name}.sh"
+    script.write_text(SCRIPT.format(n_tasks=n_tasks, time=wct, command=command))
+    return str(sim_dir), str(script)
+
+
+def wait_for_queue(scheduler, n_jobs, timeout=10):
+    start = time.time()
+    while len(scheduler.check_queues()) > n_jobs:
+        assert time.time() - start < timeout
+        time.sleep(0.05)
+
+
+def test_concurrency_limit(scheduler, tmp_path):
+    job_ids = [
+        scheduler.submit_job(*write_script(tmp_path, f"job_{i}", "sleep 0.5"))
+        for i in range(3)
+    ]
+    # Only two single core jobs fit on the two cores
+    assert scheduler.check_queues() == [
+        f"{job_ids[0]} R",
+        f"{job_ids[1]} R",
+        f"{job_ids[2]} PD",
+    ]
+    wait_for_queue(scheduler, 0)
+
+    assert (tmp_path / "job_2" / "job_env.txt").read_text() == f"{job_ids[2]} 1\n"
+    start_time, end_time, run_time, n_cores, status = scheduler.get_metadata(
+        SchedulerTask("job_2", 4, 3, job_ids[2], None), scheduler.logger
+    )
+    assert status == "COMPLETED"
+    assert n_cores == 1.0
+    assert run_time >= 0.5
+    assert not scheduler.check_wct_hit(job_ids[2])
+
+
+def test_wct_and_cancel(scheduler, tmp_path):
+    timed_out = scheduler.submit_job(
+        *write_script(tmp_path, "timed_out", "sleep 30", wct="00:00:01")
+    )
+    cancelled = scheduler.submit_job(
+        *write_script(tmp_path, "cancelled", "sleep 30", n_tasks=2)
+    )
+    failed = scheduler.submit_job(*write_script(tmp_path, "failed", "exit 3"))
+    # The failed job can exit before the queue is checked, so only its final state is checked.
+    # The two core job stays queued behind the timed out job either way
+    assert [
+        job for job in scheduler.check_queues() if not job.startswith(f"{failed} ")
+    ] == [
+        f"{timed_out} R",
+        f"{cancelled} PD",
+    ]
+
+    scheduler.cancel_job(cancelled)
+    wait_for_queue(scheduler, 0)
+
+    assert scheduler.check_wct_hit(timed_out)
+    assert scheduler._jobs[failed].exit_code == 3
+    statuses = {
+        job_id: scheduler.get_metadata(
+            SchedulerTask("rel", 4, 3, job_id, None), scheduler.logger
+        )[-1]
+        for job_id in [timed_out, cancelled, failed]
+    }
+    assert statuses == {
+        timed_out: "TIMEOUT",
+        cancelled: "CANCELLED",
+        failed: "FAILED",
+    }
+
+
+def test_platform_specific_script(scheduler, monkeypatch):
+    monkeypatch.setattr(Scheduler, "get_scheduler", lambda: scheduler)
+    script = get_platform_specific_script(
+        ProcessType.clean_up,
+        {"sim_dir": "/tmp/rel", "srf_name": "rel"},
+        {"time": "00:10:00"},
+    )
+    assert script.endswith(f"clean_up.{Bash.SCRIPT_EXTENSION} /tmp/rel rel")
@@ -0,0 +1,46 @@
+import qcore.constants as const
+
+from workflow.automation.lib.MgmtDB import SchedulerTask
+
+SACCT_WCT_OUTPUT = """1001|01:00:00|01:00:00
+1002|1-00:00:00|02:30:00
+1003|UNLIMITED|00:10:00
+"""
+
+SACCT_METADATA_OUTPUT = """      1001 sim_hf.PangopangoF29_HYP01-10_S1244 2019-08-16T13:05:06 2019-08-16T13:12:56 2019-08-16T14:58:28       80            1000 COMPLETED nid00[166-171]
+      1002 sim_hf.PangopangoF29_HYP02-10_S1254 2019-08-16T13:05:06 2019-08-16T13:12:56 2019-08-16T14:58:28       40            2000 TIMEOUT nid00[172-180]
+"""
+
+
+def test_check_wct_hit_many(make_slurm):
+    slurm = make_slurm(SACCT_WCT_OUTPUT)
+    assert slurm.check_wct_hit_many([1001, 1002, 1003, 1004]) == {
+        1001: True,
+        1002: False,
+    }
+    assert len(slurm.commands) == 1
+    assert "-j 1001,1002,1003,1004 " in slurm.commands[0]
+
+
+def test_get_metadata_many(make_slurm):
+    slurm = make_slurm(SACCT_METADATA_OUTPUT)
+    tasks = [
+        SchedulerTask(run_name, const.ProcessType.HF.value, 3, job_id, None)
+        for run_name, job_id in [
+            ("PangopangoF29_HYP01-10_S1244", 1001),
+            ("PangopangoF29_HYP02-10_S1254", 1002),
+            ("PangopangoF29_HYP03-10_S1264", 1003),
+        ]
+    ]
+    metadata = slurm.get_metadata_many(tasks, slurm.logger)
+    assert len(slurm.commands) == 1
+    assert metadata[1001] == (
+        "2019-08-16_13:12:56",
+        "2019-08-16_14:58:28",
+        12.5,
+        80.0,
+        "COMPLETED",
+    )
+    assert metadata[1002][2:] == (50.0, 40.0, "TIMEOUT")
+    # Jobs sacct doesn't know about are treated as cancelled
+    assert metadata[1003] == (0, 0, 0, 0.0, "CANCELLED")
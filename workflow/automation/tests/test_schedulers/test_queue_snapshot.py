@@ -0,0 +1,58 @@
+import pytest
+
+SQUEUE_OUTPUT = """CLUSTER: maui
+JOBID ST USER
+1001 R test_user
+1002 PD other_user
+"""
+
+
+@pytest.fixture
+def slurm(make_slurm):
+    return make_slurm(
+        SQUEUE_OUTPUT,
+        {"sbatch": "Submitted batch job 1003 on cluster maui", "scancel": ""},
+        queue_ttl=60,
+    )
+
+
+def test_check_queues_snapshot(slurm):
+    assert slurm.check_queues(user=False) == ["1001 R", "1002 PD"]
+    # The user view is served from the same squeue call
+    assert slurm.check_queues(user=True) == ["1001 R"]
+    assert len(slurm.commands) == 1
+    assert "-u" not in slurm.commands[0].split()
+
+    metrics = slurm.get_queue_metrics()["maui"]
+    assert metrics.queries == 1
+    assert metrics.cache_hits == 1
+
+    # Submitted jobs are added to the snapshot rather than forcing a new query
+    slurm.submit_job("/tmp", "test.sl")
+    assert slurm.check_queues(user=True) == ["1001 R", "1003 PD"]
+    assert len(slurm.commands) == 2
+
+    # Cancelling a job forces the next check to query squeue
+    slurm.cancel_job(1003)
+    slurm.check_queues(user=True)
+    assert len(slurm.commands) == 4
+    assert slurm.get_queue_metrics()["maui"].queries == 2
+
+
+def test_check_queues_errors_not_cached(slurm):
+    slurm._run_command_and_wait = lambda cmd, shell=True: ("", "squeue failed")
+    for _ in range(2):
+        with pytest.raises(EnvironmentError):
+            slurm.check_queues()
+    metrics = slurm.get_queue_metrics()["maui"]
+    assert metrics.queries == 2
+    assert metrics.errors == 2
+
+
+def test_check_queues_max_age(slurm):
+    slurm.check_queues()
+    slurm.check_queues(max_age=60)
+    assert len(slurm.commands) == 1
+    # A snapshot older than max_age is queried again, even within the queue ttl
+    slurm.check_queues(max_age=0)
+    assert len(slurm.commands) == 2
@@ -1,10 +1,19 @@
 import os
+import re
 import shutil
 import pytest
 
-from workflow.automation.lib.MgmtDB import connect_db_ctx, SchedulerTask
+from workflow.automation.lib.MgmtDB import (
+    connect_db_ctx,
+    get_connection,
+    MgmtDB,
+    SchedulerTask,
+    SCHEMA_VERSION,
+)
 from workflow.automation.install_scripts import create_mgmt_db
+from workflow.automation.lib.constants import ChCountType
 from qcore import utils
+import qcore.constants as const
 from qcore.qclogging import get_basic_logger
 
 TEST_DB_FILE = "./output/slurm_mgmt.db"
@@ -52,6 +61,16 @@ def test_insert_task(mgmt_db):
     assert len(get_rows(mgmt_db.db_file, "state", "proc_type", TEST_PROC[0])) == 2
 
 
+def test_insert_tasks(mgmt_db):
+    new_tasks = [("bulk_rel", proc_type) for proc_type in range(1, INIT_DB_ROWS + 1)]
+    assert mgmt_db.insert_tasks(new_tasks + new_tasks[:2]) == (INIT_DB_ROWS, 2)
+    # Reinstalling skips tasks that are not failed
+    assert mgmt_db.populate(["bulk_rel"]) == (0, INIT_DB_ROWS)
+    assert len(get_rows(mgmt_db.db_file, "state", "run_name", "bulk_rel")) == (
+        INIT_DB_ROWS
+    )
+
+
 def test_update_live_db(mgmt_db):
     mgmt_db.update_entries_live(
         [SchedulerTask(TEST_RUN_NAME, TEST_PROC[0], TEST_STATUS[0], None, None)],
@@ -65,5 +84,265 @@ def test_update_live_db(mgmt_db):
     mgmt_db.close_conn()
 
 
+def test_get_runnable_tasks(mgmt_db):
+    completed = [
+        const.ProcessType(proc_type)
+        for (proc_type,) in get_rows(
+            mgmt_db.db_file,
+            "state",
+            "status",
+            const.Status.completed.value,
+            selected_col="proc_type",
+        )
+    ]
+    runnable_tasks = mgmt_db.get_runnable_tasks(TEST_RUN_NAME, None, set())
+    assert len(runnable_tasks) > 0
+    for proc_type, run_name, retries in runnable_tasks:
+        assert run_name == TEST_RUN_NAME
+        assert retries == mgmt_db.get_retries(proc_type, run_name)
+        assert (
+            len(const.ProcessType(proc_type).get_remaining_dependencies(completed)) == 0
+        )
+
+    proc_type, run_name, _ = runnable_tasks[0]
+    waiting = mgmt_db.get_runnable_tasks(TEST_RUN_NAME, None, {(run_name, proc_type)})
+    assert (proc_type, run_name) not in [task[:2] for task in waiting]
+    assert len(mgmt_db.get_runnable_tasks(TEST_RUN_NAME, 1, set())) == 1
+
+
+def test_cascading_failure(mgmt_db):
+    run_name = "cascade_rel"
+    completed = [
+        const.ProcessType.EMOD3D,
+        const.ProcessType.merge_ts,
+        const.ProcessType.HF,
+        const.ProcessType.BB,
+        const.ProcessType.IM_calculation,
+        const.ProcessType.IM_plot,
+    ]
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        cur.executemany(
+            "INSERT INTO state(run_name, proc_type, status, job_id) VALUES (?, ?, ?, ?)",
+            [
+                (run_name, proc.value, const.Status.completed.value, proc.value)
+                for proc in completed
+            ]
+            + [
+                (
+                    run_name,
+                    const.ProcessType.plot_ts.value,
+                    const.Status.created.value,
+                    None,
+                )
+            ],
+        )
+
+    assert mgmt_db.update_entries_live(
+        [
+            SchedulerTask(
+                run_name,
+                const.ProcessType.EMOD3D.value,
+                const.Status.failed.value,
+                const.ProcessType.EMOD3D.value,
+            )
+        ],
+        2,
+    )
+    mgmt_db.close_conn()
+
+    statuses = {}
+    for proc_type, status in get_rows(
+        mgmt_db.db_file, "state", "run_name", run_name, "proc_type, status"
+    ):
+        statuses.setdefault(const.ProcessType(proc_type), []).append(status)
+    # The failure cascades through the completed tasks that depend on it
+    for proc in [
+        const.ProcessType.merge_ts,
+        const.ProcessType.BB,
+        const.ProcessType.IM_calculation,
+        const.ProcessType.IM_plot,
+    ]:
+        assert statuses[proc] == [const.Status.failed.value]
+    assert statuses[const.ProcessType.HF] == [const.Status.completed.value]
+    assert statuses[const.ProcessType.plot_ts] == [const.Status.created.value]
+    # The failed task is retried
+    assert sorted(statuses[const.ProcessType.EMOD3D]) == [
+        const.Status.created.value,
+        const.Status.failed.value,
+    ]
+
+
+def test_get_core_hour_states_bulk(mgmt_db):
+    run_name = "core_hours_rel"
+    # job_id, proc_type, status, last_modified
+    tasks = [
+        (1000, const.ProcessType.EMOD3D, const.Status.completed, 5),
+        (1001, const.ProcessType.EMOD3D, const.Status.failed, 10),
+        (1002, const.ProcessType.EMOD3D, const.Status.completed, 20),
+        (1003, const.ProcessType.HF, const.Status.killed_WCT, 15),
+        (1004, const.ProcessType.HF, const.Status.completed, 30),
+    ]
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        for job_id, proc_type, status, last_modified in tasks:
+            cur.execute(
+                "INSERT INTO state(run_name, proc_type, status, job_id, last_modified) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (run_name, proc_type.value, status.value, job_id, last_modified),
+            )
+            cur.execute(
+                "INSERT INTO job_duration_log(job_id, start_time, end_time, cores) "
+                "VALUES (?, 0, 3600, 40)",
+                (job_id,),
+            )
+
+    for ch_count_type, expected_jobs in [
+        # Only the tasks after the last failure are needed
+        (ChCountType.Needed, [1002, 1003, 1004]),
+        (ChCountType.Actual, [1000, 1002, 1003, 1004]),
+    ]:
+        states = mgmt_db.get_core_hour_states_bulk(ch_count_type, run_name)
+        assert sorted(state.job_id for state in states) == expected_jobs
+        assert sorted(
+            state[4] for state in mgmt_db.get_core_hour_states(run_name, ch_count_type)
+        ) == sorted(state.job_id for state in states)
+        assert all(state.core_hours == 40 for state in states)
+
+
+def test_add_retries(mgmt_db):
+    run_name = "retry_rel"
+    failed = const.Status.failed.value
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        cur.executemany(
+            "INSERT INTO state(run_name, proc_type, status) VALUES (?, ?, ?)",
+            [
+                (run_name, const.ProcessType.HF.value, failed),
+                (run_name, const.ProcessType.BB.value, failed),
+                (run_name, const.ProcessType.BB.value, failed),
+                (run_name, const.ProcessType.EMOD3D.value, failed),
+                (run_name, const.ProcessType.EMOD3D.value, const.Status.created.value),
+                (run_name, const.ProcessType.IM_calculation.value, failed),
+                (run_name, const.ProcessType.plot_ts.value, const.Status.created.value),
+            ],
+        )
+        # The counts follow updates and deletes as well
+        cur.execute(
+            "UPDATE state SET status = ? WHERE run_name = ? AND proc_type = ?",
+            (
+                const.Status.killed_WCT.value,
+                run_name,
+                const.ProcessType.IM_calculation.value,
+            ),
+        )
+        cur.execute(
+            "DELETE FROM state WHERE run_name = ? AND proc_type = ?",
+            (run_name, const.ProcessType.plot_ts.value),
+        )
+
+    mgmt_db.add_retries(2)
+    assert mgmt_db.get_retries(const.ProcessType.HF.value, run_name) == 2
+    assert mgmt_db.get_retries(const.ProcessType.BB.value, run_name) == 2
+    assert mgmt_db.get_retries(const.ProcessType.EMOD3D.value, run_name) == 2
+    # killed_WCT attempts are retried, but aren't counted by get_retries
+    assert mgmt_db.get_retries(const.ProcessType.IM_calculation.value, run_name) == 1
+    assert mgmt_db.get_retries(const.ProcessType.plot_ts.value, run_name) == 0
+
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        counted = cur.execute(
+            "SELECT run_name, proc_type, attempts, failures, not_failed FROM task_attempts "
+            "WHERE attempts + failures + not_failed > 0 ORDER BY run_name, proc_type"
+        ).fetchall()
+        recounted = cur.execute(
+            "SELECT run_name, proc_type, SUM(status != ?), SUM(status IN (?, ?)), SUM(status <= ?) "
+            "FROM state GROUP BY run_name, proc_type ORDER BY run_name, proc_type",
+            (
+                const.Status.killed_WCT.value,
+                const.Status.killed_WCT.value,
+                failed,
+                const.Status.completed.value,
+            ),
+        ).fetchall()
+    assert counted == recounted
+
+
+def test_array_job_ids(mgmt_db):
+    run_name = "array_rel"
+    proc_type = const.ProcessType.HF.value
+    mgmt_db.insert(run_name, proc_type)
+    # Array job elements are tracked by their jobid_index
+    for status in [
+        const.Status.queued.value,
+        const.Status.running.value,
+        const.Status.completed.value,
+    ]:
+        mgmt_db.update_entries_live(
+            [SchedulerTask(run_name, proc_type, status, "1001_3", None)],
+            get_basic_logger(),
+        )
+    assert get_rows(
+        mgmt_db.db_file, "state", "run_name", run_name, selected_col="status, job_id"
+    ) == [(const.Status.completed.value, "1001_3")]
+
+
+def test_connection_reuse(mgmt_db):
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        assert cur.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        cur.execute(
+            "INSERT INTO state(run_name, proc_type, status) VALUES (?, ?, ?)",
+            ("nested_ctx", TEST_PROC[0], 1),
+        )
+        with connect_db_ctx(mgmt_db.db_file) as nested_cur:
+            assert nested_cur.connection is cur.connection
+        # Only the outermost context commits
+        assert cur.connection.in_transaction
+    assert len(get_rows(mgmt_db.db_file, "state", "run_name", "nested_ctx")) == 1
+    assert mgmt_db.check_integrity() == []
+
+
+def test_query_plans(mgmt_db):
+    """The per task lookups have to stay index backed as the state table grows"""
+    # Recreate a db from before the indexes were added
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        cur.execute("DROP INDEX task_search")
+        cur.execute("PRAGMA user_version = 0")
+    assert mgmt_db.migrate() == SCHEMA_VERSION == mgmt_db.get_schema_version()
+
+    conn = get_connection(mgmt_db.db_file)
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        entry = SchedulerTask(TEST_RUN_NAME, TEST_PROC[0], FORCE_STATUS[0], None)
+        mgmt_db.get_retries(TEST_PROC[0], TEST_RUN_NAME)
+        mgmt_db.num_task_complete((TEST_PROC[0], TEST_RUN_NAME))
+        mgmt_db._check_dependancy_met((TEST_PROC[0], TEST_RUN_NAME))
+        mgmt_db.get_runnable_tasks(TEST_RUN_NAME, None, set())
+        mgmt_db.get_job_duration_info(1)
+        mgmt_db.add_retries(2)
+        with connect_db_ctx(mgmt_db.db_file) as cur:
+            MgmtDB._does_task_exists(cur, TEST_RUN_NAME, TEST_PROC[0])
+            MgmtDB.find_dependant_task(cur, entry)
+    finally:
+        conn.set_trace_callback(None)
+
+    statements = [
+        statement
+        for statement in statements
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE"))
+    ]
+    assert len(statements) > 0
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        for statement in statements:
+            plan = [row[-1] for row in cur.execute(f"EXPLAIN QUERY PLAN {statement}")]
+            for step in plan:
+                assert not step.startswith(
+                    ("SCAN state", "SCAN error", "SCAN job_duration_log")
+                ), f"{statement} does a full table scan: {plan}"
+            if re.search(r"run_name = ", statement) and re.search(
+                r"proc_type = ", statement
+            ):
+                assert any(
+                    "run_name=? AND proc_type=?" in step for step in plan
+                ), f"{statement} does not use the task index: {plan}"
+
+
 def teardown_module(module):
     shutil.rmtree(os.path.dirname(TEST_DB_FILE))
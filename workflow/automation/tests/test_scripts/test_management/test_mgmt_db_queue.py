@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+
+import qcore.constants as const
+
+from workflow.automation.lib.mgmt_db_queue import (
+    BACKENDS,
+    QueueWatcher,
+    create_queue,
+    get_pending_updates,
+    get_queue,
+    make_entry,
+)
+
+TEST_RUN_NAMES = ["PangopangoF29_HYP01-10_S1244", "PangopangoF29_HYP02-10_S1254"]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_queue_backend(tmp_path, backend):
+    create_queue(str(tmp_path), backend)
+    queue = get_queue(str(tmp_path))
+    assert queue.backend == backend
+
+    statuses = [const.Status.queued.value, const.Status.running.value]
+    for job_id, (run_name, status) in enumerate(zip(TEST_RUN_NAMES, statuses)):
+        queue.add(
+            make_entry(run_name, const.ProcessType.HF.value, status, job_id=job_id)
+        )
+
+    keys = queue.keys()
+    entries = queue.read()
+    assert keys == [key for key, _ in entries]
+    # Updates are read in the order they were added
+    assert [entry.run_name for _, entry in entries] == TEST_RUN_NAMES
+    assert [entry.status for _, entry in entries] == statuses
+    for key, entry in entries:
+        _, run_name, proc_type = key.split(".")
+        assert run_name == entry.run_name
+        assert proc_type == str(const.ProcessType.HF.value)
+
+    assert get_pending_updates(keys) == {
+        (run_name, const.ProcessType.HF.value) for run_name in TEST_RUN_NAMES
+    }
+
+    queue.remove(keys[:1])
+    assert queue.keys() == keys[1:]
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_queue_watcher(tmp_path, backend, use_inotify):
+    queue = create_queue(str(tmp_path), backend)
+    watcher = QueueWatcher(
+        queue, poll_interval=0.05, debounce=0.05, use_inotify=use_inotify
+    )
+    try:
+        assert not watcher.wait(0.2)
+
+        def add_updates():
+            for run_name in TEST_RUN_NAMES:
+                queue.add(
+                    make_entry(
+                        run_name,
+                        const.ProcessType.HF.value,
+                        const.Status.completed.value,
+                    )
+                )
+
+        adder = threading.Timer(0.1, add_updates)
+        adder.start()
+        assert watcher.wait(10)
+        adder.join()
+        # Reading the updates isn't a change
+        queue.read()
+        assert not watcher.wait(0.2)
+    finally:
+        watcher.close()
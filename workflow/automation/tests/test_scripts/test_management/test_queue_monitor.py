@@ -0,0 +1,92 @@
+from logging import getLogger
+
+import pytest
+
+import qcore.constants as const
+
+from workflow.automation.execution_scripts import queue_monitor
+from workflow.automation.lib.mgmt_db_queue import entry_to_task, make_entry
+
+RUN_NAME = "PangopangoF29_HYP01-10_S1244"
+# Submitted by auto_submit after the last scheduler check
+NEW_JOB_ID = 1003
+
+
+@pytest.fixture
+def rechecks(monkeypatch, init_scheduler):
+    """The results of each re-check of the scheduler, and the max_age of each re-check"""
+    results, max_ages = [], []
+
+    def get_queued_tasks(queue_logger, max_age=None):
+        max_ages.append(max_age)
+        return results.pop(0)
+
+    monkeypatch.setattr(queue_monitor, "get_queued_tasks", get_queued_tasks)
+    return results, max_ages
+
+
+def get_entries(status):
+    return [
+        (
+            f"1.{RUN_NAME}.{const.ProcessType.HF.value}",
+            entry_to_task(
+                RUN_NAME,
+                make_entry(
+                    RUN_NAME, const.ProcessType.HF.value, status, job_id=NEW_JOB_ID
+                ),
+            ),
+        )
+    ]
+
+
+def test_new_job_finished_update(rechecks):
+    results, max_ages = rechecks
+    logger = getLogger("test_queue_monitor")
+    entries = get_entries(const.Status.completed.value)
+
+    # The job is still in the scheduler queue, so the update waits for it to leave
+    results.append(({str(NEW_JOB_ID): "R"}, True))
+    updates, keys, waiting_for_exit, queued_tasks = queue_monitor.check_queue_updates(
+        entries, {}, True, logger
+    )
+    assert (updates, keys, waiting_for_exit) == ([], [], True)
+    assert queued_tasks == {str(NEW_JOB_ID): "R"}
+
+    # The scheduler couldn't be checked, so the update waits for the next scheduler check
+    results.append(({}, False))
+    updates, keys, waiting_for_exit, _ = queue_monitor.check_queue_updates(
+        entries, {}, True, logger
+    )
+    assert (updates, keys, waiting_for_exit) == ([], [], False)
+
+    # The job has left the scheduler queue
+    results.append(({}, True))
+    updates, keys, waiting_for_exit, _ = queue_monitor.check_queue_updates(
+        entries, queued_tasks, True, logger
+    )
+    assert updates == [entries[0][1]]
+    assert keys == [entries[0][0]]
+    assert not waiting_for_exit
+    assert max_ages == [queue_monitor.RECHECK_INTERVAL] * 3
+
+
+def test_no_recheck(rechecks):
+    _, max_ages = rechecks
+    logger = getLogger("test_queue_monitor")
+
+    # Queued and running updates don't need their job to have left the scheduler queue
+    entries = get_entries(const.Status.running.value)
+    updates, _, waiting_for_exit, _ = queue_monitor.check_queue_updates(
+        entries, {str(NEW_JOB_ID): "R"}, True, logger
+    )
+    assert updates == [entries[0][1]]
+    assert not waiting_for_exit
+
+    # The scheduler queue was just checked
+    entries = get_entries(const.Status.failed.value)
+    updates, _, waiting_for_exit, _ = queue_monitor.check_queue_updates(
+        entries, {str(NEW_JOB_ID): "R"}, False, logger
+    )
+    assert updates == []
+    assert waiting_for_exit
+    assert max_ages == []
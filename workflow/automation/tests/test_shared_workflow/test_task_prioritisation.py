@@ -0,0 +1,86 @@
+import pytest
+
+import qcore.constants as const
+
+from workflow.automation.install_scripts import create_mgmt_db
+from workflow.automation.lib.MgmtDB import connect_db_ctx
+from workflow.automation.lib.task_prioritisation import (
+    get_dependants,
+    TaskPrioritiser,
+)
+
+EMOD3D = const.ProcessType.EMOD3D.value
+HF = const.ProcessType.HF.value
+BB = const.ProcessType.BB.value
+IM_CALC = const.ProcessType.IM_calculation.value
+ALLOWED_TASKS = [
+    const.ProcessType.EMOD3D,
+    const.ProcessType.HF,
+    const.ProcessType.BB,
+    const.ProcessType.IM_calculation,
+]
+# proc_type, run time (hours), cores of the completed jobs
+COMPLETED_JOBS = [(EMOD3D, 10, 40), (HF, 2, 80), (BB, 1, 40), (IM_CALC, 0.5, 40)]
+RUNNABLE_TASKS = [
+    (HF, "FaultA_REL01", 0),
+    (EMOD3D, "FaultA_REL02", 0),
+    (IM_CALC, "FaultB_REL01", 1),
+    (BB, "FaultB_REL02", 0),
+]
+
+
+@pytest.fixture
+def mgmt_db(tmp_path):
+    mgmt_db = create_mgmt_db.create_mgmt_db([], str(tmp_path / "slurm_mgmt.db"))
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        for job_id, (proc_type, run_time, cores) in enumerate(COMPLETED_JOBS):
+            cur.execute(
+                "INSERT INTO state(run_name, proc_type, status, job_id) VALUES (?, ?, ?, ?)",
+                ("FaultC_REL01", proc_type, const.Status.completed.value, job_id),
+            )
+            cur.execute(
+                "INSERT INTO job_duration_log(job_id, start_time, end_time, cores) "
+                "VALUES (?, 0, ?, ?)",
+                (job_id, run_time * 3600, cores),
+            )
+        cur.execute(
+            "INSERT INTO state(run_name, proc_type, status) VALUES (?, ?, ?)",
+            ("FaultA_REL03", HF, const.Status.running.value),
+        )
+    return mgmt_db
+
+
+def get_prioritiser(policy, mgmt_db, tmp_path):
+    # There are no realisations in the root folder, so the estimates are the means of the completed jobs
+    return TaskPrioritiser(policy, str(tmp_path), mgmt_db, ALLOWED_TASKS)
+
+
+def test_get_dependants():
+    dependants = get_dependants(ALLOWED_TASKS)
+    assert dependants[EMOD3D] == [BB]
+    assert dependants[HF] == [BB]
+    assert dependants[BB] == [IM_CALC]
+    assert IM_CALC not in dependants
+
+
+@pytest.mark.parametrize(
+    ["policy", "expected"],
+    [
+        ("fifo", RUNNABLE_TASKS),
+        # 20, 400, 40 and 160 core hours
+        ("sjf", [RUNNABLE_TASKS[i] for i in [2, 3, 0, 1]]),
+        # 11.5, 3.5, 1.5 and 0.5 hours to the end of the realisation
+        ("critical_path", [RUNNABLE_TASKS[i] for i in [1, 0, 3, 2]]),
+        # FaultA already has a task in progress
+        ("fair_share", [RUNNABLE_TASKS[i] for i in [2, 0, 3, 1]]),
+    ],
+)
+def test_policies(mgmt_db, tmp_path, policy, expected):
+    prioritiser = get_prioritiser(policy, mgmt_db, tmp_path)
+    assert prioritiser.prioritise(list(RUNNABLE_TASKS)) == expected
+    assert prioritiser.candidate_limit(5) == (5 if policy == "fifo" else 50)
+
+
+def test_unknown_policy(mgmt_db, tmp_path):
+    with pytest.raises(ValueError):
+        get_prioritiser("lifo", mgmt_db, tmp_path)
@@ -0,0 +1,139 @@
+"""
+Writes the station waveforms and vsite checkpoints of a BB binary file.
+The file (header and size) must already be initialised by bb_sim.py.
+The vsite of a station is always written after its waveform,
+as a positive vsite marks the station as completed.
+"""
+import numpy as np
+
+from qcore import timeseries
+
+HEAD_SIZE = timeseries.BBSeis.HEAD_SIZE
+HEAD_STAT = timeseries.BBSeis.HEAD_STAT
+FLOAT_SIZE = 0x4
+N_COMP = 3
+# offset of vsite within the station header
+VSITE_OFFSET = 40
+
+
+class BBFileWriter:
+    """Writes each station as it is completed with independent posix writes"""
+
+    def __init__(self, out_file, nstat, bb_nt):
+        self.head_total = HEAD_SIZE + nstat * HEAD_STAT
+        self.bb_nt = bb_nt
+        self.bin_data = open(out_file, "r+b")
+
+    def write(self, stat_idx, bb_acc, vsite):
+        """
+        :param bb_acc: float32 array of shape (bb_nt, N_COMP)
+        :param vsite: float32 vsite of the station
+        """
+        self.bin_data.seek(
+            self.head_total + stat_idx * self.bb_nt * N_COMP * FLOAT_SIZE
+        )
+        bb_acc.tofile(self.bin_data)
+        # write vsite as used for checkpointing
+        self.bin_data.seek(HEAD_SIZE + stat_idx * HEAD_STAT + VSITE_OFFSET)
+        np.float32(vsite).tofile(self.bin_data)
+
+    def close(self):
+        self.bin_data.close()
+
+
+class BBMPIFileWriter:
+    """
+    Buffers io_batch stations and writes them through MPI-IO.
+
+    collective: each flush is two Write_at_all calls (waveforms, then vsites) through an
+        indexed file view, so the MPI library can aggregate the writes of all ranks.
+        Requires n_assigned, the number of stations this rank will write,
+        all ranks then flush the same number of times.
+    otherwise the buffered stations are written with independent Write_at calls,
+        as needed when stations are dispatched dynamically.
+
+    Creating and closing the writer are collective over comm.
+    """
+
+    def __init__(self, comm, out_file, nstat, bb_nt, io_batch=16, n_assigned=None):
+        from mpi4py import MPI
+
+        self._MPI = MPI
+        self.head_total = HEAD_SIZE + nstat * HEAD_STAT
+        self.bb_nt = bb_nt
+        self.io_batch = io_batch
+        self.collective = n_assigned is not None
+
+        self.n_rounds = 0
+        if self.collective:
+            # number of flushes every rank makes, including empty ones
+            self.n_rounds = comm.allreduce(-(-n_assigned // io_batch), op=MPI.MAX)
+
+        self.acc_buffer = np.empty((io_batch, bb_nt, N_COMP), dtype="f4")
+        self.vsite_buffer = np.empty(io_batch, dtype="f4")
+        self.idx_buffer = np.empty(io_batch, dtype=np.int64)
+        self.n_buffered = 0
+        self.n_flushed = 0
+
+        self.fh = MPI.File.Open(comm, out_file, MPI.MODE_WRONLY)
+
+    def write(self, stat_idx, bb_acc, vsite):
+        """
+        :param bb_acc: float32 array of shape (bb_nt, N_COMP)
+        :param vsite: float32 vsite of the station
+        """
+        self.acc_buffer[self.n_buffered] = bb_acc
+        self.vsite_buffer[self.n_buffered] = vsite
+        self.idx_buffer[self.n_buffered] = stat_idx
+        self.n_buffered += 1
+        if self.n_buffered == self.io_batch:
+            self.flush()
+
+    def _acc_offset(self, stat_idx):
+        return self.head_total + stat_idx * self.bb_nt * N_COMP * FLOAT_SIZE
+
+    @staticmethod
+    def _vsite_offset(stat_idx):
+        return HEAD_SIZE + stat_idx * HEAD_STAT + VSITE_OFFSET
+
+    def _write_collective(self, offsets, data, block_length):
+        MPI = self._MPI
+        if offsets.size:
+            # byte offsets, files can be larger than int displacements allow
+            filetype = MPI.FLOAT.Create_hindexed_block(
+                block_length, offsets.tolist()
+            ).Commit()
+        else:
+            filetype = MPI.FLOAT
+        self.fh.Set_view(0, MPI.FLOAT, filetype)
+        self.fh.Write_at_all(0, data)
+        if filetype is not MPI.FLOAT:
+            filetype.Free()
+
+    def flush(self):
+        """Writes the buffered stations. Collective if the writer is"""
+        # file views require increasing displacements
+        order = np.argsort(self.idx_buffer[: self.n_buffered])
+        idx = self.idx_buffer[order]
+        acc = self.acc_buffer[order]
+        vsite = self.vsite_buffer[order]
+
+        if self.collective:
+            self._write_collective(self._acc_offset(idx), acc, self.bb_nt * N_COMP)
+            self._write_collective(self._vsite_offset(idx), vsite, 1)
+            self.n_flushed += 1
+        else:
+            for i, stat_idx in enumerate(idx):
+                self.fh.Write_at(self._acc_offset(stat_idx), acc[i])
+            for i, stat_idx in enumerate(idx):
+                self.fh.Write_at(self._vsite_offset(stat_idx), vsite[i : i + 1])
+        self.n_buffered = 0
+
+    def close(self):
+        """Writes remaining stations and closes the file. Collective"""
+        if self.n_buffered or not self.collective:
+            self.flush()
+        # ranks with fewer stations take part in the remaining collective writes
+        while self.n_flushed < self.n_rounds:
+            self.flush()
+        self.fh.Close()
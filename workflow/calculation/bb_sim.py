@@ -4,14 +4,27 @@ Combines low frequency and high frequency seismograms.
 """
 
 from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import os
 import logging
+from logging.handlers import QueueHandler
+import queue
 import numpy as np
+from scipy.signal import butter, sosfiltfilt
 
 from qcore.siteamp_models import nt2n, cb_amp, ba18_amp, init_ba18
 from qcore import timeseries, utils
 from qcore.constants import VM_PARAMS_FILE_NAME, Components, PLATFORM_CONFIG
+from workflow.calculation.bb_output import BBFileWriter, BBMPIFileWriter
 from workflow.calculation.site_response_BB import site_response
+from workflow.calculation.station_dispatch import (
+    DISPATCH_MODES,
+    DISPATCH_STATIC,
+    StationDispatcher,
+    wait_for_ranks,
+)
 from workflow.automation import platform_config
 
 if __name__ == "__main__":
@@ -20,12 +33,88 @@ if __name__ == "__main__":
 
 N_COMPONENTS = 3
 
-ampdeamp = timeseries.ampdeamp
-bwfilter = timeseries.bwfilter
 HEAD_SIZE = timeseries.BBSeis.HEAD_SIZE
 HEAD_STAT = timeseries.BBSeis.HEAD_STAT
 FLOAT_SIZE = 0x4
 N_COMP = 3
+# cutoff shift applied by timeseries.bwfilter to match the power spectrum crossover
+BW_FREQ_SHIFT = {"highpass": 0.8956803352330285, "lowpass": 1.1164697500474103}
+
+
+def bwfilter_sos(dt, freq, band):
+    """
+    Second order sections of the 4th order Butterworth filter used by timeseries.bwfilter.
+    Computed once and reused for every station.
+    """
+    nyq = 1.0 / (2.0 * dt)
+    return butter(4, freq * BW_FREQ_SHIFT[band] / nyq, btype=band, output="sos")
+
+
+def bwfilter_components(acc, sos):
+    """Filters all components (columns) of acc at once, as timeseries.bwfilter does"""
+    return sosfiltfilt(sos, acc, axis=0, padtype=None)
+
+
+def ampdeamp_components(acc, ampf, work=None):
+    """
+    Amplifies all components (columns) of acc with one batched rfft/irfft,
+    as timeseries.ampdeamp does for a single component.
+    acc is not modified, so it may be a read only view such as a memmap.
+    :param ampf: amplification spectra, one row per component
+    :param work: reusable buffer of shape (2 * ampf.shape[1], components), allocated
+        if not given or not matching the shape or dtype needed
+    """
+    nt = acc.shape[0]
+    if work is None or work.shape[0] != 2 * ampf.shape[1] or work.dtype != acc.dtype:
+        work = np.empty((2 * ampf.shape[1], acc.shape[1]), dtype=acc.dtype)
+    # zero padded copy of acc, tapered 5% on the right using the hanning method
+    work[:nt] = acc
+    work[nt:] = 0
+    ntap = int(nt * 0.05)
+    work[nt - ntap : nt] *= np.hanning(ntap * 2 + 1)[ntap + 1 :, np.newaxis]
+
+    fourier = np.fft.rfft(work, axis=0)
+    # last value of fft is some identity value
+    fourier[:-1] *= ampf.T
+    return np.fft.irfft(fourier, axis=0)[:nt]
+
+
+class SiteAmpCache:
+    """
+    Bounded LRU cache of site amplification spectra, keyed by the station dependent
+    inputs of the amplification function (vref, vsite, vpga, pga).
+    With pga_bin set, spectra are only evaluated at multiples of pga_bin and
+    linearly interpolated in between, so stations with similar pga share them.
+    Cached spectra are read only.
+    """
+
+    def __init__(self, amp_function, dt, n2, maxsize=256, pga_bin=None, **kwargs):
+        self.amp_function = amp_function
+        self.dt = dt
+        self.n2 = n2
+        self.pga_bin = pga_bin
+        self.kwargs = kwargs
+        self._spectrum = lru_cache(maxsize=maxsize)(self._evaluate)
+
+    def _evaluate(self, vref, vsite, vpga, pga):
+        ampf = self.amp_function(
+            self.dt, self.n2, vref, vsite, vpga, pga, **self.kwargs
+        )
+        ampf.setflags(write=False)
+        return ampf
+
+    def __call__(self, vref, vsite, vpga, pga):
+        if not self.pga_bin:
+            return self._spectrum(vref, vsite, vpga, pga)
+        lower, weight = divmod(float(pga) / self.pga_bin, 1)
+        ampf = self._spectrum(vref, vsite, vpga, lower * self.pga_bin)
+        if weight == 0:
+            return ampf
+        upper = self._spectrum(vref, vsite, vpga, (lower + 1) * self.pga_bin)
+        return ampf + weight * (upper - ampf)
+
+    def cache_info(self):
+        return self._spectrum.cache_info()
 
 
 def args_parser(cmd=None):
@@ -66,6 +155,45 @@ def args_parser(cmd=None):
         ],
         nargs="?",
     )
+    arg(
+        "--opensees_workers",
+        help="number of OpenSees site response runs each rank keeps in progress. "
+        "Components and stations are run concurrently",
+        type=int,
+        default=1,
+    )
+    arg(
+        "--amp_cache_size",
+        help="number of site amplification spectra kept in the cache of each rank",
+        type=int,
+        default=256,
+    )
+    arg(
+        "--amp_pga_bin",
+        help="evaluate site amplification at multiples of this pga (g) and interpolate "
+        "in between. Off by default, only exactly matching inputs share spectra",
+        type=float,
+        default=None,
+    )
+    arg(
+        "--mpi_io",
+        help="write the output with MPI-IO, collectively unless --dispatch dynamic",
+        action="store_true",
+    )
+    arg(
+        "--io_batch",
+        help="number of stations buffered per MPI-IO write (--mpi_io only)",
+        type=int,
+        default=16,
+    )
+    arg(
+        "--dispatch",
+        help="""how stations are distributed across ranks
+        static: round-robin split before the simulation starts
+        dynamic: ranks claim the next station from a shared counter when they are free""",
+        choices=DISPATCH_MODES,
+        default=DISPATCH_STATIC,
+    )
 
     args = parser.parse_args(cmd)
     return args
@@ -112,18 +240,6 @@ def main():
         init_ba18()
         amp_function = ba18_amp
 
-    if args.no_lf_amp:
-
-        def ampdeamp_lf(series, *x, **y):
-            return series
-
-        def lf_amp_function(*x, **y):
-            pass
-
-    else:
-        ampdeamp_lf = ampdeamp
-        lf_amp_function = amp_function
-
     # load data stores
     lf = timeseries.LFSeis(args.lf_dir)
     hf = timeseries.HFSeis(args.hf_file)
@@ -191,11 +307,6 @@ def main():
     bb_nt = int(lf_start_padding + round(lf.duration / bb_dt) + lf_end_padding)
     n2 = nt2n(bb_nt)
 
-    lf_start_padding_ts = np.zeros(lf_start_padding)
-    hf_start_padding_ts = np.zeros(hf_start_padding)
-    lf_end_padding_ts = np.zeros(lf_end_padding)
-    hf_end_padding_ts = np.zeros(hf_end_padding)
-
     head_total = HEAD_SIZE + lf.stations.size * HEAD_STAT
     file_size = head_total + lf.stations.size * bb_nt * N_COMP * FLOAT_SIZE
     if args.flo is None:
@@ -376,57 +487,87 @@ def main():
                 initialise()
                 station_mask = np.ones(lf.stations.size, dtype=np.bool)
     station_mask = comm.bcast(station_mask, root=master)
-    stations_todo = hf.stations[station_mask][rank::size]
-    stations_todo_idx = np.arange(hf.stations.size)[station_mask][rank::size]
+    stations_todo_idx = StationDispatcher(
+        comm, np.arange(hf.stations.size)[station_mask], mode=args.dispatch
+    )
 
     # load container to write to
-    bin_data = open(args.out_file, "r+b")
-    bin_seek = head_total + stations_todo_idx * bb_nt * N_COMP * FLOAT_SIZE
-    bin_seek_vsite = HEAD_SIZE + stations_todo_idx * HEAD_STAT + 40
+    if args.mpi_io:
+        bb_output = BBMPIFileWriter(
+            comm,
+            args.out_file,
+            lf.stations.size,
+            bb_nt,
+            io_batch=args.io_batch,
+            n_assigned=stations_todo_idx.n_assigned,
+        )
+    else:
+        bb_output = BBFileWriter(args.out_file, lf.stations.size, bb_nt)
 
     # work on station subset
-    fmin = args.fmin
-    fmidbot = args.fmidbot
+    site_amp = SiteAmpCache(
+        amp_function,
+        bb_dt,
+        n2,
+        maxsize=args.amp_cache_size,
+        pga_bin=args.amp_pga_bin,
+        fmin=args.fmin,
+        fmidbot=args.fmidbot,
+        version=site_amp_version,
+    )
+    sos_highpass = bwfilter_sos(bb_dt, args.flo, "highpass")
+    sos_lowpass = bwfilter_sos(bb_dt, args.flo, "lowpass")
+    # OpenSees runs in worker threads, their log records are passed back to this thread
+    # so that only the main thread writes to the MPI log file
+    opensees_pool = ThreadPoolExecutor(max_workers=args.opensees_workers)
+    opensees_log_queue = queue.Queue()
+    opensees_logger = logging.getLogger(f"{logger.name}.opensees")
+    opensees_logger.propagate = False
+    opensees_logger.setLevel(logger.level)
+    opensees_logger.addHandler(QueueHandler(opensees_log_queue))
+    # stations waiting on OpenSees, by station index: component futures
+    opensees_pending = OrderedDict()
+
+    def finish_site_response(stat_idx):
+        """Waits for the OpenSees runs of a station and writes it"""
+        futures = opensees_pending.pop(stat_idx)
+        site_acc = np.empty((bb_nt, N_COMP), dtype="f4")
+        for c, future in enumerate(futures):
+            site_acc[:, c] = future.result() / 9.81
+        while not opensees_log_queue.empty():
+            logger.handle(opensees_log_queue.get())
+        # vsite is used for checkpointing
+        bb_output.write(stat_idx, site_acc, vs30s[stat_idx])
+
     t0 = MPI.Wtime()
+    # hf and lf are added into the padded sum, the padding is left as zeros
+    bb_sum = np.empty((bb_nt, N_COMP))
     bb_acc = np.empty((bb_nt, N_COMP), dtype="f4")
-    for i, stat in enumerate(stations_todo):
+    amp_work = np.empty((n2, N_COMP), dtype="f4")
+    for i, stat_idx in enumerate(stations_todo_idx):
+        stat = hf.stations[stat_idx]
         logger.debug(
-            f"Working on {stat.name}, {100*i/len(stations_todo):.2f}% complete"
+            f"Working on {stat.name}, {100*stations_todo_idx.progress:.2f}% complete"
         )
-        lf_acc = np.copy(lf.acc(stat.name, dt=bb_dt))
-        hf_acc = np.copy(hf.acc(stat.name, dt=bb_dt))
+        # used read only, hf_acc is a view of the memory mapped HF file if dt matches
+        lf_acc = lf.acc(stat.name, dt=bb_dt)
+        hf_acc = hf.acc(stat.name, dt=bb_dt)
+        if is_master and i == 0:
+            if (
+                hf_start_padding + hf_acc.shape[0] + hf_end_padding
+                != lf_start_padding + lf_acc.shape[0] + lf_end_padding
+            ):
+                logger.critical(
+                    "padded hf and lf have different number of timesteps, aborting. "
+                )
+                comm.Abort()
+
         station_yaml = os.path.join(str(args.site_response_dir), f"{stat.name}.yaml")
-        if args.site_response_dir and os.path.isfile(station_yaml):
+        site_specific = args.site_response_dir and os.path.isfile(station_yaml)
+        if site_specific:
             logger.debug(
                 f"Station {stat.name} has a site specific file. Running OpenSees"
             )
-            site_properties = site_response.SiteProp.from_file(station_yaml)
-            for c in range(N_COMPONENTS):
-                hf_filtered = bwfilter(
-                    hf_acc[:, c],
-                    bb_dt,
-                    args.flo,
-                    "highpass",
-                )
-                lf_filtered = bwfilter(
-                    lf_acc[:, c],
-                    bb_dt,
-                    args.flo,
-                    "lowpass",
-                )
-                hf_c = np.hstack((hf_start_padding_ts, hf_filtered, hf_end_padding_ts))
-                lf_c = np.hstack((lf_start_padding_ts, lf_filtered, lf_end_padding_ts))
-                bb_acc[:, c] = (
-                    site_response.deconvolve_timeseries_and_run_site_response(
-                        hf_c + lf_c,
-                        Components(c),
-                        site_properties,
-                        dt=bb_dt,
-                        logger=logger,
-                    )
-                    / 9.81
-                )
-
         else:
             if args.site_response_dir:
                 logger.debug(
@@ -437,74 +578,71 @@ def main():
                     f"Site specific response not being used. Running vs30 based amplification for {stat.name}"
                 )
             pga = np.max(np.abs(hf_acc), axis=0) / 981.0
-            # ideally remove loop # Could reduce to single components?
-            for c in range(N_COMPONENTS):
-                hf_amp_val = amp_function(
-                    bb_dt,
-                    n2,
-                    stat.vs,
-                    vs30s[stations_todo_idx[i]],
-                    stat.vs,
-                    pga[c],
-                    fmin=fmin,
-                    fmidbot=fmidbot,
-                    version=site_amp_version,
-                )
-                lf_amp_val = lf_amp_function(
-                    bb_dt,
-                    n2,
-                    lfvs30refs[stations_todo_idx[i]],
-                    vs30s[stations_todo_idx[i]],
-                    stat.vs,
-                    pga[c],
-                    fmin=fmin,
-                    fmidbot=fmidbot,
-                    version=site_amp_version,
-                )
-                hf_filtered = bwfilter(
-                    ampdeamp(
-                        hf_acc[:, c],
-                        hf_amp_val,
-                        amp=True,
-                    ),
-                    bb_dt,
-                    args.flo,
-                    "highpass",
+            # amplification spectra of all components, amplified in a single pass
+            hf_amp_val = np.stack(
+                [
+                    site_amp(stat.vs, vs30s[stat_idx], stat.vs, pga[c])
+                    for c in range(N_COMPONENTS)
+                ]
+            )
+            hf_acc = ampdeamp_components(hf_acc, hf_amp_val, amp_work)
+            if not args.no_lf_amp:
+                lf_amp_val = np.stack(
+                    [
+                        site_amp(lfvs30refs[stat_idx], vs30s[stat_idx], stat.vs, pga[c])
+                        for c in range(N_COMPONENTS)
+                    ]
                 )
-                lf_filtered = bwfilter(
-                    ampdeamp_lf(
-                        lf_acc[:, c],
-                        lf_amp_val,
-                        amp=True,
-                    ),
-                    bb_dt,
-                    args.flo,
-                    "lowpass",
+                lf_acc = ampdeamp_components(lf_acc, lf_amp_val, amp_work)
+
+        bb_sum.fill(0)
+        bb_sum[
+            hf_start_padding : hf_start_padding + hf_acc.shape[0]
+        ] += bwfilter_components(hf_acc, sos_highpass)
+        bb_sum[
+            lf_start_padding : lf_start_padding + lf_acc.shape[0]
+        ] += bwfilter_components(lf_acc, sos_lowpass)
+
+        if site_specific:
+            site_properties = site_response.SiteProp.from_file(station_yaml)
+            opensees_pending[stat_idx] = [
+                opensees_pool.submit(
+                    site_response.deconvolve_timeseries_and_run_site_response,
+                    bb_sum[:, c].copy(),
+                    Components(c),
+                    site_properties,
+                    dt=bb_dt,
+                    logger=opensees_logger,
                 )
-                hf_c = np.hstack((hf_start_padding_ts, hf_filtered, hf_end_padding_ts))
-                lf_c = np.hstack((lf_start_padding_ts, lf_filtered, lf_end_padding_ts))
-                if is_master and i == 0:
-                    if len(hf_c) != len(lf_c):
-                        logger.critical(
-                            "padded hf and lf have different number of timesteps, aborting. "
-                        )
-                        comm.Abort()
-                bb_acc[:, c] = (hf_c + lf_c) / 981.0
-
-        bin_data.seek(bin_seek[i])
-        bb_acc.tofile(bin_data)
-        # write vsite as used for checkpointing
-        bin_data.seek(bin_seek_vsite[i])
-        vs30s[stations_todo_idx[i]].tofile(bin_data)
-    bin_data.close()
+                for c in range(N_COMPONENTS)
+            ]
+            # keep enough runs queued to occupy the pool, finishing the oldest station
+            while len(opensees_pending) * N_COMPONENTS > 2 * args.opensees_workers:
+                finish_site_response(next(iter(opensees_pending)))
+        else:
+            np.divide(bb_sum, 981.0, out=bb_acc, casting="unsafe")
+            # vsite is used for checkpointing
+            bb_output.write(stat_idx, bb_acc, vs30s[stat_idx])
+    while opensees_pending:
+        finish_site_response(next(iter(opensees_pending)))
+    opensees_pool.shutdown()
+    bb_output.close()
 
     print("Process %03d of %03d finished (%.2fs)." % (rank, size, MPI.Wtime() - t0))
     logger.debug(
         "Process {} of {} completed {} stations ({:.2f}).".format(
-            rank, size, len(stations_todo), MPI.Wtime() - t0
+            rank, size, stations_todo_idx.n_processed, MPI.Wtime() - t0
+        )
+    )
+    amp_cache_info = site_amp.cache_info()
+    logger.debug(
+        "Rank {} site amplification cache hits {}, misses {}.".format(
+            rank, amp_cache_info.hits, amp_cache_info.misses
         )
     )
-    comm.Barrier()  # all ranks wait here until rank 0 arrives to announce all completed
+    # all ranks wait here until rank 0 arrives to announce all completed
+    wait_for_ranks(comm, logger)
+    stations_todo_idx.free()
     if is_master:
         logger.debug("Simulation completed.")
 
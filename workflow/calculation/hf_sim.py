@@ -3,16 +3,30 @@
 Simulates high frequency seismograms for stations.
 """
 from argparse import ArgumentParser
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from functools import lru_cache
 import os
 import random
 from subprocess import Popen, PIPE
 from tempfile import mkstemp
+import time
 
 import numpy as np
 import logging
 
 from qcore import binary_version, constants, utils
 from workflow.automation.platform_config import platform_config
+from workflow.calculation.station_dispatch import (
+    DISPATCH_MODES,
+    DISPATCH_STATIC,
+    StationDispatcher,
+    wait_for_ranks,
+)
 
 if __name__ == "__main__":
     from qcore import MPIFileHandler
@@ -52,6 +66,76 @@ def random_seed():
     return random.randrange(1_000_000, 9_999_999)
 
 
+@lru_cache(maxsize=None)
+def load_v1d_vs(v1d_path):
+    """Loads the vs (m/s) of the top layer of a 1D velocity model"""
+    with open(v1d_path, "r") as f:
+        f.readline()
+        return np.float32(float(f.readline().split()[2]) * 1000.0)
+
+
+class CheckpointWriter:
+    """
+    Buffers the e_dist and vs checkpoints of stations in the HF output header.
+    Whole station header records are written so that the records of stations
+    completed in index order can be coalesced into a single write.
+    Only records of stations added to this writer are ever written,
+    so ranks can share the output file.
+    """
+
+    def __init__(self, out_file, stations, max_stations=1, interval=0):
+        """
+        :param stations: lon, lat, name of all stations in the output file
+        :param max_stations: flush once this many stations are buffered
+        :param interval: flush if this many seconds passed since the last flush
+        """
+        self.records = np.zeros(
+            stations.size,
+            dtype={
+                "names": ["lon", "lat", "name", "e_dist", "vs"],
+                "formats": ["f4", "f4", "|S8", "f4", "f4"],
+                "itemsize": HEAD_STAT,
+            },
+        )
+        for column in ["lon", "lat", "name"]:
+            self.records[column] = stations[column]
+        self.max_stations = max_stations
+        self.interval = interval
+        self.pending = []
+        self.last_flush = time.time()
+        self.fd = os.open(out_file, os.O_WRONLY)
+
+    def add(self, idx_0, e_dist, vs):
+        """Buffers the checkpoints of the len(e_dist) stations starting at idx_0"""
+        idx = np.arange(idx_0, idx_0 + e_dist.size)
+        self.records["e_dist"][idx] = e_dist
+        self.records["vs"][idx] = vs
+        self.pending.extend(idx)
+        if (
+            len(self.pending) >= self.max_stations
+            or time.time() - self.last_flush >= self.interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered checkpoints, one write per run of consecutive stations"""
+        if self.pending:
+            idx = np.unique(self.pending)
+            # split where the next station is not adjacent to the previous one
+            for run in np.split(idx, np.flatnonzero(np.diff(idx) != 1) + 1):
+                os.pwrite(
+                    self.fd,
+                    self.records[run[0] : run[-1] + 1].tobytes(),
+                    HEAD_SIZE + run[0] * HEAD_STAT,
+                )
+            self.pending = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
 def args_parser(cmd=None):
     """
     CMD is a list of strings to parse
@@ -196,6 +280,40 @@ def args_parser(cmd=None):
         nargs=3,
         default=["1", "-1", "-1"],
     )
+    arg(
+        "--batch_size",
+        help="""number of consecutive stations simulated by each HF binary invocation
+        Batches are aligned to the station index and seeded from their first station.
+        Incompatible with --site_specific (forced to 1)""",
+        type=int,
+        default=1,
+    )
+    arg(
+        "--n_workers",
+        help="number of HF binaries run concurrently by each rank",
+        type=int,
+        default=1,
+    )
+    arg(
+        "--checkpoint_stations",
+        help="number of completed stations buffered before their checkpoints are written",
+        type=int,
+        default=16,
+    )
+    arg(
+        "--checkpoint_interval",
+        help="maximum time (seconds) completed stations are buffered before their checkpoints are written",
+        type=float,
+        default=60.0,
+    )
+    arg(
+        "--dispatch",
+        help="""how station batches are distributed across ranks
+        static: round-robin split before the simulation starts
+        dynamic: ranks claim the next batch from a shared counter when they are free""",
+        choices=DISPATCH_MODES,
+        default=DISPATCH_STATIC,
+    )
 
     args = parser.parse_args(cmd)
 
@@ -230,6 +348,16 @@ if __name__ == "__main__":
             logger.debug("seed from command line: {}".format(args.seed))
         assert args.seed >= 0  # don't like negative seed
 
+        if args.batch_size < 1 or args.n_workers < 1:
+            logger.error("--batch_size and --n_workers must be at least 1.")
+            comm.Abort(1)
+        if args.site_specific and args.batch_size > 1:
+            # each station needs its own v1d file, only one can be given per invocation
+            logger.warning(
+                "--site_specific requires --batch_size 1, ignoring batch size."
+            )
+            args.batch_size = 1
+
         # Logging each argument
         for key in vars(args):
             logger.debug("{} : {}".format(key, getattr(args, key)))
@@ -409,35 +537,24 @@ if __name__ == "__main__":
                 initialise()
                 station_mask = np.ones(stations.size, dtype=bool)
     station_mask = comm.bcast(station_mask, root=master)
-    stations_todo = stations[station_mask]
     stations_todo_idx = np.arange(stations.size)[station_mask]
 
-    def run_hf(
-        local_statfile, n_stat, idx_0, v1d_path=args.hf_vel_mod_1d, bin_mod=True
-    ):
+    def hf_stdin_template(bin_mod=True):
         """
-        Runs HF Fortran code.
+        Builds the HF Fortran input once, with None in the lines that change per invocation.
+        Returns the lines and the positions of the station file, seed, station count,
+        velocity model and (bin_mod only) seek byte lines.
         """
-        if args.seed >= 0:
-            assert n_stat == 1
-            seed = args.seed + idx_0
-        else:
-            seed = random_seed()
-
-        logger.info(
-            "run_hf({}, {}, {}) seed: {}".format(local_statfile, n_stat, idx_0, seed)
-        )
-
         hf_sim_args = [
             "",
             str(args.sdrop),
-            local_statfile,
+            None,  # station file
             args.out_file,
             "{:d} {}".format(len(args.rayset), " ".join(map(str, args.rayset))),
             str(int(not args.no_siteamp)),
             "{:d} {:d} {} {}".format(nbu, ift, flo, fhi),
-            str(seed),
-            str(n_stat),
+            None,  # seed
+            None,  # number of stations
             "{} {} {} {} {}".format(
                 args.duration, args.dt, args.fmax, args.kappa, args.qfexp
             ),
@@ -446,7 +563,7 @@ if __name__ == "__main__":
             ),
             "{} {}".format(args.mom, args.rupv),
             args.stoch_file,
-            v1d_path,
+            None,  # velocity model
             str(args.vs_moho),
             "{:d} {} {} {} {} {:d}".format(
                 nl_skip, vp_sig, vsh_sig, rho_sig, qs_sig, ic_flag
@@ -455,6 +572,7 @@ if __name__ == "__main__":
             "{} {} {}".format(args.fa_sig1, args.fa_sig2, args.rv_sig1),
             str(args.path_dur),
         ]
+        slots = [2, 7, 8, 13]
 
         # extra params needed for v6.0
         if utils.compare_versions(args.version, "6.0.3") >= 0:
@@ -474,29 +592,61 @@ if __name__ == "__main__":
                 and utils.compare_versions(args.version.split(".")[3], "4") == 0
             ):
                 hf_sim_args.append(str(args.dpath_pert))
-            hf_sim_args.append(str(head_total + idx_0 * (nt * N_COMP * FLOAT_SIZE)))
+            slots.append(len(hf_sim_args))
+            hf_sim_args.append(None)  # seek byte
 
         # add empty '' for extra \n at the end( needed as input)
         hf_sim_args.append("")
 
-        stdin = "\n".join(hf_sim_args)
+        return hf_sim_args, slots
+
+    hf_stdin_lines, hf_stdin_slots = hf_stdin_template()
+
+    def hf_stdin(local_statfile, n_stat, idx_0, v1d_path=args.hf_vel_mod_1d):
+        """
+        Fills in the HF Fortran input for the given stations.
+        """
+        if args.seed >= 0:
+            # the binary seeds once per invocation, batches start at a fixed station index
+            seed = args.seed + idx_0
+        else:
+            seed = random_seed()
+
+        logger.info(
+            "run_hf({}, {}, {}) seed: {}".format(local_statfile, n_stat, idx_0, seed)
+        )
+
+        hf_sim_args = list(hf_stdin_lines)
+        values = [local_statfile, str(seed), str(n_stat), v1d_path]
+        values.append(str(head_total + idx_0 * (nt * N_COMP * FLOAT_SIZE)))
+        for slot, value in zip(hf_stdin_slots, values):
+            hf_sim_args[slot] = value
 
-        logger.debug(stdin)
+        return "\n".join(hf_sim_args)
 
-        # run HF binary
+    def run_hf(stdin):
+        """
+        Runs HF Fortran code. Called from the worker threads, so must not log.
+        Returns the Fortran stderr, which contains the e_dist of each station.
+        """
         p = Popen([args.sim_bin], stdin=PIPE, stderr=PIPE, universal_newlines=True)
-        stderr = p.communicate(stdin)[1]
+        return p.communicate(stdin)[1]
 
-        # load vs
-        with open(v1d_path, "r") as f:
-            f.readline()
-            vs = np.float32(float(f.readline().split()[2]) * 1000.0)
+    def finish_hf(future, local_statfile, n_stat, idx_0, v1d_path):
+        """
+        Collects the result of a run_hf call and buffers the station checkpoints.
+        Failures are dumped to hf_err_{idx_0} and leave the stations unfinished.
+        Returns True if the run succeeded.
+        """
+        os.remove(local_statfile)
+        try:
+            stderr = future.result()
+        except OSError as e:
+            stderr = str(e)
 
         # e_dist is the only other variable that HF calculates
         e_dist = np.fromstring(stderr, dtype="f4", sep="\n")
-        try:
-            assert e_dist.size == n_stat
-        except AssertionError:
+        if e_dist.size != n_stat:
             logger.error(
                 "Expected {} e_dist values, got {}".format(n_stat, e_dist.size)
             )
@@ -504,47 +654,91 @@ if __name__ == "__main__":
 
             with open(f"hf_err_{idx_0}", "w") as e:
                 e.write(stderr)
-            comm.Abort(1)
+            return False
 
-        # write e_dist and vs to file
-        with open(args.out_file, "r+b") as out:
-            out.seek(HEAD_SIZE + idx_0 * HEAD_STAT)
-            for i in range(n_stat):
-                out.seek(HEAD_STAT - 2 * FLOAT_SIZE, 1)
-                e_dist[i].tofile(out)
-                vs.tofile(out)
+        # buffer e_dist and vs to be written to file
+        checkpoints.add(idx_0, e_dist, load_v1d_vs(v1d_path))
+        return True
 
-    # distribute work in a round-robin fashion across ranks for optimisation
+    # group stations into batches aligned to the station index so the seed of a batch
+    # does not depend on the number of ranks or which stations were already completed
+    # a batch containing any unfinished station is run again in full
+    batch_starts = np.unique(stations_todo_idx // args.batch_size) * args.batch_size
+
+    # distribute work across ranks, either statically in a round-robin fashion
     # if size=4, rank 0 takes [0,4,8...], rank 1 takes [1,5,9...], rank 2 takes [2,6,10...],
     # rank 3 takes [3,7,11...]
-    work = stations_todo[rank::size]
-    work_idx = stations_todo_idx[rank::size]
+    # or dynamically with each rank taking the next batch when it finishes the last
+    work_idx = StationDispatcher(comm, batch_starts, mode=args.dispatch)
 
     # process data to give Fortran code
+    # up to n_workers HF binaries run at once, each with its own station file
+    # MPI and logging calls stay on the main thread
     t0 = MPI.Wtime()
-    in_stats = mkstemp()[1]
-
-    v1d_path = args.hf_vel_mod_1d
-    for s in range(work.size):
-        if args.site_specific:
-            v1d_path = os.path.join(
-                args.site_v1d_dir, f"{work[s]['name'].decode('ascii')}.1d"
-            )
+    checkpoints = CheckpointWriter(
+        args.out_file,
+        stations,
+        max_stations=args.checkpoint_stations,
+        interval=args.checkpoint_interval,
+    )
+    n_done = 0
+    failed = []
+    running = {}
+
+    def collect(return_when):
+        """Finishes completed HF runs, returns the number of stations completed"""
+        n_stat_done = 0
+        done = wait(running, return_when=return_when)[0]
+        for future in done:
+            local_statfile, n_stat, idx_0, v1d_path = running.pop(future)
+            if finish_hf(future, local_statfile, n_stat, idx_0, v1d_path):
+                n_stat_done += n_stat
+            else:
+                failed.append(idx_0)
+        return n_stat_done
+
+    with ThreadPoolExecutor(max_workers=args.n_workers) as pool:
+        v1d_path = args.hf_vel_mod_1d
+        for idx_0 in work_idx:
+            n_stat = min(args.batch_size, stations.size - idx_0)
+            if args.site_specific:
+                v1d_path = os.path.join(
+                    args.site_v1d_dir, f"{stations[idx_0]['name'].decode('ascii')}.1d"
+                )
 
-        np.savetxt(
-            in_stats, work[s : s + 1], fmt="%f %f %s"
-        )  # making in_stats file with the list of one station work[s]
-        run_hf(
-            in_stats, 1, work_idx[s], v1d_path=v1d_path
-        )  # passing in_stat with the seed adjustment work_idx[s]
+            # The descriptor is closed straight away, so one isn't held open per batch
+            in_stats_fd, in_stats = mkstemp()
+            os.close(in_stats_fd)
+            np.savetxt(
+                in_stats, stations[idx_0 : idx_0 + n_stat], fmt="%f %f %s"
+            )  # making in_stats file with the list of stations in the batch
+            future = pool.submit(
+                run_hf, hf_stdin(in_stats, n_stat, idx_0, v1d_path=v1d_path)
+            )  # passing in_stat with the seed adjustment idx_0
+            running[future] = (in_stats, n_stat, idx_0, v1d_path)
+
+            if len(running) >= args.n_workers:
+                n_done += collect(FIRST_COMPLETED)
+        if running:
+            n_done += collect(ALL_COMPLETED)
+    checkpoints.close()
 
-    os.remove(in_stats)
     logger.debug(
         "Process {} of {} completed {} stations ({:.2f}).".format(
-            rank, size, work.size, MPI.Wtime() - t0
+            rank, size, n_done, MPI.Wtime() - t0
         )
     )
-    comm.Barrier()  # all ranks wait here until rank 0 arrives to announce all completed
+    if failed:
+        # completed stations are checkpointed, a rerun will only repeat the failures
+        logger.error(
+            "HF failed for the batches starting at stations {}, aborting.".format(
+                failed
+            )
+        )
+        comm.Abort(1)
+    # all ranks wait here until rank 0 arrives to announce all completed
+    wait_for_ranks(comm, logger)
+    work_idx.free()
     if is_master:
         actual_size = os.stat(args.out_file).st_size
         if actual_size != file_size:
@@ -576,7 +576,16 @@ set velocityFile $gMotion
 
 
 # timeseries object for force history
-set mSeries "Path -dt $motionDT -filePath $velocityFile -factor $cFactor"
+if { [file extension $velocityFile] == ".bin" } {
+    # raw little endian float64 values
+    set fp [open $velocityFile r]
+    fconfigure $fp -translation binary
+    binary scan [read $fp] q* motionValues
+    close $fp
+    set mSeries [list Path -dt $motionDT -values $motionValues -factor $cFactor]
+} else {
+    set mSeries "Path -dt $motionDT -filePath $velocityFile -factor $cFactor"
+}
 
 # loading object
 pattern Plain 10 $mSeries {
@@ -82,6 +82,11 @@ class SiteProp:
 
     name: str = ""  # Name of the station
 
+    # generated tcl, by number of time steps
+    _tcl_cache: typing.Dict[typing.Optional[int], str] = dataclasses.field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+
     @property
     def soil_thick(self):
         return sum(self.layerThick)
@@ -125,10 +130,19 @@ class SiteProp:
     def to_tcl(self, file_path, nt=None):
         """
         Writes the site properties in tcl format, as required by the site amplification code
+        The tcl is generated once per site and nt
         :param file_path: The path to write the file to
         :param nt: The number of time steps. Added for convenience.
             If more non-site parameters are needed, make a new file
         """
+        if nt not in self._tcl_cache:
+            self._tcl_cache[nt] = self._generate_tcl(nt)
+
+        with open(file_path, "w") as fp:
+            fp.write(self._tcl_cache[nt])
+
+    def _generate_tcl(self, nt=None):
+        """Generates the site properties in tcl format"""
 
         def list_to_tcl(val, offset=0):
             """Converts a list into tcl compatible array list format"""
@@ -168,8 +182,7 @@ array set voidR [list {list_to_tcl(self.voidR)}]
         if nt is not None:
             out_str += f"\nset motionSteps {nt}"
 
-        with open(file_path, "w") as fp:
-            fp.write(out_str)
+        return out_str
 
 
 class TimeOutError(Exception):
@@ -253,6 +266,7 @@ def deconvolve_timeseries_and_run_site_response(
     site_properties: SiteProp,
     dt=0.005,
     logger=qclogging.get_basic_logger(),
+    binary_io=True,
 ):
     """
     Deconvolves a surface waveform to a waveform at a given depth
@@ -262,6 +276,7 @@ def deconvolve_timeseries_and_run_site_response(
     :param site_properties: A SiteProp object for the location
     :param dt: The timestep for the given waveform
     :param logger: Logger to send messages to
+    :param binary_io: Pass the velocity to OpenSees as raw float64 instead of ascii
     :return: A waveform with site specific amplification applied. Has the same shape as waveform and units of m/s/s
     """
     size = acceleration_waveform.size
@@ -316,19 +331,28 @@ def deconvolve_timeseries_and_run_site_response(
 
     with tempfile.TemporaryDirectory() as td:
         td = pathlib.Path(td)
-        with tempfile.NamedTemporaryFile(dir=td) as file_name:
-            # File name doesn't matter for temp file
-            np.savetxt(file_name, bbgm_decon_vel)
-            params_path = td / "params.tcl"
-            site_properties.to_tcl(params_path, nt=size)
-            try:
-                out_file = call_opensees(file_name.name, params_path, td, logger=logger)
-            except RuntimeError as e:
-                logger.error(f"This didn't work: {component}, {site_properties.name}")
-                raise e
-            else:
-                # Acceleration in m/s/s
-                return np.loadtxt(out_file)
+        if binary_io:
+            # the .bin extension selects binary input in the tcl script
+            input_file = td / "velocity.bin"
+            bbgm_decon_vel.astype("<f8").tofile(input_file)
+        else:
+            input_file = td / "velocity.txt"
+            np.savetxt(input_file, bbgm_decon_vel)
+        params_path = td / "params.tcl"
+        site_properties.to_tcl(params_path, nt=size)
+        try:
+            out_file = call_opensees(input_file, params_path, td, logger=logger)
+        except RuntimeError as e:
+            logger.error(f"This didn't work: {component}, {site_properties.name}")
+            raise e
+        else:
+            # Acceleration in m/s/s, one value per line
+            return read_recorder_output(out_file)
+
+
+def read_recorder_output(out_file):
+    """Reads the single column output of an OpenSees recorder"""
+    return np.fromfile(out_file, sep=" ")
 
 
 def check_status(component_outdir, check_fail=False):
@@ -0,0 +1,112 @@
+"""
+Distributes stations (or batches of stations) across the ranks of an MPI simulation.
+"""
+import numpy as np
+
+DISPATCH_STATIC = "static"
+DISPATCH_DYNAMIC = "dynamic"
+DISPATCH_MODES = [DISPATCH_STATIC, DISPATCH_DYNAMIC]
+
+
+class StationDispatcher:
+    """Iterates over the work items assigned to the calling rank.
+
+    static: items are split in a round-robin fashion before any work starts.
+    dynamic: each rank claims the next item from a counter held in an MPI window on rank 0
+        when it is ready for more work, so ranks finishing early take on more items.
+
+    All ranks of comm must create the dispatcher and call free() when done.
+    """
+
+    def __init__(self, comm, items, mode=DISPATCH_STATIC):
+        from mpi4py import MPI
+
+        self._MPI = MPI
+        self.comm = comm
+        self.items = np.asarray(items)
+        self.mode = mode
+        # items given to this rank, and the position reached in items
+        self.n_processed = 0
+        self._position = 0
+
+        self._win = None
+        if self.mode == DISPATCH_DYNAMIC:
+            if comm.Get_rank() == 0:
+                self._counter = np.zeros(1, dtype="i8")
+                memory = self._counter
+            else:
+                memory = MPI.BOTTOM
+            self._win = MPI.Win.Create(memory, MPI.INT64_T.Get_size(), comm=comm)
+            self._one = np.ones(1, dtype="i8")
+            self._next = np.zeros(1, dtype="i8")
+        elif self.mode != DISPATCH_STATIC:
+            raise ValueError(
+                f"Unknown dispatch mode {self.mode}, must be one of {DISPATCH_MODES}"
+            )
+
+    def _claim(self):
+        """Atomically increments the shared counter and returns its previous value"""
+        self._win.Lock(0, self._MPI.LOCK_SHARED)
+        self._win.Fetch_and_op(self._one, self._next, 0, 0, self._MPI.SUM)
+        self._win.Unlock(0)
+        return int(self._next[0])
+
+    @property
+    def n_assigned(self):
+        """Number of items this rank will process, None if only known at the end (dynamic)"""
+        if self.mode == DISPATCH_DYNAMIC:
+            return None
+        return self.items[self.comm.Get_rank() :: self.comm.Get_size()].size
+
+    @property
+    def progress(self):
+        """Fraction of all items claimed so far (dynamic) or of this rank's items (static)"""
+        if self.mode == DISPATCH_DYNAMIC:
+            return self._position / max(self.items.size, 1)
+        return self.n_processed / max(self.n_assigned, 1)
+
+    def __iter__(self):
+        if self.mode == DISPATCH_STATIC:
+            for item in self.items[self.comm.Get_rank() :: self.comm.Get_size()]:
+                self.n_processed += 1
+                yield item
+        else:
+            while True:
+                self._position = self._claim()
+                if self._position >= self.items.size:
+                    break
+                self.n_processed += 1
+                yield self.items[self._position]
+
+    def free(self):
+        """Releases the MPI window. Collective over all ranks of comm"""
+        if self._win is not None:
+            self._win.Free()
+            self._win = None
+
+
+def wait_for_ranks(comm, logger):
+    """Waits for all ranks to finish, logging the time each rank spent idle.
+    The master additionally logs the idle time summed over all ranks.
+    Messages must not start with "Process " as that marks rank completion for aggregate_hf_logs.py
+
+    :return: The number of seconds this rank waited for the others
+    """
+    from mpi4py import MPI
+
+    t_idle = MPI.Wtime()
+    comm.Barrier()
+    idle = MPI.Wtime() - t_idle
+    logger.debug(
+        "Rank {} of {} idle for {:.2f}s waiting on other ranks.".format(
+            comm.Get_rank(), comm.Get_size(), idle
+        )
+    )
+    idle_times = comm.gather(idle, root=0)
+    if comm.Get_rank() == 0:
+        logger.debug(
+            "Total idle time over all ranks {:.2f}s, longest {:.2f}s.".format(
+                sum(idle_times), max(idle_times)
+            )
+        )
+    return idle
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the BB output modes of bb_sim.py on a synthetic station set.
+Writes a BB sized file with the posix writer and the MPI-IO writer (collective and independent)
+and reports the time taken by the slowest rank for each.
+Run with the same launcher and rank count as BB, eg:
+srun -n 80 python bench_bb_output.py /nesi/nobackup/.../bench --n_stations 10000 --nt 20000
+"""
+import argparse
+import os
+
+import numpy as np
+from mpi4py import MPI
+
+from workflow.calculation.bb_output import (
+    BBFileWriter,
+    BBMPIFileWriter,
+    HEAD_SIZE,
+    HEAD_STAT,
+    FLOAT_SIZE,
+    N_COMP,
+)
+from workflow.calculation.station_dispatch import (
+    DISPATCH_DYNAMIC,
+    DISPATCH_STATIC,
+    StationDispatcher,
+)
+
+
+def bench_mode(comm, out_file, n_stations, nt, mode, io_batch):
+    """Writes every station once in the given mode, returns the time of the slowest rank"""
+    file_size = (
+        HEAD_SIZE + n_stations * HEAD_STAT + n_stations * nt * N_COMP * FLOAT_SIZE
+    )
+    if comm.Get_rank() == 0:
+        with open(out_file, "wb") as out:
+            out.truncate(file_size)
+    comm.Barrier()
+
+    dispatch = DISPATCH_DYNAMIC if mode == "mpi_io_independent" else DISPATCH_STATIC
+    stations = StationDispatcher(comm, np.arange(n_stations), mode=dispatch)
+    acc = np.ones((nt, N_COMP), dtype="f4")
+
+    t0 = MPI.Wtime()
+    if mode == "posix":
+        writer = BBFileWriter(out_file, n_stations, nt)
+    else:
+        writer = BBMPIFileWriter(
+            comm,
+            out_file,
+            n_stations,
+            nt,
+            io_batch=io_batch,
+            n_assigned=stations.n_assigned,
+        )
+    for stat_idx in stations:
+        writer.write(stat_idx, acc, 500.0)
+    writer.close()
+    elapsed = MPI.Wtime() - t0
+
+    comm.Barrier()
+    stations.free()
+    if comm.Get_rank() == 0:
+        os.remove(out_file)
+    return comm.reduce(elapsed, op=MPI.MAX, root=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("out_dir", help="directory on the filesystem to benchmark")
+    parser.add_argument("--n_stations", type=int, default=2000)
+    parser.add_argument("--nt", type=int, default=20000)
+    parser.add_argument("--io_batch", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    out_file = os.path.join(args.out_dir, "bench_BB.bin")
+    size_gb = args.n_stations * args.nt * N_COMP * FLOAT_SIZE / 1e9
+    if comm.Get_rank() == 0:
+        print(
+            f"{args.n_stations} stations, nt {args.nt} ({size_gb:.2f} GB), "
+            f"{comm.Get_size()} ranks, io_batch {args.io_batch}"
+        )
+    for mode in ["posix", "mpi_io_collective", "mpi_io_independent"]:
+        times = [
+            bench_mode(comm, out_file, args.n_stations, args.nt, mode, args.io_batch)
+            for _ in range(args.repeats)
+        ]
+        if comm.Get_rank() == 0:
+            print(
+                f"{mode:>20}: best {min(times):.2f}s "
+                f"({size_gb / min(times):.2f} GB/s), mean {np.mean(times):.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,699 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the management db queries used each auto_submit cycle on a synthetic db.
+The db holds n_rels realisations with a state row for every process type,
+spread over the workflow stages so most created tasks are still waiting on dependencies.
+eg:
+python bench_mgmt_db.py runnable /tmp/bench --n_rels 5000
+python bench_mgmt_db.py populate /tmp/bench --n_rels 1000 5000 20000
+python bench_mgmt_db.py queue /nesi/nobackup/.../bench --n_updates 4000
+python bench_mgmt_db.py pending /tmp/bench --n_updates 0 1000 5000 20000
+python bench_mgmt_db.py wake /nesi/nobackup/.../bench --sleep_time 30
+python bench_mgmt_db.py completion /tmp/bench --sleep_time 30
+python bench_mgmt_db.py core_hours /tmp/bench --n_rels 20000
+python bench_mgmt_db.py retries /tmp/bench --n_rels 20000
+"""
+import argparse
+import getpass
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import qcore.constants as const
+import qcore.simulation_structure as sim_struct
+
+from workflow.automation.execution_scripts import queue_monitor
+from workflow.automation.lib.mgmt_db_queue import (
+    BACKENDS,
+    QueueWatcher,
+    create_queue,
+    get_pending_updates,
+    get_queue,
+    make_entry,
+)
+from workflow.automation.lib.constants import ChCountType
+from workflow.automation.lib.MgmtDB import (
+    MgmtDB,
+    close_connections,
+    connect_db_ctx,
+)
+from workflow.automation.lib.schedulers.scheduler_factory import Scheduler
+
+INIT_SCRIPT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "automation",
+    "install_scripts",
+    "slurm_mgmt.db.sql",
+)
+# Workflow order the synthetic realisations are completed in
+STAGES = [
+    const.ProcessType.VM_PARAMS,
+    const.ProcessType.VM_GEN,
+    const.ProcessType.VM_PERT,
+    const.ProcessType.INSTALL_FAULT,
+    const.ProcessType.EMOD3D,
+    const.ProcessType.HF,
+    const.ProcessType.BB,
+    const.ProcessType.IM_calculation,
+]
+
+
+def make_synthetic_db(db_file, n_rels, retry_fraction=0.05, seed=0):
+    """Creates a mgmt db with a row per realisation and process type.
+    Each realisation has completed a random number of STAGES, and retry_fraction of the
+    completed tasks have a failed attempt before them.
+    """
+    close_connections()
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    mgmt_db = MgmtDB.init_db(db_file, INIT_SCRIPT)
+    rng = random.Random(seed)
+
+    rows = []
+    for i in range(n_rels):
+        run_name = "Fault{}_REL{:02d}".format(i // 50, i % 50)
+        n_done = rng.randint(0, len(STAGES))
+        done = {proc.value for proc in STAGES[:n_done]}
+        for proc in const.ProcessType:
+            if proc.value in done:
+                if rng.random() < retry_fraction:
+                    rows.append((run_name, proc.value, const.Status.failed.value))
+                rows.append((run_name, proc.value, const.Status.completed.value))
+            else:
+                rows.append((run_name, proc.value, const.Status.created.value))
+
+    with connect_db_ctx(db_file) as cur:
+        cur.executemany(
+            "INSERT INTO state(run_name, proc_type, status, last_modified) "
+            "VALUES(?, ?, ?, strftime('%s','now'))",
+            rows,
+        )
+    return mgmt_db, len(rows)
+
+
+def legacy_get_runnable_tasks(mgmt_db, allowed_rels, task_limit, update_files):
+    """The previous implementation, pages through created tasks checking each one
+    with its own db connections"""
+    allowed_tasks = [str(task.value) for task in const.ProcessType]
+    tasks_waiting_for_updates = [
+        "{}__{}".format(*(entry.split(".")[1:3])) for entry in update_files
+    ]
+    runnable_tasks = []
+    offset = 0
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        entries = cur.execute(
+            """SELECT COUNT(*) FROM status_enum, state
+                      WHERE state.status = status_enum.id
+                       AND proc_type IN (?{}) AND run_name LIKE (?)
+                       AND status_enum.state = 'created'""".format(
+                ",?" * (len(allowed_tasks) - 1)
+            ),
+            (*allowed_tasks, allowed_rels),
+        ).fetchone()[0]
+        while len(runnable_tasks) < task_limit and offset < entries:
+            db_tasks = cur.execute(
+                """SELECT proc_type, run_name FROM status_enum, state
+                          WHERE state.status = status_enum.id
+                           AND proc_type IN (?{}) AND run_name LIKE (?)
+                           AND status_enum.state = 'created'
+                          LIMIT 100 OFFSET ?""".format(
+                    ",?" * (len(allowed_tasks) - 1)
+                ),
+                (*allowed_tasks, allowed_rels, offset),
+            ).fetchall()
+            runnable_tasks.extend(
+                [
+                    (*task, mgmt_db.get_retries(*task))
+                    for task in db_tasks
+                    if mgmt_db._check_dependancy_met(task)
+                    and "{}__{}".format(*task) not in tasks_waiting_for_updates
+                ]
+            )
+            offset += 100
+    return runnable_tasks
+
+
+def legacy_populate(mgmt_db, realisations):
+    """The previous implementation of MgmtDB.populate, a check and insert per task"""
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        procs_to_be_done = cur.execute("select * from proc_type_enum").fetchall()
+        for run_name in realisations:
+            for proc in procs_to_be_done:
+                if not mgmt_db._does_task_exists(cur, run_name, proc[0]):
+                    mgmt_db._insert_task(cur, run_name, proc[0])
+
+
+def legacy_check_mgmt_queue(queue_entries, run_name, proc_type):
+    """The previous implementation of check_mgmt_queue, splits and compares every key"""
+    for entry in queue_entries:
+        _, entry_run_name, entry_proc_type = entry.split(".")
+        if entry_run_name == run_name and entry_proc_type == str(proc_type):
+            return True
+    return False
+
+
+def legacy_add_retries(mgmt_db, n_max_retries):
+    """The previous implementation of MgmtDB.add_retries, counts the failures of every task"""
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        errored = cur.execute(
+            "SELECT run_name, proc_type FROM state WHERE status IN (?, ?)",
+            (const.Status.failed.value, const.Status.killed_WCT.value),
+        ).fetchall()
+    failure_count = {}
+    for task in errored:
+        failure_count[task] = failure_count.get(task, 0) + 1
+    with connect_db_ctx(mgmt_db.db_file) as cur:
+        for (run_name, proc_type), fail_count in failure_count.items():
+            if fail_count >= n_max_retries:
+                continue
+            not_failed_count = cur.execute(
+                "SELECT COUNT(*) FROM state WHERE run_name = ? AND proc_type = ? AND status <= ?",
+                (run_name, proc_type, const.Status.completed.value),
+            ).fetchone()[0]
+            if not_failed_count == 0:
+                mgmt_db._insert_task(cur, run_name, proc_type)
+
+
+def legacy_core_hours(mgmt_db):
+    """The previous core hour collection of cybershake_progress, queries per realisation and job"""
+    core_hours = 0
+    for (rel_name,) in mgmt_db.get_rel_names():
+        for state in mgmt_db.get_core_hour_states(rel_name, ChCountType.Needed):
+            (
+                _,
+                _,
+                _,
+                start_time,
+                end_time,
+                _,
+                cores,
+                _,
+                _,
+            ) = mgmt_db.get_job_duration_info(state[4])
+            core_hours += cores * (end_time - start_time) / 3600
+    return core_hours
+
+
+def time_call(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return result, times
+
+
+def bench_runnable(args):
+    db_file = os.path.join(args.out_dir, "bench_mgmt.db")
+    mgmt_db, n_rows = make_synthetic_db(db_file, args.n_rels)
+    print(f"{n_rows} state rows for {args.n_rels} realisations")
+    legacy_limit = float("inf") if args.task_limit is None else args.task_limit
+
+    for name, func in [
+        (
+            "legacy",
+            lambda: legacy_get_runnable_tasks(mgmt_db, "%", legacy_limit, []),
+        ),
+        (
+            "set based",
+            lambda: mgmt_db.get_runnable_tasks("%", args.task_limit, set()),
+        ),
+    ]:
+        result, times = time_call(func, args.repeats)
+        print(
+            f"{name:>10}: {len(result)} runnable tasks, "
+            f"best {min(times):.3f}s, mean {np.mean(times):.3f}s"
+        )
+    close_connections()
+    os.remove(db_file)
+
+
+def bench_populate(args):
+    db_file = os.path.join(args.out_dir, "bench_mgmt.db")
+    for n_rels in args.n_rels:
+        realisations = [
+            "Fault{}_REL{:02d}".format(i // 50, i % 50) for i in range(n_rels)
+        ]
+        for name, func in [
+            ("legacy", lambda mgmt_db: legacy_populate(mgmt_db, realisations)),
+            ("bulk", lambda mgmt_db: mgmt_db.populate(list(realisations))),
+        ]:
+            mgmt_db, _ = make_synthetic_db(db_file, 0)
+            t0 = time.perf_counter()
+            func(mgmt_db)
+            fresh = time.perf_counter() - t0
+            # Installing again skips every task
+            t0 = time.perf_counter()
+            func(mgmt_db)
+            again = time.perf_counter() - t0
+            print(
+                f"{n_rels:>7} realisations {name:>7}: install {fresh:.3f}s "
+                f"({1e6 * fresh / n_rels:.0f}us per realisation), reinstall {again:.3f}s"
+            )
+    close_connections()
+    os.remove(db_file)
+
+
+def bench_pending(args):
+    """Time of the pending update checks of an auto_submit cycle as the queue grows"""
+    db_file = os.path.join(args.out_dir, "bench_mgmt.db")
+    mgmt_db, _ = make_synthetic_db(db_file, args.n_rels)
+    runnable_tasks = mgmt_db.get_runnable_tasks("%", None, set())
+    print(f"{len(runnable_tasks)} runnable tasks for {args.n_rels} realisations")
+
+    for n_updates in args.n_updates:
+        # Updates for tasks that aren't runnable, so every check is a miss
+        keys = [
+            "{:012d}.Queued{}_REL{:02d}.{}".format(
+                i, i // 50, i % 50, const.ProcessType.HF.value
+            )
+            for i in range(n_updates)
+        ]
+
+        def legacy():
+            return [
+                task
+                for task in runnable_tasks
+                if not legacy_check_mgmt_queue(keys, task[1], task[0])
+            ]
+
+        def indexed():
+            pending_updates = get_pending_updates(keys)
+            return [
+                task
+                for task in runnable_tasks
+                if (task[1], task[0]) not in pending_updates
+            ]
+
+        for name, func in [("legacy", legacy), ("indexed", indexed)]:
+            result, times = time_call(func, args.repeats)
+            assert len(result) == len(runnable_tasks)
+            print(
+                f"{n_updates:>7} pending updates {name:>8}: best {min(times):.3f}s, "
+                f"mean {np.mean(times):.3f}s"
+            )
+    close_connections()
+    os.remove(db_file)
+
+
+def bench_core_hours(args):
+    db_file = os.path.join(args.out_dir, "bench_mgmt.db")
+    mgmt_db, _ = make_synthetic_db(db_file, args.n_rels)
+    with connect_db_ctx(db_file) as cur:
+        cur.execute(
+            "UPDATE state SET job_id = id, last_modified = id WHERE status != ?",
+            (const.Status.created.value,),
+        )
+        cur.execute(
+            "INSERT INTO job_duration_log(job_id, queued_time, start_time, end_time, cores) "
+            "SELECT job_id, 0, 0, 3600, 40 FROM state WHERE job_id IS NOT NULL"
+        )
+
+    for name, func in [
+        ("legacy", lambda: legacy_core_hours(mgmt_db)),
+        (
+            "bulk",
+            lambda: sum(
+                state.core_hours
+                for state in mgmt_db.get_core_hour_states_bulk(ChCountType.Needed)
+            ),
+        ),
+    ]:
+        result, times = time_call(func, args.repeats)
+        print(
+            f"{name:>10}: {result:.0f} core hours for {args.n_rels} realisations, "
+            f"best {min(times):.3f}s, mean {np.mean(times):.3f}s"
+        )
+    close_connections()
+    os.remove(db_file)
+
+
+def bench_retries(args):
+    db_file = os.path.join(args.out_dir, "bench_mgmt.db")
+    mgmt_db, n_rows = make_synthetic_db(db_file, args.n_rels, retry_fraction=0.2)
+    print(f"{n_rows} state rows for {args.n_rels} realisations")
+
+    for name, func in [
+        ("legacy", lambda: legacy_add_retries(mgmt_db, 2)),
+        ("counted", lambda: mgmt_db.add_retries(2)),
+    ]:
+        _, times = time_call(func, args.repeats)
+        print(
+            f"{name:>10}: add_retries best {min(times):.3f}s, mean {np.mean(times):.3f}s"
+        )
+    close_connections()
+    os.remove(db_file)
+
+
+def _add_updates(args):
+    queue_folder, worker, n_updates = args
+    queue = get_queue(queue_folder)
+    for i in range(n_updates):
+        queue.add(
+            make_entry(
+                f"Fault{worker}_REL{i:04d}",
+                const.ProcessType.HF.value,
+                const.Status.completed.value,
+                job_id=worker * n_updates + i,
+            )
+        )
+
+
+def bench_queue(args):
+    for backend in BACKENDS:
+        queue_folder = os.path.join(args.out_dir, f"bench_queue_{backend}")
+        if os.path.isdir(queue_folder):
+            shutil.rmtree(queue_folder)
+        queue = create_queue(queue_folder, backend)
+
+        # Jobs reporting in from separate processes
+        t0 = time.perf_counter()
+        with Pool(args.n_writers) as pool:
+            pool.map(
+                _add_updates,
+                [
+                    (queue_folder, worker, args.n_updates // args.n_writers)
+                    for worker in range(args.n_writers)
+                ],
+            )
+        add_time = time.perf_counter() - t0
+
+        # A queue_monitor and an auto_submit cycle
+        t0 = time.perf_counter()
+        keys = queue.keys()
+        entries = queue.read()
+        queue.remove([key for key, _ in entries])
+        consume_time = time.perf_counter() - t0
+        assert (
+            len(keys)
+            == len(entries)
+            == args.n_updates - (args.n_updates % args.n_writers)
+        )
+        assert len(queue.keys()) == 0
+
+        print(
+            f"{backend:>10}: add {len(entries) / add_time:.0f} updates/s "
+            f"from {args.n_writers} processes, consume {len(entries)} updates {consume_time:.3f}s"
+        )
+        shutil.rmtree(queue_folder)
+
+
+def _consume_updates(queue, watcher, sleep_time, added, latencies, stop):
+    """A queue monitor loop, records the time from each update being added to it being read"""
+    while not stop.is_set():
+        if watcher is None:
+            time.sleep(sleep_time)
+        else:
+            watcher.wait(sleep_time)
+        entries = queue.read()
+        read_time = time.perf_counter()
+        latencies.extend(read_time - added[entry.run_name] for _, entry in entries)
+        queue.remove([key for key, _ in entries])
+
+
+def bench_wake(args):
+    """Time from an update being added to the queue monitor reading it"""
+    rng = random.Random(0)
+    for backend in BACKENDS:
+        for mode in ["sleep", "watch"]:
+            queue_folder = os.path.join(args.out_dir, f"bench_wake_{backend}")
+            if os.path.isdir(queue_folder):
+                shutil.rmtree(queue_folder)
+            queue = create_queue(queue_folder, backend)
+            watcher = QueueWatcher(queue) if mode == "watch" else None
+
+            added, latencies, stop = {}, [], threading.Event()
+            consumer = threading.Thread(
+                target=_consume_updates,
+                args=(queue, watcher, args.sleep_time, added, latencies, stop),
+            )
+            consumer.start()
+            for i in range(args.n_updates):
+                time.sleep(rng.uniform(0, args.sleep_time))
+                run_name = f"Fault_REL{i:04d}"
+                added[run_name] = time.perf_counter()
+                queue.add(
+                    make_entry(
+                        run_name,
+                        const.ProcessType.HF.value,
+                        const.Status.completed.value,
+                    )
+                )
+            while len(latencies) < args.n_updates:
+                time.sleep(0.1)
+            stop.set()
+            consumer.join()
+
+            if watcher is not None:
+                mode = f"watch ({'inotify' if watcher.uses_inotify else 'polling'})"
+                watcher.close()
+            print(
+                f"{backend:>10} {mode:>17}: mean {np.mean(latencies):.2f}s, "
+                f"max {max(latencies):.2f}s from update to read"
+            )
+            shutil.rmtree(queue_folder)
+
+
+COMPLETION_SCRIPT = """#!/bin/bash
+#SBATCH --ntasks=1
+#SBATCH --time=01:00:00
+
+python {add_to_mgmt_queue} {queue_folder} {run_name} EMOD3D running $SLURM_JOB_ID
+sleep {run_time}
+python {add_to_mgmt_queue} {queue_folder} {run_name} EMOD3D completed $SLURM_JOB_ID
+date +%s.%N > {completed_file}
+# As in the templates, the job exits shortly after reporting it has completed
+sleep {exit_delay}
+"""
+
+
+def _find_runnable(mgmt_db, queue, submit_event, sleep_time, runnable_times, stop):
+    """An auto_submit loop, records the time each merge_ts task is first runnable"""
+    while not stop.is_set():
+        runnable_tasks = mgmt_db.get_runnable_tasks(
+            "%",
+            None,
+            get_pending_updates(queue.keys()),
+            [const.ProcessType.merge_ts],
+        )
+        now = time.time()
+        for _, run_name, _ in runnable_tasks:
+            runnable_times.setdefault(run_name, now)
+        if submit_event is None:
+            time.sleep(sleep_time)
+        elif submit_event.wait(sleep_time):
+            submit_event.clear()
+    close_connections()
+
+
+def bench_completion(args):
+    """Time from a job reporting it has completed to its dependant being runnable for auto_submit.
+    The jobs are run by the scheduler of the platform, use a platform with the bash scheduler"""
+    add_to_mgmt_queue = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+        "automation",
+        "execution_scripts",
+        "add_to_mgmt_queue.py",
+    )
+    logger = logging.getLogger("bench_completion")
+    Scheduler.initialise_scheduler(getpass.getuser(), logger=logger)
+    rng = random.Random(0)
+    for mode in ["sleep", "watch"]:
+        root_folder = os.path.join(args.out_dir, f"bench_completion_{mode}")
+        if os.path.isdir(root_folder):
+            shutil.rmtree(root_folder)
+        os.makedirs(root_folder)
+        mgmt_db = MgmtDB.init_db(sim_struct.get_mgmt_db(root_folder), INIT_SCRIPT)
+        queue_folder = sim_struct.get_mgmt_db_queue(root_folder)
+        queue = create_queue(queue_folder, args.backend)
+
+        # Each realisation has an EMOD3D job submitted, with merge_ts waiting on it
+        completed_files = {}
+        for i in range(args.n_jobs):
+            run_name = f"Bench_REL{i:02d}"
+            sim_dir = sim_struct.get_sim_dir(root_folder, run_name)
+            os.makedirs(sim_dir)
+            completed_files[run_name] = os.path.join(sim_dir, "completed_time")
+            script = os.path.join(sim_dir, "bench_job.sh")
+            with open(script, "w") as f:
+                f.write(
+                    COMPLETION_SCRIPT.format(
+                        run_time=rng.uniform(1, 2 * args.sleep_time),
+                        add_to_mgmt_queue=add_to_mgmt_queue,
+                        queue_folder=queue_folder,
+                        run_name=run_name,
+                        completed_file=completed_files[run_name],
+                        exit_delay=args.exit_delay,
+                    )
+                )
+            job_id = Scheduler.get_scheduler().submit_job(sim_dir, script)
+            mgmt_db.insert_tasks(
+                [
+                    (run_name, const.ProcessType.EMOD3D.value),
+                    (run_name, const.ProcessType.merge_ts.value),
+                ]
+            )
+            with connect_db_ctx(mgmt_db.db_file) as cur:
+                cur.execute(
+                    "UPDATE state SET status = ?, job_id = ? WHERE run_name = ? AND proc_type = ?",
+                    (
+                        const.Status.queued.value,
+                        job_id,
+                        run_name,
+                        const.ProcessType.EMOD3D.value,
+                    ),
+                )
+
+        submit_event = threading.Event() if mode == "watch" else None
+        runnable_times, stop = {}, threading.Event()
+        queue_monitor.keepAlive = True
+        monitor = threading.Thread(
+            target=queue_monitor.queue_monitor_loop,
+            args=(root_folder, args.sleep_time, 2),
+            kwargs={
+                "queue_logger": logger,
+                "watch_queue": mode == "watch",
+                "submit_event": submit_event,
+            },
+        )
+        submitter = threading.Thread(
+            target=_find_runnable,
+            args=(
+                mgmt_db,
+                queue,
+                submit_event,
+                args.sleep_time,
+                runnable_times,
+                stop,
+            ),
+        )
+        monitor.start()
+        submitter.start()
+        while len(runnable_times) < args.n_jobs:
+            time.sleep(0.1)
+        stop.set()
+        queue_monitor.keepAlive = False
+        if submit_event is not None:
+            submit_event.set()
+        submitter.join()
+        monitor.join()
+
+        latencies = []
+        for run_name, completed_file in completed_files.items():
+            with open(completed_file) as f:
+                latencies.append(runnable_times[run_name] - float(f.read()))
+        print(
+            f"{args.backend:>10} {mode:>5}: mean {np.mean(latencies):.2f}s, "
+            f"max {max(latencies):.2f}s from a job completing to its dependant being runnable"
+        )
+        shutil.rmtree(root_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="bench")
+    subparsers.required = True
+
+    runnable_parser = subparsers.add_parser(
+        "runnable", help="get_runnable_tasks cycle time"
+    )
+    runnable_parser.add_argument("out_dir", help="directory to create the db in")
+    runnable_parser.add_argument("--n_rels", type=int, default=5000)
+    runnable_parser.add_argument(
+        "--task_limit",
+        type=int,
+        default=None,
+        help="number of tasks auto_submit asks for, defaults to all runnable tasks",
+    )
+    runnable_parser.add_argument("--repeats", type=int, default=3)
+    runnable_parser.set_defaults(func=bench_runnable)
+
+    populate_parser = subparsers.add_parser(
+        "populate", help="install time of a cybershake into the mgmt db"
+    )
+    populate_parser.add_argument("out_dir", help="directory to create the db in")
+    populate_parser.add_argument(
+        "--n_rels", type=int, nargs="+", default=[1000, 5000, 20000]
+    )
+    populate_parser.set_defaults(func=bench_populate)
+
+    queue_parser = subparsers.add_parser(
+        "queue", help="throughput of the mgmt db queue backends"
+    )
+    queue_parser.add_argument(
+        "out_dir",
+        help="directory to create the queues in, use the cybershake filesystem",
+    )
+    queue_parser.add_argument("--n_updates", type=int, default=4000)
+    queue_parser.add_argument("--n_writers", type=int, default=8)
+    queue_parser.set_defaults(func=bench_queue)
+
+    pending_parser = subparsers.add_parser(
+        "pending", help="pending update checks per cycle as the mgmt db queue grows"
+    )
+    pending_parser.add_argument("out_dir", help="directory to create the db in")
+    pending_parser.add_argument("--n_rels", type=int, default=2000)
+    pending_parser.add_argument(
+        "--n_updates", type=int, nargs="+", default=[0, 1000, 5000, 20000]
+    )
+    pending_parser.add_argument("--repeats", type=int, default=3)
+    pending_parser.set_defaults(func=bench_pending)
+
+    core_hours_parser = subparsers.add_parser(
+        "core_hours", help="core hour collection of cybershake_progress"
+    )
+    core_hours_parser.add_argument("out_dir", help="directory to create the db in")
+    core_hours_parser.add_argument("--n_rels", type=int, default=20000)
+    core_hours_parser.add_argument("--repeats", type=int, default=1)
+    core_hours_parser.set_defaults(func=bench_core_hours)
+
+    retries_parser = subparsers.add_parser(
+        "retries", help="add_retries time at queue_monitor start"
+    )
+    retries_parser.add_argument("out_dir", help="directory to create the db in")
+    retries_parser.add_argument("--n_rels", type=int, default=20000)
+    retries_parser.add_argument("--repeats", type=int, default=3)
+    retries_parser.set_defaults(func=bench_retries)
+
+    wake_parser = subparsers.add_parser(
+        "wake", help="latency of the queue monitor reading new updates"
+    )
+    wake_parser.add_argument(
+        "out_dir",
+        help="directory to create the queues in, use the cybershake filesystem",
+    )
+    wake_parser.add_argument("--sleep_time", type=float, default=5)
+    wake_parser.add_argument("--n_updates", type=int, default=10)
+    wake_parser.set_defaults(func=bench_wake)
+
+    completion_parser = subparsers.add_parser(
+        "completion",
+        help="latency from a job completing to its dependant being runnable, with the bash scheduler",
+    )
+    completion_parser.add_argument(
+        "out_dir",
+        help="directory to create the cybershake root folders in",
+    )
+    completion_parser.add_argument("--sleep_time", type=float, default=5)
+    completion_parser.add_argument("--n_jobs", type=int, default=10)
+    completion_parser.add_argument(
+        "--exit_delay",
+        type=float,
+        default=0.5,
+        help="seconds each job runs for after reporting it has completed",
+    )
+    completion_parser.add_argument("--backend", choices=BACKENDS, default=BACKENDS[0])
+    completion_parser.set_defaults(func=bench_completion)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()